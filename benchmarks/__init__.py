@@ -0,0 +1,5 @@
+'''
+Benchmarks of forework: microbenchmarks of the dispatch, identification,
+serialization and query paths, and end-to-end scheduler runs over synthetic
+evidence (see `evidence`). Run them with `python -m benchmarks`.
+'''
@@ -0,0 +1,129 @@
+import os
+import sys
+import argparse
+import json
+import platform
+import datetime
+import tempfile
+import subprocess
+import multiprocessing
+
+from . import evidence, micro, endtoend
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    report = {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'benchmarks': {},
+    }
+    backend = {'name': args.backend}
+    if args.workers is not None:
+        backend['workers'] = args.workers
+    with tempfile.TemporaryDirectory(prefix='forework-bench-') as workdir:
+        root = os.path.join(workdir, 'evidence')
+        manifest = evidence.generate(
+            root, evidence.parse_counts(args.count), args.depth, args.fanout,
+            args.duplicates, args.seed)
+        del manifest['root']
+        report['evidence'] = manifest
+        if args.suite in ('all', 'micro'):
+            config = endtoend.make_config(workdir, root, 'micro')
+            report['benchmarks'].update(micro.run(
+                root, config, args.repeat, args.results_size))
+        if args.suite in ('all', 'e2e'):
+            report['benchmarks'].update(endtoend.run(
+                root, workdir, backend, args.timeout))
+    with open(args.output, 'w') as fd:
+        json.dump(report, fd, indent=4, sort_keys=True)
+    for (name, metrics) in sorted(report['benchmarks'].items()):
+        print('{n:<28} {m}'.format(n=name, m=summary(metrics)))
+    print('Results written to {o}'.format(o=args.output))
+
+
+def summary(metrics):
+    for key in ('per_second', 'artifacts_per_second', 'mean'):
+        if metrics.get(key) is not None:
+            return '{k}={v:.1f}'.format(k=key, v=metrics[key])
+    return ''
+
+
+def flatten(report):
+    # benchmark.metric -> value, for the numeric metrics
+    return {
+        '{b}.{m}'.format(b=name, m=key): value
+        for (name, metrics) in report['benchmarks'].items()
+        for (key, value) in metrics.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    }
+
+
+def compare(args):
+    with open(args.old) as fd:
+        old = flatten(json.load(fd))
+    with open(args.new) as fd:
+        new = flatten(json.load(fd))
+    print('{k:<52} {o:>14} {n:>14} {c:>8}'.format(
+        k='metric', o='old', n='new', c='change'))
+    for key in sorted(set(old) & set(new)):
+        if old[key]:
+            change = '{c:+.1f}%'.format(c=100. * (new[key] - old[key]) /
+                                        old[key])
+        else:
+            change = ''
+        print('{k:<52} {o:>14.6g} {n:>14.6g} {c:>8}'.format(
+            k=key, o=old[key], n=new[key], c=change))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Run the forework benchmarks on synthetic evidence')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument(
+        '-o', '--output',
+        default='benchmark-{t}.json'.format(
+            t=datetime.datetime.now().strftime('%Y%m%dT%H%M%S')),
+        help='JSON file to write the results to')
+    run_parser.add_argument('-s', '--suite', default='all',
+                            choices=('all', 'micro', 'e2e'),
+                            help='Benchmarks to run')
+    run_parser.add_argument('-r', '--repeat', type=int,
+                            default=micro.DEFAULT_REPEAT,
+                            help='Repetitions of the microbenchmarks')
+    run_parser.add_argument('--results-size', type=int,
+                            default=micro.RESULTS_SIZE,
+                            help='Number of tasks of the results queried')
+    run_parser.add_argument('-b', '--backend', default='local',
+                            help='Backend of the end-to-end runs')
+    run_parser.add_argument('-w', '--workers', type=int,
+                            help='Workers of the backend')
+    run_parser.add_argument('--timeout', type=float,
+                            default=endtoend.DEFAULT_TIMEOUT,
+                            help='Timeout of an end-to-end run (seconds)')
+    evidence.add_arguments(run_parser)
+    run_parser.set_defaults(function=run)
+    compare_parser = commands.add_parser(
+        'compare', help='Compare the results of two runs')
+    compare_parser.add_argument('old', help='Results of the reference run')
+    compare_parser.add_argument('new', help='Results of the run to compare')
+    compare_parser.set_defaults(function=compare)
+    args = parser.parse_args(args)
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
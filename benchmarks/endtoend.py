@@ -0,0 +1,112 @@
+import os
+import time
+import multiprocessing
+
+import yaml
+
+from forework import scheduler, results
+from forework.config import ForeworkConfig
+from forework.tasks.raw import Raw
+
+
+DEFAULT_TIMEOUT = 600
+# the scheduler is done once it has been idle for this long (seconds)
+IDLE_SETTLE = 0.5
+# tasks prioritized by the runs measuring the time to the first priority
+# artifact
+PRIORITY_TASKS = ['JpegFile']
+
+
+def make_config(workdir, root, name, **settings):
+    '''
+    Write an investigation configuration and return it
+    '''
+    investigation = {
+        'investigation': 'Benchmark {n}'.format(n=name),
+        'entrypoint': root,
+        'tasks': {},
+    }
+    investigation.update(settings)
+    filename = os.path.join(workdir, '{n}.yml'.format(n=name))
+    with open(filename, 'w') as fd:
+        yaml.dump([investigation], fd)
+    return ForeworkConfig(filename)
+
+
+def wait_until_idle(sched, timeout=DEFAULT_TIMEOUT, settle=IDLE_SETTLE):
+    '''
+    Wait until the scheduler has no queued or running tasks
+    '''
+    deadline = time.time() + timeout
+    idle_since = None
+    while time.time() < deadline:
+        if sched.in_flight == 0 and sched.queued == 0:
+            if idle_since is None:
+                idle_since = time.time()
+            elif time.time() - idle_since >= settle:
+                return
+        else:
+            idle_since = None
+        time.sleep(.01)
+    raise Exception('The scheduler did not complete in {t} seconds'.format(
+        t=timeout))
+
+
+def run_scheduler(config, timeout=DEFAULT_TIMEOUT, priority=None):
+    '''
+    Analyze the entry point of `config` and return the metrics of the run.
+    Times are taken from the tasks themselves, so they do not depend on how
+    often the scheduler is polled.
+    '''
+    sched = scheduler.Scheduler()
+    sched.set_config(config)
+    sched.enqueue(Raw(config.entrypoint, config))
+    sched.start()
+    try:
+        wait_until_idle(sched, timeout)
+    finally:
+        sched.stop()
+    res = sched.results
+    start = results.to_epoch(res.start)
+    ends = [task._end for task in res if task._end is not None]
+    duration = max(ends) - start
+    metrics = {
+        'tasks': len(res),
+        'duration_s': duration,
+        'artifacts_per_second': len(res) / duration,
+        'bytes_per_second': res.size() / duration,
+        'time_to_first_artifact_s': min(ends) - start,
+    }
+    for name in priority or ():
+        ends = [task._end for task in res[name] if task._end is not None]
+        if ends:
+            metrics['time_to_first_{n}_s'.format(n=name)] = min(ends) - start
+            metrics['{n}_done_at_ratio'.format(n=name)] = \
+                (min(ends) - start) / duration
+    return metrics
+
+
+def run(root, workdir, backend=None, timeout=DEFAULT_TIMEOUT):
+    '''
+    Run the end-to-end benchmarks on the evidence in `root`, and return their
+    metrics by name: a plain run, a run prioritizing PRIORITY_TASKS, and a run
+    with deduplication. `backend` is the backend configuration (default: the
+    local backend with one worker per CPU).
+    '''
+    if backend is None:
+        backend = {'name': 'local', 'workers': multiprocessing.cpu_count()}
+    runs = {
+        'scheduler': {},
+        'scheduler_priority': {'priority': PRIORITY_TASKS},
+        'scheduler_dedup': {
+            'dedup': {'tasks': ['TextFile', 'JpegFile', 'PDFFile',
+                                'ZipFile']}},
+    }
+    metrics = {}
+    for (name, settings) in runs.items():
+        config = make_config(workdir, root, name, backend=backend, **settings)
+        # the time to the first priority artifact is reported for every run,
+        # to compare them
+        metrics[name] = run_scheduler(config, timeout, PRIORITY_TASKS)
+        metrics[name]['backend'] = backend['name']
+    return metrics
@@ -0,0 +1,187 @@
+import io
+import os
+import json
+import random
+import zipfile
+import argparse
+
+import PIL.Image
+
+
+# default composition of the synthetic evidence
+DEFAULT_COUNTS = {'text': 200, 'jpeg': 50, 'pdf': 10, 'zip': 10}
+DEFAULT_DEPTH = 3
+DEFAULT_FANOUT = 4
+DEFAULT_DUPLICATES = 0.1
+DEFAULT_TEXT_SIZE = 4096
+ZIP_MEMBERS = 4
+
+WORDS = ('evidence', 'invoice', 'password', 'meeting', 'transfer', 'account',
+         'report', 'contract', 'delivery', 'address', 'forensic', 'update')
+
+
+def make_text(rng, size=DEFAULT_TEXT_SIZE):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    lines = [' '.join(words[i:i + 12]) for i in range(0, len(words), 12)]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def random_bytes(rng, size):
+    # Random.randbytes needs Python 3.9
+    return rng.getrandbits(8 * size).to_bytes(size, 'little')
+
+
+def make_jpeg(rng, width=64, height=64):
+    image = PIL.Image.frombytes(
+        'RGB', (width, height), random_bytes(rng, width * height * 3))
+    buf = io.BytesIO()
+    image.save(buf, 'JPEG', comment=b'synthetic')
+    return buf.getvalue()
+
+
+def make_pdf(rng, pages=2):
+    images = [PIL.Image.frombytes('RGB', (16, 16),
+                                  random_bytes(rng, 16 * 16 * 3))
+              for _ in range(pages)]
+    buf = io.BytesIO()
+    images[0].save(buf, 'PDF', save_all=True, append_images=images[1:])
+    return buf.getvalue()
+
+
+def make_zip(rng, members=ZIP_MEMBERS):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for n in range(members):
+            archive.writestr('member{n}.txt'.format(n=n),
+                             make_text(rng, DEFAULT_TEXT_SIZE // members))
+    return buf.getvalue()
+
+
+MAKERS = {
+    'text': (make_text, '.txt'),
+    'jpeg': (make_jpeg, '.jpg'),
+    'pdf': (make_pdf, '.pdf'),
+    'zip': (make_zip, '.zip'),
+}
+
+
+def make_directories(root, depth, fanout):
+    '''
+    Create a tree of directories `depth` levels deep below `root`, with
+    `fanout` subdirectories each, and return their paths, root included
+    '''
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for n in range(fanout):
+                path = os.path.join(parent, 'd{n}'.format(n=n))
+                os.mkdir(path)
+                next_level.append(path)
+        directories.extend(next_level)
+        level = next_level
+    return directories
+
+
+def generate(root, counts=None, depth=DEFAULT_DEPTH, fanout=DEFAULT_FANOUT,
+             duplicates=DEFAULT_DUPLICATES, seed=0):
+    '''
+    Generate a synthetic evidence tree in `root`, which must not exist.
+
+    `counts` is the number of files of each kind (see `MAKERS`), spread at
+    random over a tree of directories `depth` levels deep with `fanout`
+    subdirectories each. A fraction `duplicates` of the files are copies of
+    other files of the same kind, for the deduplication stage. The same seed
+    generates the same tree. Return a manifest of the tree, as a dict.
+    '''
+    if counts is None:
+        counts = DEFAULT_COUNTS
+    rng = random.Random(seed)
+    os.makedirs(root)
+    directories = make_directories(root, depth, fanout)
+    files = {kind: 0 for kind in counts}
+    total_size = 0
+    duplicated = 0
+    for (kind, count) in sorted(counts.items()):
+        make, extension = MAKERS[kind]
+        written = []
+        for n in range(count):
+            if written and rng.random() < duplicates:
+                data = rng.choice(written)
+                duplicated += 1
+            else:
+                data = make(rng)
+                written.append(data)
+            path = os.path.join(rng.choice(directories), '{k}{n}{e}'.format(
+                k=kind, n=n, e=extension))
+            with open(path, 'wb') as fd:
+                fd.write(data)
+            files[kind] += 1
+            total_size += len(data)
+    return {
+        'root': root,
+        'seed': seed,
+        'depth': depth,
+        'fanout': fanout,
+        'duplicate_ratio': duplicates,
+        'directories': len(directories),
+        'files': files,
+        'duplicates': duplicated,
+        'size': total_size,
+    }
+
+
+def parse_counts(values):
+    '''
+    Parse KIND=COUNT strings into a counts dict for `generate`
+    '''
+    counts = dict(DEFAULT_COUNTS)
+    for value in values or ():
+        kind, _, count = value.partition('=')
+        if kind not in MAKERS:
+            raise argparse.ArgumentTypeError(
+                'Unknown file kind {k!r}, valid kinds are: {v}'.format(
+                    k=kind, v=', '.join(sorted(MAKERS))))
+        counts[kind] = int(count)
+    return counts
+
+
+def add_arguments(parser):
+    parser.add_argument('-n', '--count', action='append', metavar='KIND=N',
+                        help='Number of files of a kind ({k}), can be repeated '
+                             '(default: {d})'.format(
+                                 k=', '.join(sorted(MAKERS)),
+                                 d=', '.join('{k}={n}'.format(k=k, n=n)
+                                             for (k, n) in
+                                             sorted(DEFAULT_COUNTS.items()))))
+    parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH,
+                        help='Nesting depth of the directories')
+    parser.add_argument('--fanout', type=int, default=DEFAULT_FANOUT,
+                        help='Subdirectories per directory')
+    parser.add_argument('--duplicates', type=float,
+                        default=DEFAULT_DUPLICATES,
+                        help='Fraction of files that are duplicates')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random generator')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.evidence',
+        description='Generate a synthetic evidence tree')
+    parser.add_argument('root', help='Directory to create')
+    add_arguments(parser)
+    args = parser.parse_args(args)
+    manifest = generate(args.root, parse_counts(args.count), args.depth,
+                        args.fanout, args.duplicates, args.seed)
+    print(json.dumps(manifest, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import os
+import time
+import pickle
+import random
+import datetime
+import statistics
+
+from forework import basetask, results, utils
+from forework.basetask import BaseTask, DispatchIndex, find_tasks
+from forework.tasks.raw import Raw
+
+
+DEFAULT_REPEAT = 5
+# number of tasks of the synthetic results for the query benchmarks
+RESULTS_SIZE = 100000
+KEYWORDS = ('password', 'invoice', 'transfer', 'account')
+
+
+def measure(function, count, repeat=DEFAULT_REPEAT, setup=None):
+    '''
+    Time `repeat` calls of `function`, each one processing `count` items,
+    after calling `setup` (if any) out of the timed section. Return the best
+    and median times, and the items processed per second in the best call.
+    '''
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    return {
+        'items': count,
+        'repeat': repeat,
+        'best_s': best,
+        'median_s': statistics.median(timings),
+        'per_second': count / best if best > 0 else None,
+    }
+
+
+def list_files(root):
+    paths = []
+    for (dirpath, _, filenames) in os.walk(root):
+        paths.extend(os.path.join(dirpath, name) for name in filenames)
+    return sorted(paths)
+
+
+def clear_file_type_caches():
+    utils._file_type_cache.clear()
+    utils._header_cache.clear()
+
+
+def bench_file_type(paths, repeat):
+    '''
+    libmagic identification of the evidence files, with empty caches (cold)
+    and with the memoized types (warm)
+    '''
+    def identify():
+        for path in paths:
+            utils.get_file_type(path)
+
+    cold = measure(identify, len(paths), repeat, setup=clear_file_type_caches)
+    warm = measure(identify, len(paths), repeat)
+    return {'get_file_type_cold': cold, 'get_file_type_warm': warm}
+
+
+def bench_dispatch(filetypes, repeat):
+    '''
+    Lookup of the tasks handling the file types of the evidence, with a new
+    dispatch index (cold) and with `find_tasks_by_filetype`, whose index
+    caches the lookups (warm)
+    '''
+    tasks = find_tasks()
+    # the file types are looked up in the proportions of the evidence
+    lookups = filetypes * max(1, 10000 // max(1, len(filetypes)))
+    index = []
+
+    def new_index():
+        index[:] = [DispatchIndex(tasks)]
+
+    def lookup():
+        dispatch = index[0]
+        for filetype in lookups:
+            list(dispatch.lookup(filetype, True))
+
+    def find():
+        for filetype in lookups:
+            basetask.find_tasks_by_filetype(filetype)
+
+    return {
+        'dispatch_cold': measure(lookup, len(lookups), repeat,
+                                 setup=new_index),
+        'find_tasks_by_filetype': measure(find, len(lookups), repeat),
+    }
+
+
+def bench_serialization(paths, config, repeat):
+    '''
+    Conversions of completed tasks to and from dicts and JSON, as done for
+    the results stores, checkpoints and broker messages, and pickling, as
+    done for the process pool and IPyParallel backends
+    '''
+    tasks = [Raw(path, config).start() for path in paths]
+    dicts = [task.to_dict() for task in tasks]
+    jsons = [task.to_json() for task in tasks]
+    pickles = [pickle.dumps(task) for task in tasks]
+    metrics = {
+        'to_dict': measure(lambda: [t.to_dict() for t in tasks],
+                           len(tasks), repeat),
+        'from_dict': measure(
+            lambda: [BaseTask.from_dict(d, config) for d in dicts],
+            len(tasks), repeat),
+        'to_json': measure(lambda: [t.to_json() for t in tasks],
+                           len(tasks), repeat),
+        'from_json': measure(
+            lambda: [BaseTask.from_json(j, config) for j in jsons],
+            len(tasks), repeat),
+        'pickle': measure(lambda: [pickle.dumps(t) for t in tasks],
+                          len(tasks), repeat),
+        'unpickle': measure(lambda: [pickle.loads(p) for p in pickles],
+                            len(tasks), repeat),
+    }
+    metrics['json_bytes'] = {
+        'mean': statistics.mean(len(j) for j in jsons)}
+    metrics['pickle_bytes'] = {
+        'mean': statistics.mean(len(p) for p in pickles)}
+    return metrics
+
+
+def make_results(config, count=RESULTS_SIZE, seed=0):
+    '''
+    Return `count` completed tasks spread over one hour, a quarter of them
+    with keywords in their result
+    '''
+    rng = random.Random(seed)
+    epoch = time.time() - 3600
+    tasks = []
+    for n in range(count):
+        start = epoch + rng.random() * 3600
+        tasks.append(BaseTask.from_dict({
+            'name': 'Raw',
+            'path': '/evidence/{n}'.format(n=n),
+            'completed': True,
+            'start': start,
+            'end': start + rng.random() * 10,
+            'result': ({'keywords': rng.sample(KEYWORDS, 2)}
+                       if n % 4 == 0 else None),
+        }, config))
+    return tasks
+
+
+def bench_results(config, repeat, count=RESULTS_SIZE):
+    '''
+    Queries on the results of an investigation: the first query builds the
+    index it uses, the following ones reuse it
+    '''
+    tasks = make_results(config, count)
+    first = datetime.datetime.fromtimestamp(
+        min(task._start for task in tasks), datetime.timezone.utc)
+    ranges = [(first + datetime.timedelta(minutes=n),
+               first + datetime.timedelta(minutes=n + 2)) for n in range(60)]
+    res = []
+
+    def new_results():
+        res[:] = [results.Results(tasks)]
+
+    def by_name():
+        res[0]['Raw']
+
+    def in_range():
+        for (start, end) in ranges:
+            res[0].in_range(start, end)
+
+    def hits():
+        for keyword in KEYWORDS:
+            res[0].hits(keyword)
+
+    metrics = {
+        'results_by_name_first': measure(by_name, 1, repeat,
+                                         setup=new_results),
+        'results_in_range_first': measure(in_range, len(ranges), repeat,
+                                          setup=new_results),
+        'results_hits_first': measure(hits, len(KEYWORDS), repeat,
+                                      setup=new_results),
+    }
+    new_results()
+    by_name()
+    in_range()
+    hits()
+    metrics['results_by_name'] = measure(by_name, 1, repeat)
+    metrics['results_in_range'] = measure(in_range, len(ranges), repeat)
+    metrics['results_hits'] = measure(hits, len(KEYWORDS), repeat)
+    for value in metrics.values():
+        value['tasks'] = count
+    return metrics
+
+
+def run(root, config, repeat=DEFAULT_REPEAT, results_size=RESULTS_SIZE):
+    '''
+    Run the microbenchmarks on the evidence in `root`, and return their
+    metrics by name
+    '''
+    paths = list_files(root)
+    clear_file_type_caches()
+    filetypes = [utils.get_file_type(path) for path in paths]
+    metrics = {}
+    metrics.update(bench_file_type(paths, repeat))
+    metrics.update(bench_dispatch(filetypes, repeat))
+    metrics.update(bench_serialization(paths, config, repeat))
+    metrics.update(bench_results(config, repeat, results_size))
+    return metrics
+
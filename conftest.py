@@ -1,10 +1,14 @@
+import io
 import os
 import sys
 
+import PIL.Image
 import pytest
+import yaml
 
 sys.path.insert(0, '..')
 from forework.config import ForeworkConfig
+from forework.tasks import jpeg
 
 
 @pytest.fixture
@@ -19,3 +23,57 @@ def test_image_1(images_dir):
 @pytest.fixture
 def test_conf():
     return ForeworkConfig('tests/test.yml')
+
+
+@pytest.fixture
+def make_conf(tmp_path):
+    '''
+    Return a function building a ForeworkConfig from a dict of task settings
+    '''
+    def _make_conf(tasks=None, **settings):
+        investigation = {
+            'investigation': 'Test investigation',
+            'entrypoint': str(tmp_path),
+            'tasks': tasks or {},
+        }
+        investigation.update(settings)
+        conf_file = tmp_path / 'investigation.yml'
+        conf_file.write_text(yaml.dump([investigation]))
+        return ForeworkConfig(str(conf_file))
+    return _make_conf
+
+
+@pytest.fixture
+def make_jpeg():
+    '''
+    Return a function building a small JPEG file with EXIF and GPS tags and a
+    comment, returning its content and writing it to `path` if given
+    '''
+    def _make_jpeg(path=None):
+        exif = PIL.Image.Exif()
+        exif[0x010f] = 'Canon'
+        exif.get_ifd(jpeg.EXIF_IFD_TAG)[0x9003] = '2019:12:31 23:59:58'
+        gps = exif.get_ifd(jpeg.GPS_IFD_TAG)
+        gps[1], gps[2] = 'N', (45.0, 30.0, 0.0)
+        gps[3], gps[4] = 'W', (10.0, 15.0, 36.0)
+        buf = io.BytesIO()
+        PIL.Image.new('RGB', (8, 8)).save(buf, 'JPEG', exif=exif,
+                                          comment=b'hello')
+        data = buf.getvalue()
+        if path is not None:
+            path.write_bytes(data)
+        return data
+    return _make_jpeg
+
+
+@pytest.fixture
+def make_pdf():
+    '''
+    Return a function writing a PDF file of two pages, each one an image, to
+    `path`
+    '''
+    def _make_pdf(path):
+        first = PIL.Image.new('RGB', (16, 16), (255, 0, 0))
+        second = PIL.Image.new('RGB', (8, 8), (0, 0, 255))
+        first.save(str(path), save_all=True, append_images=[second])
+    return _make_pdf
@@ -7,10 +7,12 @@ import datetime
 import IPython
 
 from . import scheduler
-from . import utils, config
+from . import utils, config, dfxml
 # the following imports are useful in the shell
 from .basetask import BaseTask, find_tasks, now
 from .tasks.raw import Raw
+from .tasks.carver import Carver
+from .tasks.entropy import Entropy
 
 
 logger = utils.get_logger(__name__)
@@ -27,6 +29,19 @@ def parse_args(args=None):
     parser = argparse.ArgumentParser(prog='forework')
     parser.add_argument('-c', '--config', required=True,
                         help='Configuration file for the investigation (YAML)')
+    parser.add_argument('-r', '--resume', nargs='?', const='',
+                        metavar='CHECKPOINT',
+                        help='Resume the investigation from a checkpoint. If '
+                             'not specified, the checkpoint file from the '
+                             'configuration is used')
+    parser.add_argument('--dfxml', metavar='INVENTORY',
+                        help='Analyze the files listed in a DFXML inventory of '
+                             'the entry point, instead of walking it')
+    parser.add_argument('--carve', action='store_true',
+                        help='Carve the entry point too, e.g. a raw disk image')
+    parser.add_argument('--entropy', action='store_true',
+                        help='Compute the entropy profile of the entry point '
+                             'too, and analyze its high-entropy regions first')
     return parser.parse_args(args)
 
 
@@ -43,7 +58,16 @@ def main():
     conf = config.ForeworkConfig(args.config)
     sched = scheduler.get()
     sched.set_config(conf)
-    sched.enqueue(Raw(conf.entrypoint, conf))
+    if args.resume is not None:
+        sched.resume(args.resume or None)
+    elif args.dfxml is not None:
+        sched.enqueue_many(dfxml.import_tasks(args.dfxml, conf))
+    else:
+        sched.enqueue(Raw(conf.entrypoint, conf))
+        if args.carve:
+            sched.enqueue(Carver(conf.entrypoint, conf))
+        if args.entropy:
+            sched.enqueue(Entropy(conf.entrypoint, conf))
     IPython.embed()
 
 main()
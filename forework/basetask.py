@@ -1,12 +1,14 @@
 import os
 import re
 import json
+import time
 import datetime
+import functools
 
 import pytz
 import dateutil.parser
 
-from . import (utils, config)
+from . import (utils, config, sources, profiling)
 
 logger = utils.get_logger(__name__)
 
@@ -15,14 +17,39 @@ PRIO_NORMAL = 0
 PRIO_HIGH = 10
 
 _tasks_cache = {}
+_dispatch_index = None
+# Callable receiving batches of follow-up tasks (as JSON strings) published by
+# a task before it completes. See `set_emitter`
+_emitter = None
 
 
 def now():
     return str(datetime.datetime.utcnow().replace(tzinfo=pytz.UTC))
 
 
+def format_time(epoch):
+    '''
+    Convert seconds since the epoch to a string in the same format as `now`
+    '''
+    if epoch is None:
+        return None
+    return str(datetime.datetime.fromtimestamp(epoch, pytz.UTC))
+
+
+def parse_time(timestamp):
+    '''
+    Convert a string returned by `now` or `format_time` to seconds since the
+    epoch
+    '''
+    if timestamp is None:
+        return None
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    return dateutil.parser.parse(timestamp).timestamp()
+
+
 def _rebuild_cache():
-    global _tasks_cache
+    global _tasks_cache, _dispatch_index
     logger.info('Rebuilding tasks cache from %r', config.tasks_dir)
     import importlib
     modules = importlib.__import__('forework.tasks', fromlist='*')
@@ -35,14 +62,12 @@ def _rebuild_cache():
         )
         classes = [o for o in dir(module) if o[:2] != '__']
         for classname in classes:
-            # We don't want Raw in the task cache to avoid loops
-            if classname == 'Raw':
-                continue
             cls = getattr(module, classname)
             if type(cls) == type and cls != BaseTask and \
                     issubclass(cls, BaseTask):
                 tasks[classname] = cls
     _tasks_cache = tasks
+    _dispatch_index = None
     logger.debug('Tasks cache rebuilt: {n} tasks found'.format(n=len(tasks)))
 
 
@@ -66,58 +91,230 @@ def find_tasks(name=None, rebuild_cache=False):
     if name is not None:
         tasks_found = [_tasks_cache[name]]
     else:
-        tasks_found = list(_tasks_cache.values())
-    logger.info('Tasks found: {t}'.format(t=tasks_found))
+        # tasks that are not dispatchable (e.g. Raw) are only found by name, to
+        # avoid loops
+        tasks_found = [task for task in _tasks_cache.values()
+                       if task.DISPATCHABLE]
+    logger.debug('Tasks found: {t}'.format(t=tasks_found))
     return tasks_found
 
 
+def set_emitter(emitter):
+    '''
+    Install the callable that receives follow-up tasks published by a running
+    task through `BaseTask.flush_next_tasks`. The callable is invoked with a
+    list of tasks in JSON format. Passing None removes the emitter, and
+    follow-up tasks are then returned only together with the task results.
+    '''
+    global _emitter
+    _emitter = emitter
+
+
+class DispatchIndex:
+    '''
+    Index to find the tasks that can handle a file type.
+
+    The MAGIC_PATTERNs of all the tasks are compiled into a single regular
+    expression, whose alternatives are tried in the same order as the tasks,
+    and the handlers found for each file type are memoized in an LRU cache.
+    '''
+
+    def __init__(self, tasks, cache_size=config.DISPATCH_CACHE_SIZE):
+        self._tasks = list(tasks)
+        self._names = [task.__name__ for task in self._tasks]
+        for task in self._tasks:
+            if task.MAGIC_PATTERN is None:
+                raise Exception('MAGIC_PATTERN must be defined by the task '
+                                '{name}'.format(name=task.__name__))
+        try:
+            self._rx = re.compile('|'.join(
+                '(?P<t{n}>{p})'.format(n=idx, p=task.MAGIC_PATTERN)
+                for (idx, task) in enumerate(self._tasks)
+            ))
+        except re.error as exc:
+            # e.g. patterns using numbered backreferences. Fall back to
+            # matching the patterns one by one
+            logger.warning('Cannot compile the dispatch index, matching task '
+                           'patterns one by one: {e}'.format(e=exc))
+            self._rx = None
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    def __repr__(self):
+        return '<{cls}(tasks={n}, {s})>'.format(
+            cls=self.__class__.__name__,
+            n=len(self._tasks),
+            s=self.lookup.cache_info(),
+        )
+
+    def _lookup(self, filetype, first_only):
+        '''
+        Return the names of the tasks that can handle a file type, as a tuple
+        '''
+        if first_only and self._rx is not None:
+            match = self._rx.match(filetype)
+            if match is None:
+                return ()
+            return (self._names[int(match.lastgroup[1:])],)
+        names = []
+        for task in self._tasks:
+            if task.can_handle(filetype):
+                names.append(task.__name__)
+                if first_only:
+                    break
+        return tuple(names)
+
+    def stats(self):
+        '''
+        Return the hit/miss statistics of the file type cache, as a dict
+        '''
+        info = self.lookup.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            'tasks': len(self._tasks),
+            'hits': info.hits,
+            'misses': info.misses,
+            'hit_rate': info.hits / lookups if lookups else 0.,
+            'cached_filetypes': info.currsize,
+            'cache_size': info.maxsize,
+        }
+
+
+def get_dispatch_index():
+    '''
+    Return the dispatch index for the available tasks, building it if needed.
+    The index is rebuilt whenever the tasks cache is.
+    '''
+    global _dispatch_index
+    if _dispatch_index is None or not config.ENABLE_TASKS_CACHE:
+        tasks = find_tasks()
+        _dispatch_index = DispatchIndex(tasks)
+    return _dispatch_index
+
+
+def dispatch_stats():
+    '''
+    Return the hit/miss statistics of the dispatch index in this process
+    '''
+    return get_dispatch_index().stats()
+
+
 def find_tasks_by_filetype(filetype, first_only=True):
     '''
     Search for tasks that can handle a file type (described as a string), and
     return their names as a list of strings. If `first_only` is True, only the
     first task name is returned, as a string.
     '''
-    logger.info('Searching for tasks that can handle %r', filetype)
-    all_tasks = find_tasks()
-    suitable_tasks = []
-    for task in all_tasks:
-        if task.can_handle(filetype):
-            if first_only:
-                return [task.__name__]
-            suitable_tasks.append(task.__name__)
-    return suitable_tasks
+    logger.debug('Searching for tasks that can handle %r', filetype)
+    return list(get_dispatch_index().lookup(filetype, first_only))
 
 
 class BaseTask:
+    '''
+    Base class for all the tasks.
+
+    Tasks are created in large numbers and sent back and forth to the workers,
+    so they use __slots__ (derived tasks should declare theirs too, even if
+    empty), and refer to their configuration by ID (see
+    `config.ForeworkConfig.id`) so that it is not pickled with every task.
+    Start and end times are stored as seconds since the epoch, and as
+    monotonic clock readings for durations.
+
+    Objects that are not files of their own, e.g. archive members, are located
+    by a source (see `sources.open_source`) and have a virtual path. Tasks
+    should read their object with `open` rather than opening their path.
+    '''
+
+    __slots__ = (
+        '_path', '_offset', '_done', '_start', '_end', '_start_monotonic',
+        '_end_monotonic', '_time_function', '_result', '_warnings',
+        '_priority', '_depth', '_filetype', '_content_hash', '_hash_algorithm',
+        '_duplicate_of',
+        '_next_tasks', '_emitted', '_config_id', '_size', '_source',
+        '_worker', '_profile', '_parent', '_known',
+    )
 
     # Pattern used to match the file type to the task
     MAGIC_PATTERN = None
     # Modifiers that a task can handle. This is a list of strings
     MODIFIERS = []
+    # True if the task hands follow-up tasks to the scheduler while running
+    # (see `flush_next_tasks`)
+    STREAMS_NEXT_TASKS = False
+    # False if the task must not be selected by file type, but only by name
+    DISPATCHABLE = True
+    # Maximum number of tasks of this class run together by a worker, to save
+    # the per-task overhead of small tasks. Batches are made of the tasks
+    # dequeued together, and batched tasks must not stream follow-up tasks
+    BATCH_SIZE = 1
     _rx = None
 
     def __init__(self, path, config, offset=0, priority=PRIO_NORMAL,
-                 time_function=None):
-        self._name = self.__class__.__name__
+                 time_function=None, depth=0, source=None):
         self._path = path
         self._offset = offset
         self._done = False
         self._start = None
         self._end = None
-        if time_function is None:
-            self._time_function = now
-        else:
-            self._time_function = time_function
+        self._start_monotonic = None
+        self._end_monotonic = None
+        # function returning the current time in seconds since the epoch. None
+        # means time.time, and keeps the task picklable
+        self._time_function = time_function
         self._result = None
         self._warnings = []
         self._priority = priority
+        # distance from the entry point in the tree of discovered tasks
+        self._depth = depth
+        # file type as identified by libmagic, if known
+        self._filetype = None
+        # content hash and its hashlib algorithm, and path of the task whose
+        # result was reused if this task was deduplicated (see
+        # `dedup.Deduplicator`)
+        self._content_hash = None
+        self._hash_algorithm = None
+        self._duplicate_of = None
+        # True if the task's file is a known file (see
+        # `knownhashes.KnownFileFilter`)
+        self._known = False
         self._next_tasks = []
+        self._emitted = 0
+        # worker that ran the task (see `utils.worker_id`)
+        self._worker = None
+        # profile of the run, if it was sampled (see `profiling`)
+        self._profile = None
+        # key of the running task that streamed this task, if any (see
+        # `flush_next_tasks`)
+        self._parent = None
         self._config = config
-        if os.path.isfile(path):
+        # location of the object if it is not a file of its own
+        self._source = source
+        if source is not None:
+            self._size = source.get('size') or 0
+        elif os.path.isfile(path):
             self._size = os.stat(path).st_size
         else:
             self._size = 0
 
+    @property
+    def _name(self):
+        return self.__class__.__name__
+
+    @property
+    def _config(self):
+        return config.get_config(self._config_id)
+
+    @_config.setter
+    def _config(self, value):
+        if value is None:
+            self._config_id = None
+        else:
+            self._config_id = config.register(value)
+
+    def _now(self):
+        if self._time_function is None:
+            return time.time()
+        return self._time_function()
+
     def __repr__(self):
         return '<{cls}(path={p!r}, result={r!r})>'.format(
             cls=self.__class__.__name__,
@@ -129,7 +326,7 @@ class BaseTask:
     def can_handle(self, magic_string):
         if self.MAGIC_PATTERN is None:
             raise Exception('MAGIC_PATTERN must be defined by the task {name}'
-                            .format(name=self._name))
+                            .format(name=self.__name__))
         if self._rx is None:
             self._rx = re.compile(self.MAGIC_PATTERN)
         return self._rx.match(magic_string)
@@ -157,12 +354,23 @@ class BaseTask:
             'path': self._path,
             'offset': self._offset,
             'completed': self._done,
-            'start': self._start,
-            'end': self._end,
+            'start': format_time(self._start),
+            'end': format_time(self._end),
             'priority': self._priority,
-            'result': self.results,
+            'depth': self._depth,
+            'filetype': self._filetype,
+            'size': self._size,
+            'source': self._source,
+            'content_hash': self._content_hash,
+            'hash_algorithm': self._hash_algorithm,
+            'duplicate_of': self._duplicate_of,
+            'known': self._known,
+            'result': self._result if self._done else None,
             'next_tasks': self.next_tasks,
             'warnings': self.warnings,
+            'worker': self._worker,
+            'profile': self._profile,
+            'parent': self._parent,
         }
 
     @staticmethod
@@ -177,28 +385,65 @@ class BaseTask:
         '''
         Build a task from its dict representation (see `to_dict`)
         '''
-        task_name = taskdict['name'][0]
+        task_name = taskdict['name']
+        if isinstance(task_name, list):
+            # follow-up tasks list the suitable tasks, the first one is used
+            task_name = task_name[0]
         cls = find_tasks(task_name)[0]
         path = taskdict['path']
         offset = taskdict.get('offset', 0)
         args = taskdict.get('args', [])
         task = cls(path, config, offset=offset, *args,
-                   priority=taskdict.get('priority', PRIO_NORMAL))
-        task.done = taskdict.get('completed', False)
+                   priority=taskdict.get('priority', PRIO_NORMAL),
+                   depth=taskdict.get('depth', 0),
+                   source=taskdict.get('source'))
+        if taskdict.get('completed', False):
+            task._start = parse_time(taskdict.get('start'))
+            task._end = parse_time(taskdict.get('end'))
+            task._done = True
         task._result = taskdict.get('result', None)
+        task._warnings = list(taskdict.get('warnings', []))
+        task._filetype = taskdict.get('filetype', None)
+        task._content_hash = taskdict.get('content_hash', None)
+        task._hash_algorithm = taskdict.get('hash_algorithm', None)
+        task._duplicate_of = taskdict.get('duplicate_of', None)
+        task._known = taskdict.get('known', False)
+        task._worker = taskdict.get('worker', None)
+        task._profile = taskdict.get('profile', None)
+        parent = taskdict.get('parent')
+        task._parent = tuple(parent) if parent is not None else None
+        # follow-up tasks not yet handed to the scheduler, e.g. when the task
+        # was completed by a worker and returned as a dict
+        task._next_tasks = [
+            json.loads(t) if isinstance(t, str) else t
+            for t in taskdict.get('next_tasks') or []
+        ]
         return task
 
     @property
     def start_time(self):
         if self._start is None:
             return None
-        return dateutil.parser.parse(self._start)
+        return datetime.datetime.fromtimestamp(self._start, pytz.UTC)
 
     @property
     def end_time(self):
         if self._end is None:
             return None
-        return dateutil.parser.parse(self._end)
+        return datetime.datetime.fromtimestamp(self._end, pytz.UTC)
+
+    @property
+    def duration(self):
+        '''
+        Return the run time of the task in seconds, measured with a monotonic
+        clock if available
+        '''
+        if self._start_monotonic is not None and \
+                self._end_monotonic is not None:
+            return self._end_monotonic - self._start_monotonic
+        if self._start is None or self._end is None:
+            return None
+        return self._end - self._start
 
     @property
     def conf(self):
@@ -211,6 +456,43 @@ class BaseTask:
     def path(self):
         return self._path
 
+    @property
+    def key(self):
+        '''
+        Return a tuple identifying the object analyzed by this task, used to
+        recognize tasks already completed (e.g. when resuming an investigation)
+        '''
+        return (self._name, self._path, self._offset)
+
+    @property
+    def filetype(self):
+        '''
+        Return the file type of the task's file, identifying it only if it was
+        not already identified by the task that discovered it
+        '''
+        if self._filetype is None:
+            if self._source is None:
+                self._filetype = utils.get_file_type(self._path)
+            else:
+                self._filetype = utils.get_buffer_type(self.read_header())
+        return self._filetype
+
+    def read_header(self, size=config.FILE_TYPE_HEADER_SIZE):
+        '''
+        Return the first `size` bytes of the task's file. If the file was
+        identified in this process, the buffer read to identify it is reused.
+        '''
+        if self._source is not None:
+            return sources.read_header(self._path, self._source, size)
+        return utils.read_header(self._path, size)
+
+    def open(self):
+        '''
+        Open the task's object, whether it is a file or is located by a source,
+        and return a readable and seekable binary file object
+        '''
+        return sources.open_source(self._path, self._source)
+
     @property
     def done(self):
         return self._done
@@ -223,18 +505,44 @@ class BaseTask:
                 .format(cls=self.__class__.__name__),
             )
         if value is False:
-            self._start = self._time_function()
+            self._start = self._now()
+            self._start_monotonic = time.monotonic()
         else:
-            self._end = self._time_function()
+            self._end = self._now()
+            self._end_monotonic = time.monotonic()
         self._done = value
 
     def add_next_task(self, jsondata):
         '''
         Add a new follow-up task to the next_tasks list. The input is a valid
-        JSON representation of a task.
+        JSON representation of a task. Unless specified, the follow-up task is
+        one level deeper than this task in the tree of discovered tasks.
         '''
+        jsondata.setdefault('depth', self._depth + 1)
         self._next_tasks.append(jsondata)
 
+    def flush_next_tasks(self):
+        '''
+        Hand the follow-up tasks collected so far to the emitter (see
+        `set_emitter`), so that they can be scheduled while this task is still
+        running. If no emitter is installed the tasks are kept, and returned
+        with the results as usual. Return the number of tasks handed over.
+
+        The tasks handed over are marked with the key of this task: until it
+        completes, they are left out of the checkpoints, since this task
+        streams them again when it is resumed.
+        '''
+        if _emitter is None or not self._next_tasks:
+            return 0
+        parent = list(self.key)
+        for taskdict in self._next_tasks:
+            taskdict['parent'] = parent
+        batch = self.next_tasks
+        _emitter(batch)
+        self._emitted += len(batch)
+        self._next_tasks = []
+        return len(batch)
+
     @property
     def next_tasks(self):
         '''
@@ -257,19 +565,27 @@ class BaseTask:
         return self._warnings
 
     def start(self):
+        self._worker = utils.worker_id()
         self.done = False
         logger.info('Task {tn} started at {ts}'.format(
             tn=self.__class__.__name__,
-            ts=self._start,
+            ts=format_time(self._start),
         ))
+        profiler = None
+        if self._config is not None:
+            profiler = profiling.start_profiler(self._name,
+                                                self._config.profiling)
         try:
             self.run()
         except Exception as exc:
             logger.exception(exc)
+        finally:
+            if profiler is not None:
+                self._profile = profiling.stop_profiler(profiler)
         self.done = True
         logger.info('Task {tn} ended at {ts}'.format(
             tn=self.__class__.__name__,
-            ts=self._end,
+            ts=format_time(self._end),
         ))
         return self
 
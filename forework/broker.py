@@ -0,0 +1,464 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import argparse
+import threading
+import collections
+
+from . import utils, basetask, config
+
+
+logger = utils.get_logger(__name__)
+
+# how long a fetched message stays leased to a worker before it is delivered
+# again, unless the worker acknowledges it or extends the lease
+DEFAULT_VISIBILITY_TIMEOUT = 60
+# number of deliveries of a message before it is failed, e.g. when the tasks
+# keep crashing their workers
+DEFAULT_MAX_ATTEMPTS = 3
+# number of messages fetched at once by a worker
+DEFAULT_PREFETCH = 4
+DEFAULT_POLL_INTERVAL = 0.1
+
+# kinds of the records of the result backend
+RESULT = 'result'
+ERROR = 'error'
+STREAM = 'stream'
+
+Record = collections.namedtuple('Record', ['message_id', 'kind', 'payload'])
+
+
+class MemoryBroker:
+    '''
+    In-process broker, for workers running as threads of the scheduler's
+    process (e.g. tests, or a single box). See `SQLiteBroker` for the
+    semantics.
+    '''
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self._max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # message ID -> payload, in order of publication
+        self._ready = collections.OrderedDict()
+        # message ID -> [payload, worker, deadline]
+        self._leased = {}
+        self._attempts = collections.Counter()
+        self._records = []
+
+    def __repr__(self):
+        return '<{cls}(ready={r}, leased={l})>'.format(
+            cls=self.__class__.__name__,
+            r=len(self._ready),
+            l=len(self._leased),
+        )
+
+    def publish(self, messages):
+        with self._lock:
+            for (message_id, payload) in messages:
+                self._ready[message_id] = payload
+
+    def _expire(self, now):
+        for (message_id, (payload, _, deadline)) in list(self._leased.items()):
+            if deadline > now:
+                continue
+            del self._leased[message_id]
+            if self._attempts[message_id] >= self._max_attempts:
+                self._records.append(Record(
+                    message_id, ERROR, 'Delivered {n} times without an '
+                    'acknowledgement'.format(n=self._attempts.pop(message_id))))
+            else:
+                self._ready[message_id] = payload
+                self._ready.move_to_end(message_id, last=False)
+
+    def fetch(self, worker, count, visibility_timeout):
+        now = time.time()
+        messages = []
+        with self._lock:
+            self._expire(now)
+            while self._ready and len(messages) < count:
+                message_id, payload = self._ready.popitem(last=False)
+                self._leased[message_id] = [payload, worker,
+                                            now + visibility_timeout]
+                self._attempts[message_id] += 1
+                messages.append((message_id, payload))
+        return messages
+
+    def extend(self, message_ids, worker, visibility_timeout):
+        deadline = time.time() + visibility_timeout
+        with self._lock:
+            for message_id in message_ids:
+                lease = self._leased.get(message_id)
+                if lease is not None and lease[1] == worker:
+                    lease[2] = deadline
+
+    def ack(self, message_id, worker, kind, payload):
+        with self._lock:
+            lease = self._leased.get(message_id)
+            if lease is None or lease[1] != worker:
+                return False
+            del self._leased[message_id]
+            self._attempts.pop(message_id, None)
+            self._records.append(Record(message_id, kind, payload))
+            return True
+
+    def stream(self, message_id, worker, payload):
+        with self._lock:
+            lease = self._leased.get(message_id)
+            if lease is None or lease[1] != worker:
+                return False
+            self._records.append(Record(message_id, STREAM, payload))
+            return True
+
+    def take(self, kinds):
+        with self._lock:
+            taken = [r for r in self._records if r.kind in kinds]
+            self._records = [r for r in self._records if r.kind not in kinds]
+        return taken
+
+    def purge(self):
+        with self._lock:
+            purged = list(self._ready)
+            self._ready.clear()
+        return purged
+
+    def close(self):
+        pass
+
+
+class SQLiteBroker:
+    '''
+    Broker and result backend stored in a SQLite database, so that workers in
+    other processes of the same box, or on hosts sharing the file, can pull
+    tasks from it with no service to run.
+
+    Messages are fetched by workers under a lease: a message not acknowledged
+    (see `ack`) before its visibility timeout expires is delivered again, up
+    to `max_attempts` times. Acknowledgements store the result of the message
+    in the result backend, where the scheduler takes it (see `take`), and
+    acknowledgements of expired leases taken over by another worker are
+    ignored, so that every message gets exactly one result.
+
+    Follow-up tasks streamed by the tasks of a message (see `stream`) are
+    stored under the same lease check, so nothing is streamed for a message
+    once it has its result. A message delivered again streams its follow-up
+    tasks again though, including those streamed before its lease expired:
+    streamed tasks can repeat.
+    '''
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS messages ('
+        '    seq INTEGER PRIMARY KEY AUTOINCREMENT,'
+        '    id TEXT UNIQUE,'
+        '    payload TEXT,'
+        '    worker TEXT,'
+        '    deadline REAL,'
+        '    attempts INTEGER DEFAULT 0'
+        ')',
+        'CREATE INDEX IF NOT EXISTS messages_deadline ON messages (deadline)',
+        'CREATE TABLE IF NOT EXISTS records ('
+        '    seq INTEGER PRIMARY KEY AUTOINCREMENT,'
+        '    message_id TEXT,'
+        '    kind TEXT,'
+        '    payload TEXT'
+        ')',
+        'CREATE INDEX IF NOT EXISTS records_kind ON records (kind)',
+    )
+
+    def __init__(self, filename, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.filename = filename
+        self._max_attempts = max_attempts
+        # connections can not be shared by threads
+        self._local = threading.local()
+        db = self._db
+        db.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            db.execute(statement)
+
+    def __repr__(self):
+        return '<{cls}(filename={f!r})>'.format(
+            cls=self.__class__.__name__,
+            f=self.filename,
+        )
+
+    def __getstate__(self):
+        return (self.filename, self._max_attempts)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @property
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.filename, timeout=60,
+                                 isolation_level=None)
+            self._local.db = db
+        return db
+
+    def _transaction(self, function, *args):
+        db = self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            result = function(db, *args)
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return result
+
+    def publish(self, messages):
+        self._transaction(lambda db: db.executemany(
+            'INSERT INTO messages (id, payload) VALUES (?, ?)', messages))
+
+    def _fetch(self, db, worker, count, visibility_timeout):
+        now = time.time()
+        # leases expired too many times are failed
+        failed = db.execute(
+            'SELECT id, attempts FROM messages WHERE deadline < ? AND '
+            'attempts >= ?', (now, self._max_attempts)).fetchall()
+        db.executemany(
+            'INSERT INTO records (message_id, kind, payload) VALUES (?, ?, ?)',
+            [(message_id, ERROR, 'Delivered {n} times without an '
+              'acknowledgement'.format(n=attempts))
+             for (message_id, attempts) in failed])
+        db.executemany('DELETE FROM messages WHERE id = ?',
+                       [(message_id, ) for (message_id, _) in failed])
+        # messages never fetched have no deadline
+        messages = db.execute(
+            'SELECT id, payload FROM messages WHERE deadline IS NULL OR '
+            'deadline < ? ORDER BY seq LIMIT ?', (now, count)).fetchall()
+        db.executemany(
+            'UPDATE messages SET worker = ?, deadline = ?, '
+            'attempts = attempts + 1 WHERE id = ?',
+            [(worker, now + visibility_timeout, message_id)
+             for (message_id, _) in messages])
+        return messages
+
+    def fetch(self, worker, count, visibility_timeout):
+        return self._transaction(self._fetch, worker, count,
+                                 visibility_timeout)
+
+    def extend(self, message_ids, worker, visibility_timeout):
+        deadline = time.time() + visibility_timeout
+        self._transaction(lambda db: db.executemany(
+            'UPDATE messages SET deadline = ? WHERE id = ? AND worker = ?',
+            [(deadline, message_id, worker) for message_id in message_ids]))
+
+    def _ack(self, db, message_id, worker, kind, payload):
+        deleted = db.execute(
+            'DELETE FROM messages WHERE id = ? AND worker = ?',
+            (message_id, worker)).rowcount
+        if deleted:
+            db.execute('INSERT INTO records (message_id, kind, payload) '
+                       'VALUES (?, ?, ?)', (message_id, kind, payload))
+        return bool(deleted)
+
+    def ack(self, message_id, worker, kind, payload):
+        return self._transaction(self._ack, message_id, worker, kind, payload)
+
+    def stream(self, message_id, worker, payload):
+        return bool(self._transaction(lambda db: db.execute(
+            'INSERT INTO records (message_id, kind, payload) '
+            'SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM messages WHERE '
+            'id = ? AND worker = ?)',
+            (message_id, STREAM, payload, message_id, worker)).rowcount))
+
+    def _take(self, db, kinds):
+        marks = ', '.join('?' * len(kinds))
+        records = db.execute(
+            'SELECT seq, message_id, kind, payload FROM records WHERE kind IN '
+            '({m}) ORDER BY seq'.format(m=marks), tuple(kinds)).fetchall()
+        if records:
+            db.execute(
+                'DELETE FROM records WHERE kind IN ({m}) AND seq <= ?'.format(
+                    m=marks), tuple(kinds) + (records[-1][0], ))
+        return [Record(*record[1:]) for record in records]
+
+    def take(self, kinds):
+        return self._transaction(self._take, kinds)
+
+    def _purge(self, db):
+        purged = [message_id for (message_id, ) in db.execute(
+            'SELECT id FROM messages WHERE deadline IS NULL')]
+        db.execute('DELETE FROM messages WHERE deadline IS NULL')
+        return purged
+
+    def purge(self):
+        return self._transaction(self._purge)
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+
+def open_broker(url, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    '''
+    Open a broker from its URL: 'memory://' for an in-process broker (see
+    `MemoryBroker`), or 'sqlite://' followed by the path of the database (see
+    `SQLiteBroker`)
+    '''
+    scheme, _, location = url.partition('://')
+    if scheme == 'memory':
+        return MemoryBroker(max_attempts)
+    if scheme == 'sqlite' and location:
+        return SQLiteBroker(location, max_attempts)
+    raise Exception('Unsupported broker URL {u!r}'.format(u=url))
+
+
+def encode_message(tasks):
+    '''
+    Return the payload of a message running a list of tasks. Workers get task
+    descriptors (see `BaseTask.to_dict`), not pickled tasks.
+    '''
+    return json.dumps([task.to_dict() for task in tasks])
+
+
+# the worker running in the current thread, used to route the follow-up tasks
+# streamed by the running tasks (see `basetask.set_emitter`)
+_current = threading.local()
+
+
+def _emit(batch):
+    worker, message_id = _current.message
+    if not worker.broker.stream(message_id, worker.id, json.dumps(batch)):
+        logger.warning('Lease of message {m} lost, its follow-up tasks are '
+                       'ignored'.format(m=message_id))
+
+
+class Worker:
+    '''
+    Worker pulling task descriptors from a broker.
+
+    Up to `prefetch` messages are fetched at once, and each one is
+    acknowledged with its result as soon as its tasks are done, so that a
+    message is never lost if the worker dies: its lease expires and it is
+    delivered to another worker. The leases of the prefetched messages are
+    extended by a heartbeat thread while they wait or run.
+    '''
+
+    def __init__(self, broker, investigation_config=None,
+                 prefetch=DEFAULT_PREFETCH,
+                 visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT,
+                 poll_interval=DEFAULT_POLL_INTERVAL, worker_id=None):
+        self.broker = broker
+        self._config = investigation_config
+        self._prefetch = prefetch
+        self._visibility_timeout = visibility_timeout
+        self._poll_interval = poll_interval
+        self.id = worker_id or '{h}-{p}-{u}'.format(
+            h=os.uname()[1], p=os.getpid(), u=uuid.uuid4().hex[:8])
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.processed = 0
+
+    def __repr__(self):
+        return '<{cls}(id={i!r}, processed={p})>'.format(
+            cls=self.__class__.__name__,
+            i=self.id,
+            p=self.processed,
+        )
+
+    def _heartbeat(self):
+        while not self._stop.wait(self._visibility_timeout / 3):
+            with self._lock:
+                held = list(self._held)
+            if held:
+                self.broker.extend(held, self.id, self._visibility_timeout)
+
+    def run_message(self, message_id, payload):
+        '''
+        Run the tasks of a message and acknowledge it with their results
+        '''
+        _current.message = (self, message_id)
+        try:
+            tasks = [basetask.BaseTask.from_dict(taskdict, self._config)
+                     for taskdict in json.loads(payload)]
+            completed = [task.start().to_dict() for task in tasks]
+            kind, result = RESULT, json.dumps(completed)
+        except Exception as exc:
+            logger.exception(exc)
+            kind, result = ERROR, repr(exc)
+        finally:
+            _current.message = None
+        if not self.broker.ack(message_id, self.id, kind, result):
+            logger.warning('Lease of message {m} lost, its result is '
+                           'ignored'.format(m=message_id))
+        self.processed += 1
+
+    def run(self):
+        '''
+        Process messages until `stop` is called
+        '''
+        if self._config is not None:
+            config.register(self._config)
+        basetask.set_emitter(_emit)
+        heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        heartbeat.start()
+        logger.info('Worker {w} started'.format(w=self.id))
+        try:
+            while not self._stop.is_set():
+                messages = self.broker.fetch(self.id, self._prefetch,
+                                             self._visibility_timeout)
+                if not messages:
+                    self._stop.wait(self._poll_interval)
+                    continue
+                with self._lock:
+                    self._held.update(m for (m, _) in messages)
+                for (message_id, payload) in messages:
+                    self.run_message(message_id, payload)
+                    with self._lock:
+                        self._held.discard(message_id)
+        finally:
+            self._stop.set()
+            # tasks of the other workers of this process still running keep
+            # their follow-up tasks, and return them with their result
+            basetask.set_emitter(None)
+            heartbeat.join()
+            self.broker.close()
+        logger.info('Worker {w} stopped'.format(w=self.id))
+
+    def stop(self):
+        '''
+        Stop after the messages already fetched
+        '''
+        self._stop.set()
+
+
+def run_worker(url, investigation_config, **options):
+    '''
+    Entry point of the worker processes (see `Worker`)
+    '''
+    worker = Worker(open_broker(url), investigation_config, **options)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m forework.broker',
+        description='Run a worker pulling tasks from a broker')
+    parser.add_argument('-c', '--config', required=True,
+                        help='Configuration file for the investigation (YAML)')
+    parser.add_argument('-b', '--broker',
+                        help='Broker URL (default: the `url` of the broker '
+                             'backend in the configuration)')
+    parser.add_argument('-p', '--prefetch', type=int,
+                        default=DEFAULT_PREFETCH,
+                        help='Number of messages fetched at once')
+    args = parser.parse_args(args)
+    investigation_config = config.ForeworkConfig(args.config)
+    url = args.broker or investigation_config.backend.get('url')
+    if url is None:
+        raise SystemExit('No broker URL configured')
+    run_worker(url, investigation_config, prefetch=args.prefetch)
+
+
+if __name__ == '__main__':
+    main()
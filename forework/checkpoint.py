@@ -0,0 +1,97 @@
+import os
+import json
+
+from . import utils
+from .basetask import BaseTask, now
+
+
+logger = utils.get_logger(__name__)
+
+CHECKPOINT_VERSION = 1
+DEFAULT_CHECKPOINT_FILE = 'forework.checkpoint'
+# seconds between two checkpoints
+DEFAULT_INTERVAL = 60
+
+
+class Checkpoint:
+    '''
+    Snapshot of the state of an investigation, used to resume it after the
+    scheduler stopped.
+
+    A checkpoint holds the tasks still to run (queued, and submitted but not
+    completed), as dicts (see `BaseTask.to_dict`), and the keys of the
+    completed tasks (see `BaseTask.key`). If the finished tasks are not written
+    to a results store, their dicts are saved too.
+    '''
+
+    def __init__(self, pending=None, finished_keys=None, finished_tasks=None,
+                 start_time=None, created=None):
+        self.pending = pending or []
+        self.finished_keys = finished_keys or set()
+        self.finished_tasks = finished_tasks
+        self.start_time = start_time
+        self.created = created
+
+    def __repr__(self):
+        return '<{c}(created={t!r}, pending={p}, finished={f})>'.format(
+            c=self.__class__.__name__,
+            t=self.created,
+            p=len(self.pending),
+            f=len(self.finished_keys),
+        )
+
+    def save(self, filename):
+        '''
+        Write the checkpoint to a file. The previous checkpoint is replaced
+        atomically, so it is never lost if the process dies while writing.
+        '''
+        data = {
+            'version': CHECKPOINT_VERSION,
+            'created': now(),
+            'start_time': self.start_time,
+            'pending': self.pending,
+            'finished_keys': sorted(self.finished_keys, key=str),
+            'finished_tasks': self.finished_tasks,
+        }
+        tmpfile = filename + '.tmp'
+        with open(tmpfile, 'w') as fd:
+            json.dump(data, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmpfile, filename)
+        logger.info('Checkpoint saved to {f!r}: {p} pending and {n} finished '
+                    'tasks'.format(f=filename, p=len(self.pending),
+                                   n=len(self.finished_keys)))
+        return filename
+
+    @staticmethod
+    def load(filename):
+        '''
+        Read a checkpoint saved with `save`
+        '''
+        with open(filename) as fd:
+            data = json.load(fd)
+        if data.get('version') != CHECKPOINT_VERSION:
+            raise Exception('Unsupported checkpoint version {v!r} in '
+                            '{f!r}'.format(v=data.get('version'), f=filename))
+        return Checkpoint(
+            pending=data['pending'],
+            finished_keys={tuple(key) for key in data['finished_keys']},
+            finished_tasks=data.get('finished_tasks'),
+            start_time=data.get('start_time'),
+            created=data.get('created'),
+        )
+
+    def pending_tasks(self, config=None):
+        '''
+        Rebuild the tasks still to run
+        '''
+        return [BaseTask.from_dict(taskdict, config)
+                for taskdict in self.pending]
+
+    def completed_tasks(self, config=None):
+        '''
+        Rebuild the completed tasks, if they were saved in the checkpoint
+        '''
+        return [BaseTask.from_dict(taskdict, config)
+                for taskdict in self.finished_tasks or []]
@@ -1,11 +1,25 @@
 import os
+import uuid
 import yaml
 import logging
 
-REQUIRED_PYTHON_VERSION = (3, 4)
+REQUIRED_PYTHON_VERSION = (3, 7)
 # If true, tasks are cached - all subsequent calls to `basetask.find_tasks` will
 # use cached results, and will not discover newly added plugins unless restarted
 ENABLE_TASKS_CACHE = True
+# Number of distinct file types whose handling tasks are memoized by the
+# dispatch index (see `basetask.DispatchIndex`)
+DISPATCH_CACHE_SIZE = 4096
+# Number of bytes read from the beginning of a file to identify its type
+FILE_TYPE_HEADER_SIZE = 65536
+# Number of file types, and of file headers, memoized by `utils.get_file_type`
+FILE_TYPE_CACHE_SIZE = 65536
+HEADER_CACHE_SIZE = 128
+# Size of the chunks read when hashing files
+HASH_CHUNK_SIZE = 1024 * 1024
+# Objects read from a source (e.g. archive members, see `sources`) are kept in
+# memory up to this size, and spooled to a temporary file beyond it
+SPOOL_SIZE = 16 * 1024 * 1024
 
 src_dir = os.path.dirname(__file__)
 tasks_dir = os.path.join(src_dir, 'tasks')
@@ -27,6 +41,33 @@ def yaml_join(loader, node):
 
 yaml.add_constructor('!join', yaml_join)
 
+# configurations known in this process, by ID (see `ForeworkConfig.id`)
+_configs = {}
+
+
+def register(config):
+    '''
+    Register a configuration in this process, so that tasks can refer to it by
+    ID, and return the ID. Workers must register the configurations of the
+    tasks they run.
+    '''
+    _configs[config.id] = config
+    return config.id
+
+
+def get_config(config_id):
+    '''
+    Return a configuration registered with `register`, or None if `config_id`
+    is None
+    '''
+    if config_id is None:
+        return None
+    try:
+        return _configs[config_id]
+    except KeyError:
+        raise Exception('Configuration {c!r} is not registered in this '
+                        'process'.format(c=config_id))
+
 
 class ForeworkConfig:
     '''
@@ -36,14 +77,24 @@ class ForeworkConfig:
     --- # Example investigation
     - investigation: Example investigation
       entrypoint: /path/to/image_or_directory_to_analyze
+      priority: [JpegFile]
+      aging_rate: 1
+      max_in_flight: 256
+      backend: { name: local, workers: 4 }
+      dedup: { tasks: [PDFFile, JpegFile, ZipFile], algorithm: sha256 }
+      known_hashes: { index: nsrl.idx, action: drop }
+      results: { store: results.sqlite, batch_size: 1000 }
+      checkpoint: { path: inv001.checkpoint, interval: 60 }
+      metrics: { prometheus: forework.prom, interval: 15 }
+      profiling: { rate: 0.01, output: profiles }
       tasks:
         PDFFile: [extract_pictures]
-        TextFile: { grep: '^some pattern$' }
+        TextFile: { grep: '^some pattern$', keywords: keywords.txt }
     '''
 
     def __init__(self, config_file):
         with open(config_file) as fd:
-            config = yaml.load(fd)
+            config = yaml.load(fd, Loader=yaml.Loader)
         if len(config) == 0:
             raise Exception('No configuration found in {c!r}'.format(
                 c=config_file
@@ -53,6 +104,9 @@ class ForeworkConfig:
                   'first')
         self._config = config[0]
         self._config_file = config_file
+        # unique ID, used by the tasks to refer to this configuration
+        self.id = uuid.uuid4().hex
+        register(self)
 
     def __repr__(self):
         return '''ForeworkConfig:
@@ -105,3 +159,124 @@ class ForeworkConfig:
         Return the list of tasks to prioritize
         '''
         return self._config.get('priority', [])
+
+    @property
+    def backend(self):
+        '''
+        Return the execution backend settings as a dictionary. The `name` key
+        selects the backend (see `scheduler.BACKENDS`), the others are
+        backend-specific options. Defaults to the ipyparallel backend.
+        '''
+        backend = self._config.get('backend') or {}
+        if isinstance(backend, str):
+            backend = {'name': backend}
+        return backend
+
+    @property
+    def dedup(self):
+        '''
+        Return the content deduplication settings as a dictionary, or None if
+        deduplication is disabled (see `dedup.Deduplicator`). `dedup: true`
+        enables it with the default settings.
+        '''
+        dedup = self._config.get('dedup')
+        if not dedup:
+            return None
+        if dedup is True:
+            return {}
+        return dedup
+
+    @property
+    def known_hashes(self):
+        '''
+        Return the known-file filter settings as a dictionary, or None if it is
+        disabled (see `knownhashes.KnownFileFilter`). The `index` key is the
+        known-hash index file (see `knownhashes.build_index`).
+        `known_hashes: some_file` is accepted as a shortcut.
+        '''
+        known_hashes = self._config.get('known_hashes')
+        if not known_hashes:
+            return None
+        if isinstance(known_hashes, str):
+            known_hashes = {'index': known_hashes}
+        return known_hashes
+
+    @property
+    def results(self):
+        '''
+        Return the results store settings as a dictionary, or None if the
+        results are only kept in memory. The `store` key is the file where the
+        finished tasks are written as they complete (see
+        `results.open_sink`). `results: some_file` is accepted as a shortcut.
+        '''
+        results = self._config.get('results')
+        if not results:
+            return None
+        if isinstance(results, str):
+            results = {'store': results}
+        return results
+
+    @property
+    def checkpoint(self):
+        '''
+        Return the checkpoint settings as a dictionary with the `path` of the
+        checkpoint file and the `interval` in seconds between checkpoints, or
+        None if checkpointing is disabled. `checkpoint: some_file` is accepted
+        as a shortcut.
+        '''
+        checkpoint = self._config.get('checkpoint')
+        if not checkpoint:
+            return None
+        if checkpoint is True:
+            return {}
+        if isinstance(checkpoint, str):
+            checkpoint = {'path': checkpoint}
+        return checkpoint
+
+    @property
+    def metrics(self):
+        '''
+        Return the metrics export settings as a dictionary with the
+        `prometheus` file where the scheduler metrics are written in the
+        Prometheus text format, and the `interval` in seconds between writes,
+        or None if they are not exported (see `metrics.SchedulerMetrics`).
+        `metrics: some_file` is accepted as a shortcut.
+        '''
+        metrics = self._config.get('metrics')
+        if not metrics:
+            return None
+        if isinstance(metrics, str):
+            metrics = {'prometheus': metrics}
+        return metrics
+
+    @property
+    def profiling(self):
+        '''
+        Return the profiling settings as a dictionary, or None if profiling is
+        disabled (see `profiling`). The `rate` key is the fraction of the task
+        runs profiled, `tasks` restricts profiling to some task classes, and
+        `output` is the directory where the merged profiles are written at the
+        end of the run. `profiling: true` enables it with the default settings.
+        '''
+        profiling = self._config.get('profiling')
+        if not profiling:
+            return None
+        if profiling is True:
+            return {}
+        return profiling
+
+    @property
+    def aging_rate(self):
+        '''
+        Return how much queued tasks gain in priority for every second spent in
+        the queue, or None if not defined (see `task_queue.PriorityTaskQueue`)
+        '''
+        return self._config.get('aging_rate')
+
+    @property
+    def max_in_flight(self):
+        '''
+        Return the maximum number of tasks submitted for execution at any time,
+        or None if not defined
+        '''
+        return self._config.get('max_in_flight')
@@ -0,0 +1,183 @@
+import os
+import collections
+import concurrent.futures
+
+from . import utils
+
+
+logger = utils.get_logger(__name__)
+
+
+class Deduplicator:
+    '''
+    Content deduplication stage of the scheduler.
+
+    Before a task is dispatched, the content of its file is hashed in a pool of
+    background threads. The first task seen with a given hash is dispatched as
+    usual, and later tasks with the same name and hash are not run: they get
+    the result of the first one linked to them instead (see `link`). Only the
+    result and path of the originals are kept for that, not the tasks.
+
+    Supported settings:
+        tasks: names of the tasks to deduplicate (default: DEFAULT_TASKS)
+        algorithm: hashlib algorithm used for the content hash
+        workers: number of hashing threads
+    '''
+
+    DEFAULT_TASKS = ['PDFFile', 'JpegFile', 'ZipFile']
+    DEFAULT_ALGORITHM = 'sha256'
+    DEFAULT_WORKERS = 4
+
+    def __init__(self, tasks=None, algorithm=DEFAULT_ALGORITHM,
+                 workers=DEFAULT_WORKERS):
+        self._task_names = set(tasks or self.DEFAULT_TASKS)
+        self._algorithm = algorithm
+        self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+        # (task name, hash) -> (result, path) of the completed original, or
+        # None while in progress
+        self._originals = {}
+        # (task name, hash) -> duplicates waiting for the original to complete
+        self._waiting = collections.defaultdict(list)
+        # duplicates linked to a completed original, see `take_linked`
+        self._linked = []
+        # tasks being hashed
+        self._hashing = set()
+        self.hashed = 0
+        self.duplicates = 0
+
+    def __repr__(self):
+        return '<{cls}(tasks={t!r}, hashed={h}, duplicates={d})>'.format(
+            cls=self.__class__.__name__,
+            t=sorted(self._task_names),
+            h=self.hashed,
+            d=self.duplicates,
+        )
+
+    def applies_to(self, task):
+        '''
+        Return True if the task has to be deduplicated
+        '''
+        if task._name not in self._task_names:
+            return False
+        return task._source is not None or os.path.isfile(task.path)
+
+    @property
+    def algorithm(self):
+        return self._algorithm
+
+    def hash(self, task, callback, digest=None):
+        '''
+        Compute the content hash of the task's file in the background, and call
+        `callback(task, future)` when done. The future's result is the digest.
+        If the digest is already known (e.g. computed by the known-file filter,
+        see `knownhashes.KnownFileFilter`), the file is not read again.
+        '''
+        self._hashing.add(task)
+        if digest is not None:
+            future = concurrent.futures.Future()
+            future.set_result(digest)
+            callback(task, future)
+            return
+        future = self._pool.submit(self._hash, task)
+        future.add_done_callback(lambda f: callback(task, f))
+
+    def _hash(self, task):
+        with task.open() as fd:
+            return utils.hash_fileobj(fd, (self._algorithm,))[self._algorithm]
+
+    def check(self, task, digest):
+        '''
+        Record the content hash of a task. Return True if the task has to be
+        run, False if it is a duplicate. Duplicates are either linked to their
+        original right away and returned by `take_linked`, or held until the
+        original completes (see `completed`).
+        '''
+        self._hashing.discard(task)
+        self.hashed += 1
+        task._content_hash = digest
+        task._hash_algorithm = self._algorithm
+        key = (task._name, digest)
+        if key not in self._originals:
+            self._originals[key] = None
+            return True
+        self.duplicates += 1
+        self._waiting[key].append(task)
+        original = self._originals[key]
+        if original is not None:
+            self._linked.extend(self._link_waiting(key, original))
+        return False
+
+    def hash_failed(self, task):
+        '''
+        Record that a content hash could not be computed. The task is run
+        without deduplication.
+        '''
+        self._hashing.discard(task)
+
+    @property
+    def hashing(self):
+        '''
+        Return the number of tasks being hashed
+        '''
+        return len(self._hashing)
+
+    def pending_tasks(self):
+        '''
+        Return the tasks held by the deduplication stage, i.e. those being
+        hashed and the duplicates waiting for their original to complete
+        '''
+        tasks = list(self._hashing)
+        for duplicates in self._waiting.values():
+            tasks.extend(duplicates)
+        return tasks
+
+    def take_linked(self):
+        '''
+        Return, and forget, the duplicates linked since the last call
+        '''
+        linked, self._linked = self._linked, []
+        return linked
+
+    def _link_waiting(self, key, original):
+        duplicates = self._waiting.pop(key, [])
+        for duplicate in duplicates:
+            self.link(duplicate, *original)
+        return duplicates
+
+    def completed(self, task, result):
+        '''
+        Record the completion of a task, with `result` being the completed task
+        or None if it failed. Return the list of duplicates linked to it if it
+        succeeded. If it failed, return the first duplicate, if any, which has
+        to be run in its place.
+        '''
+        digest = task._content_hash
+        if digest is None:
+            return []
+        key = (task._name, digest)
+        if key not in self._originals or self._originals[key] is not None:
+            return []
+        if result is not None:
+            original = self._originals[key] = (result._result, result.path)
+            return self._link_waiting(key, original)
+        # the original failed: the first duplicate becomes the original
+        duplicates = self._waiting.get(key)
+        if not duplicates:
+            del self._originals[key]
+            return []
+        self.duplicates -= 1
+        return [duplicates.pop(0)]
+
+    @staticmethod
+    def link(duplicate, result, original_path):
+        '''
+        Mark a duplicate task as completed, with the result of the original
+        found at `original_path`
+        '''
+        duplicate.done = False
+        duplicate._result = result
+        duplicate._duplicate_of = original_path
+        duplicate.done = True
+
+    def stop(self):
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import argparse
+import xml.sax.saxutils
+import xml.etree.ElementTree
+
+from . import utils, sources
+from .basetask import BaseTask, find_tasks_by_filetype
+
+
+logger = utils.get_logger(__name__)
+
+DFXML_NAMESPACE = 'http://www.forensicswiki.org/wiki/Category:Digital_Forensics_XML'
+DC_NAMESPACE = 'http://purl.org/dc/elements/1.1/'
+# namespace of the task elements added to the file objects
+FOREWORK_NAMESPACE = 'https://github.com/insomniacslk/forework'
+DFXML_EXTENSIONS = ('.xml', '.dfxml')
+# hashlib algorithm of the content hashes of the tasks that do not record it
+# (see `dedup.Deduplicator`)
+DEFAULT_HASH_TYPE = 'sha256'
+# how often the importer reports the number of file objects read
+IMPORT_LOG_INTERVAL = 100000
+
+
+class DFXMLWriter:
+    '''
+    Streaming DFXML writer. Every finished task is written as a fileobject
+    as soon as it is passed to `write`, with the file's name, size, type,
+    location (byte runs or inode) and content hash, plus the task's name and
+    result in the forework namespace. Nothing is kept in memory between two
+    tasks. `hash_type` is the algorithm of the content hashes of the tasks
+    that do not record theirs.
+    '''
+
+    def __init__(self, fd, image_filename=None, hash_type=DEFAULT_HASH_TYPE):
+        self._fd = fd
+        self._hash_type = hash_type
+        self._xml = xml.sax.saxutils.XMLGenerator(
+            fd, 'utf-8', short_empty_elements=True)
+        self.count = 0
+        self._xml.startDocument()
+        self._start('dfxml', {
+            'xmloutputversion': '1.0',
+            'xmlns': DFXML_NAMESPACE,
+            'xmlns:dc': DC_NAMESPACE,
+            'xmlns:fw': FOREWORK_NAMESPACE,
+        })
+        self._newline()
+        self._start('metadata')
+        self._element('dc:type', 'Forework results')
+        self._end('metadata')
+        self._newline()
+        self._start('creator', {'version': '1.0'})
+        self._element('program', 'forework')
+        self._element('command_line', ' '.join(sys.argv))
+        self._end('creator')
+        self._newline()
+        if image_filename:
+            self._start('source')
+            self._element('image_filename', image_filename)
+            self._end('source')
+            self._newline()
+
+    def _start(self, name, attrs=None):
+        self._xml.startElement(name, {
+            key: str(value) for (key, value) in (attrs or {}).items()
+        })
+
+    def _end(self, name):
+        self._xml.endElement(name)
+
+    def _element(self, name, text, attrs=None):
+        self._start(name, attrs)
+        self._xml.characters(str(text))
+        self._end(name)
+
+    def _newline(self):
+        self._xml.ignorableWhitespace('\n')
+
+    def write(self, task):
+        '''
+        Write a task, given as a BaseTask or as a dict (see `BaseTask.to_dict`)
+        '''
+        if not isinstance(task, dict):
+            task = task.to_dict()
+        source = task.get('source') or {}
+        size = task.get('size')
+        if size is None:
+            size = source.get('size')
+        self._start('fileobject')
+        self._element('filename', task['path'])
+        if size is not None:
+            self._element('filesize', size)
+        if source.get('type') == 'tsk':
+            self._element('inode', source['inode'])
+        if task.get('filetype') is not None:
+            self._element('libmagic', task['filetype'])
+        if task.get('content_hash') is not None:
+            self._element('hashdigest', task['content_hash'], {
+                'type': task.get('hash_algorithm') or self._hash_type})
+        if source.get('type') in ('slice', 'runs') and \
+                source.get('parent') is None:
+            self._write_byte_runs(source)
+        attrs = {'name': task['name']}
+        for key in ('start', 'end', 'duplicate_of'):
+            if task.get(key) is not None:
+                attrs[key] = task[key]
+        self._start('fw:task', attrs)
+        if source:
+            self._element('fw:source', json.dumps(source))
+        if task.get('result') is not None:
+            self._element('fw:result', json.dumps(task['result']))
+        for warning in task.get('warnings') or ():
+            self._element('fw:warning', warning)
+        self._end('fw:task')
+        self._end('fileobject')
+        self._newline()
+        self.count += 1
+
+    def _write_byte_runs(self, source):
+        if source['type'] == 'slice':
+            runs = [(source['offset'], source['size'])]
+        else:
+            runs = source['runs']
+        self._start('byte_runs')
+        file_offset = 0
+        for (offset, length) in runs:
+            attrs = {'file_offset': file_offset, 'len': length}
+            if offset is None:
+                attrs['fill'] = 0
+            else:
+                attrs['img_offset'] = offset
+            self._start('byte_run', attrs)
+            self._end('byte_run')
+            file_offset += length
+        self._end('byte_runs')
+
+    def close(self):
+        self._end('dfxml')
+        self._newline()
+        self._xml.endDocument()
+        self._fd.flush()
+
+
+def export(tasks, filename, image_filename=None,
+           hash_type=DEFAULT_HASH_TYPE):
+    '''
+    Write tasks to a DFXML file, streaming them one by one. `tasks` is any
+    iterable of BaseTask objects or task dicts, e.g. `Scheduler.results` or a
+    results store opened with `results.Results.open`. Return the number of
+    file objects written.
+    '''
+    with open(filename, 'w', encoding='utf-8',
+              errors='xmlcharrefreplace') as fd:
+        writer = DFXMLWriter(fd, image_filename, hash_type)
+        for task in tasks:
+            writer.write(task)
+        writer.close()
+    logger.info('Exported {n} tasks to {f!r}'.format(
+        n=writer.count,
+        f=filename,
+    ))
+    return writer.count
+
+
+def _local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def _tags(name):
+    # tags of a DFXML element, with or without namespace
+    return {name, '{{{ns}}}{n}'.format(ns=DFXML_NAMESPACE, n=name)}
+
+
+def _parse_fileobject(element, volume_offset):
+    fileobject = {
+        'filename': None,
+        'filesize': None,
+        'name_type': None,
+        'alloc': True,
+        'inode': None,
+        'libmagic': None,
+        'hashes': {},
+        'byte_runs': [],
+        'source': None,
+    }
+    for child in element:
+        name = _local_name(child.tag)
+        if child.tag == '{{{ns}}}task'.format(ns=FOREWORK_NAMESPACE):
+            source = child.find('{{{ns}}}source'.format(
+                ns=FOREWORK_NAMESPACE))
+            if source is not None:
+                fileobject['source'] = json.loads(source.text)
+        elif name in ('filename', 'name_type', 'libmagic'):
+            fileobject[name] = child.text
+        elif name in ('filesize', 'inode'):
+            fileobject[name] = int(child.text)
+        elif name in ('alloc', 'unalloc'):
+            alloc = child.text is None or child.text.strip() == '1'
+            fileobject['alloc'] = alloc if name == 'alloc' else not alloc
+        elif name == 'hashdigest':
+            fileobject['hashes'][child.get('type', '').lower()] = child.text
+        elif name == 'byte_runs':
+            for run in child:
+                if _local_name(run.tag) != 'byte_run':
+                    continue
+                length = int(run.get('len'))
+                if run.get('img_offset') is not None:
+                    offset = int(run.get('img_offset'))
+                elif run.get('fs_offset') is not None:
+                    offset = volume_offset + int(run.get('fs_offset'))
+                else:
+                    # sparse run
+                    offset = None
+                fileobject['byte_runs'].append((offset, length))
+    return fileobject
+
+
+def iter_fileobjects(filename):
+    '''
+    Parse a DFXML file incrementally with `iterparse`, and yield its
+    fileobjects as dicts with the keys: filename, filesize, name_type, alloc,
+    inode, libmagic, hashes (by lowercase type), byte_runs (as (image offset,
+    length) tuples, with a None offset for sparse runs) and source (the
+    source of the objects exported by forework, see `sources`). The elements
+    are discarded once read, so memory use does not depend on the number of
+    file objects.
+    '''
+    # open elements, and the byte offsets of the enclosing volumes
+    stack = []
+    volume_offsets = [0]
+    volume_tags = _tags('volume')
+    fileobject_tags = _tags('fileobject')
+    events = xml.etree.ElementTree.iterparse(filename, ('start', 'end'))
+    for (event, element) in events:
+        if event == 'start':
+            stack.append(element)
+            if element.tag in volume_tags:
+                volume_offsets.append(int(element.get('offset', 0)))
+            continue
+        stack.pop()
+        if element.tag in volume_tags:
+            volume_offsets.pop()
+        elif element.tag in fileobject_tags:
+            yield _parse_fileobject(element, volume_offsets[-1])
+        else:
+            continue
+        # detach the element from its parent, so that it can be freed
+        if stack:
+            stack[-1].remove(element)
+        element.clear()
+
+
+def import_tasks(filename, config, root=None, deleted=False):
+    '''
+    Yield the tasks analyzing the regular files of a DFXML inventory, for
+    `Scheduler.enqueue_many`, so that the inventoried files are not walked and
+    identified again.
+
+    The files are found under `root` (by default the investigation entry
+    point), unless their names are absolute. If `root` is a file, it is the
+    disk image described by the inventory, and the files are read from it
+    through their byte runs (see `sources.byte_runs`). The objects exported
+    by forework are read from their original source. The task of each file
+    is selected by the file type in the inventory (`libmagic`), and files with
+    no type are identified by Raw. Unallocated files are skipped unless
+    `deleted` is true.
+    '''
+    if root is None:
+        root = config.entrypoint
+    image = os.path.isfile(root)
+    count = 0
+    skipped = 0
+    for fileobject in iter_fileobjects(filename):
+        count += 1
+        if count % IMPORT_LOG_INTERVAL == 0:
+            logger.info('Imported {n} file objects from {f!r}'.format(
+                n=count,
+                f=filename,
+            ))
+        if fileobject['filename'] is None or \
+                fileobject['name_type'] not in (None, 'r', '-') or \
+                not (fileobject['alloc'] or deleted):
+            skipped += 1
+            continue
+        path = fileobject['filename']
+        source = fileobject['source']
+        if source is None and image:
+            if not fileobject['byte_runs']:
+                skipped += 1
+                continue
+            source = sources.byte_runs(root, fileobject['byte_runs'])
+            path = '{r}/{p}'.format(r=root, p=path.lstrip('/'))
+        elif source is None:
+            path = os.path.join(root, path)
+        filetype = fileobject['libmagic']
+        if filetype is None:
+            names = ['Raw']
+        else:
+            names = find_tasks_by_filetype(filetype)
+            if len(names) < 1:
+                skipped += 1
+                continue
+        yield BaseTask.from_dict({
+            'name': names,
+            'path': path,
+            'filetype': filetype,
+            'source': source,
+            'depth': 1,
+        }, config)
+    logger.info('Imported {n} file objects from {f!r}, {s} skipped'.format(
+        n=count,
+        f=filename,
+        s=skipped,
+    ))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m forework.dfxml',
+        description='Export a results store to DFXML')
+    parser.add_argument('store', help='Results store (.jsonl or SQLite)')
+    parser.add_argument('output', help='DFXML file to write')
+    parser.add_argument('--image', help='Image file name to record')
+    args = parser.parse_args(args)
+    from .results import Results
+    count = export(Results.open(args.store), args.output, args.image)
+    print('{n} file objects written to {o}'.format(n=count, o=args.output))
+
+
+if __name__ == '__main__':
+    main()
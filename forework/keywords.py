@@ -0,0 +1,177 @@
+import re
+import collections
+import functools
+
+from . import utils
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+logger = utils.get_logger(__name__)
+
+DEFAULT_ENCODING = 'utf-8'
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# Maximum number of offsets reported per keyword and file, None for no limit
+DEFAULT_MAX_HITS = 100
+
+
+class KeywordAutomaton:
+    '''
+    Matcher finding all the occurrences of a set of keywords in a single pass
+    over the data.
+
+    Keywords are matched as bytes in the given encoding, ignoring the ASCII
+    case unless `case_sensitive` is True. Keywords only differing by their case
+    are then reported under the first one. The `pyahocorasick` module is used
+    if available, and otherwise a regular expression matching any of the
+    keywords, so that the data is still scanned by compiled code.
+    '''
+
+    def __init__(self, keywords, case_sensitive=False,
+                 encoding=DEFAULT_ENCODING, native=None):
+        self.case_sensitive = case_sensitive
+        # encoded pattern -> keyword reported for it
+        self._patterns = {}
+        for keyword in keywords:
+            pattern = keyword.encode(encoding)
+            if not case_sensitive:
+                pattern = pattern.lower()
+            if pattern:
+                self._patterns.setdefault(pattern, keyword)
+        self._max_length = max(map(len, self._patterns), default=0)
+        if native is None:
+            native = ahocorasick is not None
+        self.native = native
+        if native:
+            self._build_native()
+        else:
+            self._build()
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def __repr__(self):
+        return '<{cls}(keywords={n}, native={native})>'.format(
+            cls=self.__class__.__name__,
+            n=len(self),
+            native=self.native,
+        )
+
+    def _build(self):
+        # a single regular expression finds the next offset where a keyword
+        # starts, and the keywords starting there are told apart by their
+        # first byte. The search resumes right after that offset, so that
+        # overlapping occurrences are found
+        self._rx = re.compile(b'|'.join(
+            re.escape(pattern)
+            for pattern in sorted(self._patterns, key=len, reverse=True)
+        ))
+        self._by_first_byte = collections.defaultdict(list)
+        for (pattern, keyword) in self._patterns.items():
+            self._by_first_byte[pattern[0]].append((pattern, keyword))
+
+    def _build_native(self):
+        automaton = ahocorasick.Automaton()
+        for (pattern, keyword) in self._patterns.items():
+            # latin-1 maps each byte to one character
+            automaton.add_word(pattern.decode('latin-1'),
+                               (len(pattern), keyword))
+        if self._patterns:
+            automaton.make_automaton()
+        self._automaton = automaton
+
+    def _finditer(self, chunks):
+        # as for `_finditer_native`, the end of each chunk is searched again
+        # with the next one
+        rx, by_first_byte = self._rx, self._by_first_byte
+        tail = b''
+        offset = 0
+        for chunk in chunks:
+            data = tail + chunk
+            match = rx.search(data)
+            while match is not None:
+                start = match.start()
+                for (pattern, keyword) in by_first_byte[data[start]]:
+                    end = start + len(pattern)
+                    if end > len(tail) and data.startswith(pattern, start):
+                        yield (offset + start, offset + end, keyword)
+                match = rx.search(data, start + 1)
+            keep = min(len(data), self._max_length - 1)
+            tail = data[len(data) - keep:] if keep else b''
+            offset += len(data) - keep
+
+    def _finditer_native(self, chunks):
+        # the automaton does not keep its state between two chunks, so the
+        # end of each chunk is searched again with the next one
+        tail = ''
+        offset = 0
+        for chunk in chunks:
+            data = tail + chunk.decode('latin-1')
+            for (last, (length, keyword)) in self._automaton.iter(data):
+                if last >= len(tail):
+                    end = offset + last + 1
+                    yield (end - length, end, keyword)
+            keep = min(len(data), self._max_length - 1)
+            tail = data[len(data) - keep:] if keep else ''
+            offset += len(data) - keep
+
+    def finditer(self, chunks):
+        '''
+        Find the keywords in an iterable of consecutive chunks of bytes,
+        yielding (start, end, keyword) tuples for all the occurrences,
+        overlapping ones included
+        '''
+        if not self._patterns:
+            return iter(())
+        if not self.case_sensitive:
+            chunks = (chunk.lower() for chunk in chunks)
+        if self.native:
+            return self._finditer_native(chunks)
+        return self._finditer(chunks)
+
+    def scan(self, fd, max_hits=DEFAULT_MAX_HITS,
+             chunk_size=DEFAULT_CHUNK_SIZE):
+        '''
+        Find the keywords in a binary file object, read in chunks. Return a
+        dict of the keywords found, with the list of their start offsets (up
+        to `max_hits` per keyword), and whether some offsets were left out.
+        '''
+        hits = {}
+        truncated = False
+        chunks = iter(functools.partial(fd.read, chunk_size), b'')
+        for (start, end, keyword) in self.finditer(chunks):
+            offsets = hits.setdefault(keyword, [])
+            if max_hits is not None and len(offsets) >= max_hits:
+                truncated = True
+                continue
+            offsets.append(start)
+        return hits, truncated
+
+
+def read_keywords(filename):
+    '''
+    Read a keyword list, with one keyword per line. Empty lines and lines
+    starting with # are ignored.
+    '''
+    with open(filename, encoding='utf-8') as fd:
+        return tuple(
+            line.strip() for line in fd
+            if line.strip() and not line.startswith('#')
+        )
+
+
+@functools.lru_cache(maxsize=8)
+def get_automaton(keywords, case_sensitive=False, encoding=DEFAULT_ENCODING):
+    '''
+    Return the automaton for a tuple of keywords, or for the name of a keyword
+    list file. Automata are cached, so that every worker builds each of them
+    only once.
+    '''
+    if isinstance(keywords, str):
+        keywords = read_keywords(keywords)
+    automaton = KeywordAutomaton(keywords, case_sensitive, encoding)
+    logger.info('Built {a!r}'.format(a=automaton))
+    return automaton
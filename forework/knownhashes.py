@@ -0,0 +1,390 @@
+import os
+import re
+import mmap
+import struct
+import hashlib
+import argparse
+import binascii
+import tempfile
+import concurrent.futures
+
+import numpy
+
+from . import utils, basetask
+
+
+logger = utils.get_logger(__name__)
+
+MAGIC = b'FWKNOWN1'
+# magic, algorithm name, digest size, number of Bloom filter hash functions,
+# number of digests, number of bits of the Bloom filter
+HEADER = struct.Struct('<8s16sIIQQ')
+HEADER_SIZE = 64
+# The digests are sorted, and the fan-out table holds the index of the first
+# digest of every 2-byte prefix (plus the total), so that a lookup only
+# searches the digests with the same prefix
+FANOUT_SIZE = 65536 + 1
+DEFAULT_BITS_PER_ENTRY = 10
+DEFAULT_HASH_COUNT = 7
+# Size of the chunks of the hash lists parsed at once by `build_index`
+BUILD_CHUNK_SIZE = 64 * 1024 * 1024
+_MASK64 = 2 ** 64 - 1
+
+
+def _bloom_positions(h1, h2, hash_count, bits):
+    # double hashing: the i-th position is h1 + i * h2, modulo 2**64 and then
+    # modulo the number of bits. numpy.uint64 arithmetic wraps the same way
+    return [((h1 + i * h2) & _MASK64) % bits for i in range(hash_count)]
+
+
+def _bloom_add(bloom, digests, hash_count, bits):
+    '''
+    Add the digests of a numpy array of byte strings to a Bloom filter,
+    stored as a numpy array of bytes. The positions are derived from the
+    first 16 bytes of the digests, which are uniformly distributed already.
+    '''
+    if not len(digests):
+        return
+    raw = digests.view(numpy.uint8).reshape(len(digests), -1)
+    h1 = numpy.ascontiguousarray(raw[:, :8]).view('<u8').ravel()
+    h2 = numpy.ascontiguousarray(raw[:, 8:16]).view('<u8').ravel() | 1
+    for i in range(hash_count):
+        positions = (h1 + numpy.uint64(i) * h2) % numpy.uint64(bits)
+        numpy.bitwise_or.at(
+            bloom, positions >> numpy.uint64(3),
+            (1 << (positions & numpy.uint64(7))).astype(numpy.uint8))
+
+
+def _parse_digests(fd, digest_size):
+    '''
+    Yield numpy arrays of the binary digests found in a hash list: every
+    hexadecimal string of the right length is a digest, so that both plain
+    lists and CSV files (e.g. NSRL) are accepted
+    '''
+    regex = re.compile(
+        b'(?<![0-9a-fA-F])[0-9a-fA-F]{%d}(?![0-9a-fA-F])' % (digest_size * 2))
+    while True:
+        chunk = fd.read(BUILD_CHUNK_SIZE)
+        if not chunk:
+            return
+        # end the chunk at a line boundary
+        chunk += fd.readline()
+        found = regex.findall(chunk)
+        if found:
+            yield numpy.frombuffer(binascii.unhexlify(b''.join(found)),
+                                   dtype='S{n}'.format(n=digest_size))
+
+
+def build_index(hash_lists, output, algorithm='sha1',
+                bits_per_entry=DEFAULT_BITS_PER_ENTRY,
+                hash_count=DEFAULT_HASH_COUNT):
+    '''
+    Build a known-hash index (see `KnownHashes`) from hash lists, given as
+    file names, with the hex digests of the `algorithm` hashlib algorithm.
+    Return the number of distinct digests.
+
+    The index is built in two passes with a bounded amount of memory, so that
+    it can hold hundreds of millions of digests: the digests are first
+    partitioned by their first byte into temporary files, then each partition
+    is sorted and deduplicated in memory with numpy, and appended to the
+    index.
+    '''
+    digest_size = hashlib.new(algorithm).digest_size
+    if digest_size < 16:
+        raise Exception('Unsupported algorithm {a!r}, digests must be at '
+                        'least 16 bytes long'.format(a=algorithm))
+    directory = os.path.dirname(os.path.abspath(output))
+    with tempfile.TemporaryDirectory(dir=directory) as tmpdir:
+        partitions = [
+            open(os.path.join(tmpdir, '{b:02x}'.format(b=byte)), 'w+b')
+            for byte in range(256)
+        ]
+        try:
+            total = 0
+            for hash_list in hash_lists:
+                with open(hash_list, 'rb') as fd:
+                    for digests in _parse_digests(fd, digest_size):
+                        first = digests.view(numpy.uint8)[::digest_size]
+                        order = numpy.argsort(first, kind='stable')
+                        bounds = numpy.concatenate(
+                            ([0], numpy.cumsum(numpy.bincount(
+                                first, minlength=256))))
+                        digests = digests[order]
+                        for byte in numpy.flatnonzero(numpy.diff(bounds)):
+                            partitions[byte].write(
+                                digests[bounds[byte]:bounds[byte + 1]]
+                                .tobytes())
+                        total += len(digests)
+            bits = max(64, total * bits_per_entry)
+            bloom = numpy.zeros((bits + 7) // 8, dtype=numpy.uint8)
+            fanout = numpy.zeros(FANOUT_SIZE, dtype=numpy.int64)
+            digests_offset = HEADER_SIZE + FANOUT_SIZE * 8 + len(bloom)
+            count = 0
+            with open(output, 'wb') as out:
+                out.seek(digests_offset)
+                for partition in partitions:
+                    partition.seek(0)
+                    digests = numpy.unique(numpy.frombuffer(
+                        partition.read(), dtype='S{n}'.format(n=digest_size)))
+                    if not len(digests):
+                        continue
+                    raw = digests.view(numpy.uint8).reshape(len(digests), -1)
+                    prefixes = raw[:, 0].astype(numpy.intp) * 256 + raw[:, 1]
+                    fanout[1:] += numpy.bincount(prefixes, minlength=65536)
+                    _bloom_add(bloom, digests, hash_count, bits)
+                    out.write(digests.tobytes())
+                    count += len(digests)
+                fanout = numpy.cumsum(fanout).astype('<u8')
+                out.seek(0)
+                out.write(HEADER.pack(MAGIC, algorithm.encode('ascii'),
+                                      digest_size, hash_count, count, bits)
+                          .ljust(HEADER_SIZE, b'\0'))
+                out.write(fanout.tobytes())
+                out.write(bloom.tobytes())
+        finally:
+            for partition in partitions:
+                partition.close()
+    logger.info('Built known-hash index {o!r} with {n} digests'.format(
+        o=output,
+        n=count,
+    ))
+    return count
+
+
+class KnownHashes:
+    '''
+    Read-only known-hash index built by `build_index`, memory-mapped so that
+    opening it is instantaneous and lookups only read a few pages, whatever
+    the number of digests.
+
+    A lookup first checks the Bloom filter, which rejects most unknown digests
+    without reading the digests, then searches the sorted digests with the
+    same 2-byte prefix, found in the fan-out table.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fd:
+            self._data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, algorithm, digest_size, hash_count, count, bits = \
+            HEADER.unpack_from(self._data)
+        if magic != MAGIC:
+            self._data.close()
+            raise Exception('{p!r} is not a known-hash index'.format(p=path))
+        self.algorithm = algorithm.rstrip(b'\0').decode('ascii')
+        self.digest_size = digest_size
+        self._hash_count = hash_count
+        self._count = count
+        self._bits = bits
+        self._bloom_offset = HEADER_SIZE + FANOUT_SIZE * 8
+        self._digests_offset = self._bloom_offset + (bits + 7) // 8
+
+    def __repr__(self):
+        return '<{cls}(path={p!r}, algorithm={a!r}, digests={n})>'.format(
+            cls=self.__class__.__name__,
+            p=self.path,
+            a=self.algorithm,
+            n=self._count,
+        )
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, digest):
+        '''
+        Return True if the digest, binary or hexadecimal, is known
+        '''
+        if isinstance(digest, str):
+            digest = binascii.unhexlify(digest)
+        if len(digest) != self.digest_size:
+            return False
+        data = self._data
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        for position in _bloom_positions(h1, h2, self._hash_count,
+                                         self._bits):
+            if not data[self._bloom_offset + (position >> 3)] & \
+                    (1 << (position & 7)):
+                return False
+        low, high = struct.unpack_from(
+            '<QQ', data, HEADER_SIZE + (digest[0] * 256 + digest[1]) * 8)
+        size = self.digest_size
+        while low < high:
+            middle = (low + high) // 2
+            start = self._digests_offset + middle * size
+            current = data[start:start + size]
+            if current == digest:
+                return True
+            if current < digest:
+                low = middle + 1
+            else:
+                high = middle
+        return False
+
+    def close(self):
+        self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class KnownFileFilter:
+    '''
+    Known-file filtering stage of the scheduler.
+
+    Before a task is dispatched, the content of its file is hashed in a pool of
+    background threads and looked up in a known-hash index (see `KnownHashes`),
+    e.g. built from the NSRL. Known files are dropped, i.e. completed without
+    being run, or run last with a low priority. Either way, they are marked
+    as known. The digests of the other algorithms requested are computed in the
+    same pass, so that the deduplication stage does not read the files again
+    (see `take_digests`).
+
+    Supported settings:
+        index: path of the known-hash index
+        action: 'drop' (the default) to drop the tasks of known files, or
+                'deprioritize' to run them last
+        tasks: names of the tasks to filter (default: DEFAULT_TASKS)
+        workers: number of hashing threads
+    '''
+
+    DEFAULT_TASKS = ['PDFFile', 'JpegFile', 'ZipFile', 'TextFile']
+    DEFAULT_WORKERS = 4
+    ACTIONS = ('drop', 'deprioritize')
+
+    def __init__(self, index, action='drop', tasks=None,
+                 workers=DEFAULT_WORKERS, algorithms=()):
+        if action not in self.ACTIONS:
+            raise Exception('Unknown action {a!r}, valid actions are: '
+                            '{v}'.format(a=action, v=', '.join(self.ACTIONS)))
+        self._index = KnownHashes(index)
+        self._action = action
+        self._task_names = set(tasks or self.DEFAULT_TASKS)
+        self._algorithms = tuple(
+            [self._index.algorithm] +
+            [a for a in algorithms if a != self._index.algorithm])
+        self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+        # tasks being hashed
+        self._hashing = set()
+        # deprioritized tasks -> their digests, see `take_digests`
+        self._deferred = {}
+        self.hashed = 0
+        self.known = 0
+
+    def __repr__(self):
+        return '<{cls}(index={i!r}, action={a!r}, hashed={h}, known={k})>' \
+            .format(
+                cls=self.__class__.__name__,
+                i=self._index.path,
+                a=self._action,
+                h=self.hashed,
+                k=self.known,
+            )
+
+    def applies_to(self, task):
+        '''
+        Return True if the task has to be checked against the known hashes
+        '''
+        if task._name not in self._task_names or task in self._deferred:
+            return False
+        return task._source is not None or os.path.isfile(task.path)
+
+    def hash(self, task, callback):
+        '''
+        Compute the digests of the task's file in the background, and call
+        `callback(task, future)` when done. The future's result is a dict
+        mapping algorithm names to hex digests.
+        '''
+        self._hashing.add(task)
+        future = self._pool.submit(self._hash, task)
+        future.add_done_callback(lambda f: callback(task, f))
+
+    def _hash(self, task):
+        with task.open() as fd:
+            return utils.hash_fileobj(fd, self._algorithms)
+
+    def check(self, task, digests):
+        '''
+        Look up the digests of a task. Return 'run' if the task is not known
+        and has to be run, or the action to take ('drop' or 'deprioritize').
+        Dropped tasks are marked as completed (see `drop`), and have to be
+        recorded as finished. Deprioritized tasks get a low priority, and have
+        to be enqueued again.
+        '''
+        self._hashing.discard(task)
+        self.hashed += 1
+        if digests[self._index.algorithm] not in self._index:
+            return 'run'
+        self.known += 1
+        logger.debug('Known file {p!r}, action: {a}'.format(
+            p=task.path,
+            a=self._action,
+        ))
+        task._known = True
+        if self._action == 'deprioritize':
+            task._priority = basetask.PRIO_LOW
+            self._deferred[task] = digests
+        else:
+            self.drop(task)
+        return self._action
+
+    @staticmethod
+    def drop(task):
+        '''
+        Mark a known task as completed, without a result
+        '''
+        task.done = False
+        task._known = True
+        task.done = True
+
+    def hash_failed(self, task):
+        '''
+        Record that the digests could not be computed. The task is run.
+        '''
+        self._hashing.discard(task)
+
+    def take_digests(self, task):
+        '''
+        Return, and forget, the digests of a deprioritized task, or None
+        '''
+        return self._deferred.pop(task, None)
+
+    @property
+    def hashing(self):
+        '''
+        Return the number of tasks being hashed
+        '''
+        return len(self._hashing)
+
+    def pending_tasks(self):
+        '''
+        Return the tasks being hashed
+        '''
+        return list(self._hashing)
+
+    def stop(self):
+        self._pool.shutdown(wait=False)
+        self._index.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m forework.knownhashes',
+        description='Build a known-hash index from hash lists, e.g. the NSRL')
+    parser.add_argument('-a', '--algorithm', default='sha1',
+                        help='Hash algorithm of the lists (default: sha1)')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Index file to write')
+    parser.add_argument('hash_lists', nargs='+', metavar='HASH_LIST',
+                        help='Files listing hex digests, one per line or in '
+                             'CSV format')
+    args = parser.parse_args(args)
+    count = build_index(args.hash_lists, args.output, args.algorithm)
+    print('{n} digests written to {o}'.format(n=count, o=args.output))
+
+
+if __name__ == '__main__':
+    main()
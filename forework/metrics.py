@@ -0,0 +1,361 @@
+import os
+import time
+import bisect
+import threading
+import collections
+
+from . import basetask
+
+
+# seconds over which the rates are computed
+DEFAULT_WINDOW = 60
+# upper bounds of the buckets of the latency histograms, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+# interval between two exports of the metrics file, in seconds
+DEFAULT_EXPORT_INTERVAL = 15
+PRIORITY_CLASSES = {
+    basetask.PRIO_LOW: 'low',
+    basetask.PRIO_NORMAL: 'normal',
+    basetask.PRIO_HIGH: 'high',
+}
+
+
+def priority_class(priority):
+    return PRIORITY_CLASSES.get(priority, str(priority))
+
+
+class Counter:
+    '''
+    Monotonic counter, which also keeps its increments of the last `window`
+    seconds to compute its recent rate
+    '''
+
+    __slots__ = ('value', '_window', '_counts', '_seconds', '_created')
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.value = 0
+        self._window = window
+        # per-second increments, in a ring indexed by second
+        self._counts = [0] * window
+        self._seconds = [-1] * window
+        self._created = time.monotonic()
+
+    def add(self, amount=1):
+        self.value += amount
+        second = int(time.monotonic())
+        slot = second % self._window
+        if self._seconds[slot] != second:
+            self._seconds[slot] = second
+            self._counts[slot] = 0
+        self._counts[slot] += amount
+
+    def rate(self):
+        '''
+        Return the average increment per second over the last `window`
+        complete seconds
+        '''
+        now = time.monotonic()
+        second = int(now)
+        total = sum(
+            count for (count, slot_second) in zip(self._counts, self._seconds)
+            if second - self._window <= slot_second < second
+        )
+        elapsed = min(self._window, second - int(self._created))
+        if elapsed <= 0:
+            return 0.
+        return total / elapsed
+
+
+class Histogram:
+    '''
+    Histogram of observed values, counted in buckets with fixed upper bounds
+    '''
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # the last count is for the values above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        '''
+        Return an upper bound of the `q` quantile (0 <= q <= 1), i.e. the
+        upper bound of its bucket, or None if nothing was observed or the
+        quantile is above the last bound
+        '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for (bound, count) in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(.5),
+            'p90': self.quantile(.9),
+            'p99': self.quantile(.99),
+        }
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{k}="{v}"'.format(k=key, v=str(value).replace('\\', '\\\\')
+                           .replace('"', '\\"').replace('\n', '\\n'))
+        for (key, value) in sorted(labels.items())
+    ) + '}'
+
+
+class PrometheusWriter:
+    '''
+    Builder of a Prometheus text format exposition
+    '''
+
+    def __init__(self):
+        self._lines = []
+
+    def metric(self, name, kind, description):
+        self._lines.append('# HELP {n} {d}'.format(n=name, d=description))
+        self._lines.append('# TYPE {n} {k}'.format(n=name, k=kind))
+
+    def sample(self, name, value, labels=None):
+        self._lines.append('{n}{l} {v}'.format(
+            n=name, l=_labels(labels), v=repr(float(value))))
+
+    def histogram(self, name, histogram, labels=None):
+        labels = dict(labels or {})
+        cumulative = 0
+        for (bound, count) in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            self.sample(name + '_bucket', cumulative,
+                        dict(labels, le=repr(float(bound))))
+        self.sample(name + '_bucket', histogram.count, dict(labels, le='+Inf'))
+        self.sample(name + '_sum', histogram.sum, labels)
+        self.sample(name + '_count', histogram.count, labels)
+
+    def text(self):
+        return '\n'.join(self._lines) + '\n'
+
+
+class SchedulerMetrics:
+    '''
+    Counters and histograms of a scheduler run: tasks enqueued, dispatched
+    (dequeued to be run), completed and failed, bytes processed, time spent
+    by each task type waiting in the queue and running, busy time of each
+    worker, and time spent by the scheduler itself in each iteration of its
+    loop. Updates are cheap: they only touch a few counters, under a lock
+    since tasks can be enqueued from any thread.
+    '''
+
+    def __init__(self, window=DEFAULT_WINDOW, buckets=DEFAULT_BUCKETS):
+        self._lock = threading.Lock()
+        self._window = window
+        self._buckets = buckets
+        self._started = time.monotonic()
+        self.enqueued = Counter(window)
+        self.dispatched = Counter(window)
+        self.completed = Counter(window)
+        self.failed = Counter(window)
+        self.bytes = Counter(window)
+        # task name -> Histogram
+        self.wait_time = {}
+        self.run_time = {}
+        # worker -> [busy seconds, tasks run]
+        self.workers = collections.defaultdict(lambda: [0., 0])
+        self.loop_time = Histogram(buckets)
+
+    def __repr__(self):
+        return '<{cls}(enqueued={e}, completed={c})>'.format(
+            cls=self.__class__.__name__,
+            e=self.enqueued.value,
+            c=self.completed.value,
+        )
+
+    def _histogram(self, histograms, name):
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram(self._buckets)
+        return histogram
+
+    def task_enqueued(self, count=1):
+        with self._lock:
+            self.enqueued.add(count)
+
+    def task_dispatched(self, task, waited):
+        '''
+        Record a task dequeued to be run, after `waited` seconds in the queue
+        '''
+        with self._lock:
+            self.dispatched.add()
+            self._histogram(self.wait_time, task._name).observe(waited)
+
+    def task_completed(self, task, result):
+        '''
+        Record the completion of a task, with its completed copy as `result`,
+        or None if it failed
+        '''
+        with self._lock:
+            if result is None:
+                self.failed.add()
+                return
+            self.completed.add()
+            self.bytes.add(result._size or 0)
+            duration = result.duration
+            if duration is not None:
+                self._histogram(self.run_time, result._name).observe(duration)
+                if result._worker is not None:
+                    worker = self.workers[result._worker]
+                    worker[0] += duration
+                    worker[1] += 1
+
+    def loop_iteration(self, seconds):
+        '''
+        Record the time spent by the scheduler handling an iteration of its
+        loop, excluding the time spent waiting for events
+        '''
+        with self._lock:
+            self.loop_time.observe(seconds)
+
+    def start(self):
+        '''
+        Mark the start of the run. The uptime, and the busy ratios of the
+        workers, are measured from then rather than from the creation of the
+        metrics, as tasks are usually enqueued before the scheduler runs.
+        '''
+        self._started = time.monotonic()
+
+    @property
+    def uptime(self):
+        return time.monotonic() - self._started
+
+    def snapshot(self, queue_depths=None, in_flight=0):
+        '''
+        Return the metrics as a dict. `queue_depths` are the numbers of queued
+        tasks by priority (see `task_queue.PriorityTaskQueue.depths`).
+        '''
+        uptime = self.uptime
+        empty = Histogram(self._buckets)
+        with self._lock:
+            counters = {
+                name: {'total': counter.value, 'per_second': counter.rate()}
+                for (name, counter) in (('enqueued', self.enqueued),
+                                        ('dispatched', self.dispatched),
+                                        ('completed', self.completed),
+                                        ('failed', self.failed),
+                                        ('bytes', self.bytes))
+            }
+            tasks = {
+                name: {
+                    'wait': self.wait_time.get(name, empty).snapshot(),
+                    'run': self.run_time.get(name, empty).snapshot(),
+                }
+                for name in set(self.wait_time) | set(self.run_time)
+            }
+            workers = {
+                worker: {
+                    'busy_s': busy,
+                    'busy_ratio': busy / uptime if uptime > 0 else None,
+                    'tasks': count,
+                }
+                for (worker, (busy, count)) in self.workers.items()
+            }
+            loop = self.loop_time.snapshot()
+        snapshot = {
+            'uptime_s': uptime,
+            'queued': sum((queue_depths or {}).values()),
+            'queue_depth': {
+                priority_class(priority): count
+                for (priority, count) in (queue_depths or {}).items()
+            },
+            'in_flight': in_flight,
+            'tasks': tasks,
+            'workers': workers,
+            'scheduler_loop': loop,
+        }
+        snapshot.update(counters)
+        return snapshot
+
+    def prometheus(self, queue_depths=None, in_flight=0):
+        '''
+        Return the metrics in the Prometheus text format. Rates are left to
+        Prometheus, which computes them from the counters.
+        '''
+        out = PrometheusWriter()
+        uptime = self.uptime
+        out.metric('forework_uptime_seconds', 'gauge',
+                   'Time since the scheduler started')
+        out.sample('forework_uptime_seconds', uptime)
+        with self._lock:
+            for (name, counter, description) in (
+                    ('enqueued', self.enqueued, 'Tasks enqueued'),
+                    ('dispatched', self.dispatched,
+                     'Tasks dequeued to be run'),
+                    ('completed', self.completed, 'Tasks completed'),
+                    ('failed', self.failed, 'Tasks whose result was lost')):
+                metric = 'forework_tasks_{n}_total'.format(n=name)
+                out.metric(metric, 'counter', description)
+                out.sample(metric, counter.value)
+            out.metric('forework_bytes_processed_total', 'counter',
+                       'Size of the objects of the completed tasks')
+            out.sample('forework_bytes_processed_total', self.bytes.value)
+            out.metric('forework_queue_depth', 'gauge',
+                       'Tasks waiting in the queue, by priority')
+            for (priority, count) in sorted((queue_depths or {}).items()):
+                out.sample('forework_queue_depth', count,
+                           {'priority': priority_class(priority)})
+            out.metric('forework_tasks_in_flight', 'gauge',
+                       'Tasks dequeued and not yet completed')
+            out.sample('forework_tasks_in_flight', in_flight)
+            for (metric, histograms, description) in (
+                    ('forework_task_wait_seconds', self.wait_time,
+                     'Time spent by the tasks in the queue'),
+                    ('forework_task_run_seconds', self.run_time,
+                     'Run time of the tasks')):
+                out.metric(metric, 'histogram', description)
+                for (name, histogram) in sorted(histograms.items()):
+                    out.histogram(metric, histogram, {'task': name})
+            out.metric('forework_worker_busy_seconds_total', 'counter',
+                       'Time spent by the workers running tasks')
+            for (worker, (busy, _)) in sorted(self.workers.items()):
+                out.sample('forework_worker_busy_seconds_total', busy,
+                           {'worker': worker})
+            out.metric('forework_worker_busy_ratio', 'gauge',
+                       'Fraction of the uptime spent by the workers running '
+                       'tasks')
+            for (worker, (busy, _)) in sorted(self.workers.items()):
+                out.sample('forework_worker_busy_ratio',
+                           busy / uptime if uptime > 0 else 0,
+                           {'worker': worker})
+            out.metric('forework_scheduler_loop_seconds', 'histogram',
+                       'Time spent by the scheduler in an iteration of its '
+                       'loop')
+            out.histogram('forework_scheduler_loop_seconds', self.loop_time)
+        return out.text()
+
+    def write_prometheus(self, filename, queue_depths=None, in_flight=0):
+        '''
+        Write the metrics to a file in the Prometheus text format, e.g. for
+        the textfile collector of the node exporter. The file is replaced
+        atomically, so readers never see a partial file.
+        '''
+        temp = '{f}.tmp'.format(f=filename)
+        with open(temp, 'w') as fd:
+            fd.write(self.prometheus(queue_depths, in_flight))
+        os.replace(temp, filename)
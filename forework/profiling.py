@@ -0,0 +1,161 @@
+import os
+import io
+import pstats
+import random
+import cProfile
+import threading
+
+from . import utils
+
+
+logger = utils.get_logger(__name__)
+
+# fraction of the tasks profiled when no rate is configured
+DEFAULT_RATE = 0.05
+
+
+def start_profiler(task_name, settings):
+    '''
+    Decide whether to profile a run of a task, given the profiling settings of
+    the investigation (see `config.ForeworkConfig.profiling`), and return an
+    enabled `cProfile.Profile` if so, or None. The run is not profiled if
+    another profiler is already active in the process (e.g. the task runs
+    under a profiler or debugger), which `enable` refuses on Python 3.12+.
+    '''
+    if settings is None:
+        return None
+    tasks = settings.get('tasks')
+    if tasks and task_name not in tasks:
+        return None
+    if random.random() >= settings.get('rate', DEFAULT_RATE):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as exc:
+        logger.warning('Not profiling {t}: {e}'.format(t=task_name, e=exc))
+        return None
+    return profiler
+
+
+def stop_profiler(profiler):
+    '''
+    Stop a profiler started by `start_profiler`, and return its statistics
+    encoded for the trip back to the scheduler (see `encode_stats`)
+    '''
+    profiler.disable()
+    profiler.create_stats()
+    return encode_stats(profiler.stats)
+
+
+def encode_stats(stats):
+    '''
+    Encode a pstats dict, keyed by (file, line, function) tuples, as nested
+    lists, so that it can be pickled cheaply and serialized to JSON (e.g. for
+    the broker backend)
+    '''
+    return [
+        list(func) + [cc, nc, tt, ct, [
+            list(caller) + list(caller_stats)
+            for (caller, caller_stats) in callers.items()
+        ]]
+        for (func, (cc, nc, tt, ct, callers)) in stats.items()
+    ]
+
+
+def decode_stats(data):
+    '''
+    Decode statistics encoded by `encode_stats` into a pstats dict
+    '''
+    stats = {}
+    for entry in data:
+        func = tuple(entry[:3])
+        cc, nc, tt, ct, callers = entry[3:]
+        stats[func] = (cc, nc, tt, ct, {
+            tuple(caller[:3]): tuple(caller[3:]) for caller in callers
+        })
+    return stats
+
+
+class _RawStats:
+    # profile-like object, from which pstats.Stats loads the statistics
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class ProfileAggregator:
+    '''
+    Merge the profiles of the tasks run by the workers into one
+    `pstats.Stats` per task class. Profiles are added by the scheduler thread,
+    and can be read from any thread.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # task name -> pstats.Stats
+        self._stats = {}
+        # task name -> number of profiled runs
+        self.counts = {}
+
+    def __repr__(self):
+        return '<{cls}(profiled={p!r})>'.format(
+            cls=self.__class__.__name__,
+            p=self.counts,
+        )
+
+    def add(self, task_name, data):
+        '''
+        Merge the encoded profile of a run of a task (see `stop_profiler`)
+        '''
+        raw = _RawStats(decode_stats(data))
+        with self._lock:
+            stats = self._stats.get(task_name)
+            if stats is None:
+                self._stats[task_name] = pstats.Stats(raw)
+            else:
+                stats.add(raw)
+            self.counts[task_name] = self.counts.get(task_name, 0) + 1
+
+    def stats(self, task_name):
+        '''
+        Return the merged statistics of a task class as a `pstats.Stats`, or
+        None if none of its runs was profiled
+        '''
+        return self._stats.get(task_name)
+
+    def report(self, task_name, sort='cumulative', limit=20):
+        '''
+        Return the merged statistics of a task class as text, sorted by `sort`
+        (see `pstats.Stats.sort_stats`) and limited to `limit` functions
+        '''
+        out = io.StringIO()
+        with self._lock:
+            stats = self._stats.get(task_name)
+            if stats is None:
+                return ''
+            stats.stream = out
+            stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def dump(self, directory):
+        '''
+        Write the merged statistics of every task class to
+        `directory/<task>.pstats`, e.g. for snakeviz or `python -m pstats`,
+        and return the file names
+        '''
+        os.makedirs(directory, exist_ok=True)
+        filenames = []
+        with self._lock:
+            for (task_name, stats) in sorted(self._stats.items()):
+                filename = os.path.join(directory, '{t}.pstats'.format(
+                    t=task_name))
+                stats.dump_stats(filename)
+                filenames.append(filename)
+        logger.info('Profiles of {n} task classes written to {d!r}'.format(
+            n=len(filenames),
+            d=directory,
+        ))
+        return filenames
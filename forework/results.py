@@ -1,10 +1,13 @@
+import os
 import json
+import bisect
+import sqlite3
 import datetime
 import itertools
 import subprocess
 import collections
 
-import dateutil
+import dateutil.parser
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
@@ -14,6 +17,9 @@ DEFAULT_RESULTS_FILE = 'results.json'
 DEFAULT_PLOT_FILE = 'results.png'
 DEFAULT_DENSITY_PLOT_FILE = 'results_density.png'
 DEFAULT_EDITOR = 'vim'
+# number of tasks written by a results sink between two flushes or commits
+DEFAULT_SINK_BATCH_SIZE = 1000
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
 
 # List of tasks to skip size computation for
 CONTAINERS = ['Image', 'DirectoryScanner']
@@ -28,6 +34,26 @@ def bytes_to_human_readable_size(size):
     return '{s:.3f} {u}'.format(s=size, u=unit)
 
 
+def to_epoch(timestamp):
+    '''
+    Convert a datetime, or a string parseable by dateutil, to seconds since the
+    epoch. Naive timestamps are assumed to be in UTC, like the task times.
+    '''
+    if not isinstance(timestamp, datetime.datetime):
+        timestamp = dateutil.parser.parse(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp.timestamp()
+
+
+def task_epochs(task):
+    '''
+    Return the start and end times of a task in seconds since the epoch, or
+    None for the times not set
+    '''
+    return (task._start, task._end)
+
+
 def grouper(n, iterable):
     it = iter(iterable)
     while True:
@@ -37,14 +63,221 @@ def grouper(n, iterable):
        yield chunk
 
 
+class JSONLinesSink:
+    '''
+    Results sink appending every finished task to a file, as one JSON object
+    per line (see `BaseTask.to_dict`). With `truncate`, the previous content
+    of the file is discarded.
+    '''
+
+    def __init__(self, filename, batch_size=DEFAULT_SINK_BATCH_SIZE,
+                 truncate=False):
+        self.filename = filename
+        self._batch_size = batch_size
+        self._pending = 0
+        self._fd = open(filename, 'w' if truncate else 'a')
+
+    def __repr__(self):
+        return '<{c}(filename={f!r})>'.format(
+            c=self.__class__.__name__,
+            f=self.filename,
+        )
+
+    def write(self, task):
+        self._fd.write(json.dumps(task.to_dict()) + '\n')
+        self._pending += 1
+        if self._pending >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        self._fd.flush()
+        self._pending = 0
+
+    def close(self):
+        self.flush()
+        self._fd.close()
+
+
+class SQLiteSink:
+    '''
+    Results sink inserting every finished task in a SQLite database, committing
+    in batches. Besides the JSON representation of the task, the columns used
+    to filter the results are stored separately. With `truncate`, the results
+    already in the database are deleted.
+    '''
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS results ('
+        '    id INTEGER PRIMARY KEY,'
+        '    name TEXT,'
+        '    path TEXT,'
+        '    start TEXT,'
+        '    end TEXT,'
+        '    data TEXT'
+        ')',
+        'CREATE INDEX IF NOT EXISTS results_name ON results (name)',
+    )
+
+    def __init__(self, filename, batch_size=DEFAULT_SINK_BATCH_SIZE,
+                 truncate=False):
+        self.filename = filename
+        self._batch_size = batch_size
+        self._batch = []
+        self._db = sqlite3.connect(filename)
+        # let readers access the database while the results are written
+        self._db.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            self._db.execute(statement)
+        if truncate:
+            self._db.execute('DELETE FROM results')
+        self._db.commit()
+
+    def __repr__(self):
+        return '<{c}(filename={f!r})>'.format(
+            c=self.__class__.__name__,
+            f=self.filename,
+        )
+
+    def write(self, task):
+        taskdict = task.to_dict()
+        self._batch.append((
+            taskdict['name'],
+            taskdict['path'],
+            taskdict['start'],
+            taskdict['end'],
+            json.dumps(taskdict),
+        ))
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self._db.executemany(
+                'INSERT INTO results (name, path, start, end, data) '
+                'VALUES (?, ?, ?, ?, ?)',
+                self._batch,
+            )
+            self._db.commit()
+            self._batch = []
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+def open_sink(filename, batch_size=DEFAULT_SINK_BATCH_SIZE, truncate=False):
+    '''
+    Open a results sink writing to `filename`. The file extension selects the
+    format: SQLite for SQLITE_EXTENSIONS, newline-delimited JSON otherwise.
+    Results are appended to the store, unless `truncate` is set.
+    '''
+    if os.path.splitext(filename)[1] in SQLITE_EXTENSIONS:
+        return SQLiteSink(filename, batch_size, truncate)
+    return JSONLinesSink(filename, batch_size, truncate)
+
+
+class StoredResults:
+    '''
+    Results written by a results sink (see `open_sink`), read lazily from the
+    store. Tasks are returned as dictionaries (see `BaseTask.to_dict`), and
+    `load` builds a `Results` object out of them.
+    '''
+
+    def __init__(self, filename):
+        if not os.path.exists(filename):
+            raise Exception('No results store at {f!r}'.format(f=filename))
+        self.filename = filename
+        self._sqlite = os.path.splitext(filename)[1] in SQLITE_EXTENSIONS
+
+    def __repr__(self):
+        return '<{c}(filename={f!r})>'.format(
+            c=self.__class__.__name__,
+            f=self.filename,
+        )
+
+    def _query(self, query, args=()):
+        db = sqlite3.connect(self.filename)
+        try:
+            for row in db.execute(query, args):
+                yield row
+        finally:
+            db.close()
+
+    def __iter__(self):
+        if self._sqlite:
+            for (data, ) in self._query('SELECT data FROM results ORDER BY id'):
+                yield json.loads(data)
+        else:
+            with open(self.filename) as fd:
+                for line in fd:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def __len__(self):
+        if self._sqlite:
+            for (count, ) in self._query('SELECT COUNT(*) FROM results'):
+                return count
+        with open(self.filename) as fd:
+            return sum(1 for line in fd if line.strip())
+
+    def __getitem__(self, item):
+        '''
+        Return a task by index, or all the tasks with the given name as a list
+        '''
+        if type(item) == int:
+            if item < 0:
+                item += len(self)
+            for taskdict in itertools.islice(self, item, item + 1):
+                return taskdict
+            raise IndexError('Results index out of range')
+        return list(self.select(item))
+
+    def select(self, name):
+        '''
+        Iterate over the tasks with the given name
+        '''
+        if self._sqlite:
+            for (data, ) in self._query(
+                    'SELECT data FROM results WHERE name = ? ORDER BY id',
+                    (name, )):
+                yield json.loads(data)
+        else:
+            for taskdict in self:
+                if taskdict['name'] == name:
+                    yield taskdict
+
+    def load(self, config=None, name=None, start=None, end=None):
+        '''
+        Build a `Results` object with the stored tasks, or only with those
+        with the given name
+        '''
+        from .basetask import BaseTask
+        taskdicts = self if name is None else self.select(name)
+        return Results(
+            [BaseTask.from_dict(taskdict, config) for taskdict in taskdicts],
+            start,
+            end,
+        )
+
+
 class Results:
     '''
     Class that wraps the results obtained from a Forework Scheduler
     '''
 
-    def __init__(self, results=None, start=None, end=None):
+    def __init__(self, results=None, start=None, end=None, _epochs=None):
         self._results = results or []
         self._size = None
+        # secondary indexes, built lazily by the methods using them:
+        # task name -> positions of the tasks with that name
+        self._by_name = None
+        # keyword -> positions of the tasks whose object contains it
+        self._by_keyword = None
+        # (start, end) times of each task, in seconds since the epoch
+        self._epochs = _epochs
+        # positions of the tasks sorted by start time, and their start times
+        self._by_start = None
+        self._sorted_starts = None
         if start is None:
             start = None
         elif not isinstance(start, datetime.datetime):
@@ -66,12 +299,48 @@ class Results:
             n=len(self),
         )
 
+    def _name_index(self):
+        if self._by_name is None:
+            by_name = collections.defaultdict(list)
+            for (position, task) in enumerate(self._results):
+                by_name[task._name].append(position)
+            self._by_name = dict(by_name)
+        return self._by_name
+
+    def _keyword_index(self):
+        if self._by_keyword is None:
+            by_keyword = collections.defaultdict(list)
+            for (position, task) in enumerate(self._results):
+                if isinstance(task._result, dict):
+                    for keyword in task._result.get('keywords') or ():
+                        by_keyword[keyword].append(position)
+            self._by_keyword = dict(by_keyword)
+        return self._by_keyword
+
+    def _epoch_index(self):
+        if self._epochs is None:
+            self._epochs = [task_epochs(task) for task in self._results]
+        return self._epochs
+
+    def _start_index(self):
+        if self._by_start is None:
+            epochs = self._epoch_index()
+            # tasks that did not start yet cannot be in any time range
+            self._by_start = sorted(
+                (position for (position, (start, end)) in enumerate(epochs)
+                 if start is not None and end is not None),
+                key=lambda position: epochs[position][0],
+            )
+            self._sorted_starts = [epochs[position][0]
+                                   for position in self._by_start]
+        return self._by_start, self._sorted_starts
+
     def size(self):
         if self._size is None:
             size = 0
-            for task in self._results:
-                if task.__class__.__name__ not in CONTAINERS:
-                    size += task._size
+            for (name, positions) in self._name_index().items():
+                if name not in CONTAINERS:
+                    size += sum(self._results[p]._size for p in positions)
             self._size = size
         return self._size
 
@@ -83,16 +352,66 @@ class Results:
             # address by index
             return self._results[item]
         elif type(item) == slice:
-            return Results(self._results[item], self.start, self.end)
+            epochs = None
+            if self._epochs is not None:
+                epochs = self._epochs[item]
+            return Results(self._results[item], self.start, self.end,
+                           _epochs=epochs)
         else:
             # address by name
-            res = []
-            for task in self._results:
-                if task._name == item:
-                    res.append(task)
-            return Results(res, self.start, self.end)
+            positions = self._name_index().get(item, [])
+            epochs = None
+            if self._epochs is not None:
+                epochs = [self._epochs[p] for p in positions]
+            return Results([self._results[p] for p in positions], self.start,
+                           self.end, _epochs=epochs)
+
+    def keywords(self):
+        '''
+        Return a dict of the keywords found, with the number of objects
+        containing each of them
+        '''
+        return {
+            keyword: len(positions)
+            for (keyword, positions) in self._keyword_index().items()
+        }
+
+    def hits(self, keyword):
+        '''
+        Return all the tasks whose object contains the given keyword
+        '''
+        positions = self._keyword_index().get(keyword, [])
+        epochs = None
+        if self._epochs is not None:
+            epochs = [self._epochs[p] for p in positions]
+        return Results([self._results[p] for p in positions], self.start,
+                       self.end, _epochs=epochs)
+
+    @staticmethod
+    def open(filename):
+        '''
+        Open a results store written by a results sink, without loading it
+        '''
+        return StoredResults(filename)
 
     def save(self, filename=DEFAULT_RESULTS_FILE):
+        '''
+        Save the results as a JSON list, to a results store if the file name
+        has a store extension (.jsonl or SQLITE_EXTENSIONS), or to a DFXML
+        file (see `dfxml.export`) for DFXML_EXTENSIONS. An existing file is
+        overwritten.
+        '''
+        from . import dfxml
+        if os.path.splitext(filename)[1] in dfxml.DFXML_EXTENSIONS:
+            dfxml.export(self, filename)
+            return filename
+        if filename.endswith('.jsonl') or \
+                os.path.splitext(filename)[1] in SQLITE_EXTENSIONS:
+            sink = open_sink(filename, truncate=True)
+            for task in self._results:
+                sink.write(task)
+            sink.close()
+            return filename
         with open(filename, 'w') as fd:
             json.dump([x.to_dict() for x in self._results], fd)
         return filename
@@ -198,7 +517,10 @@ class Results:
             duration = '<unknown>'
         else:
             duration = self.end - self.start
-        counter = collections.Counter([t._name for t in self._results])
+        counter = collections.Counter({
+            name: len(positions)
+            for (name, positions) in self._name_index().items()
+        })
         top10 = ''
         for (task, frequency) in counter.most_common(10):
             top10 += '        {t} (appeared {f} times)\n'.format(
@@ -206,12 +528,27 @@ class Results:
                 f=frequency,
             )
         hrsize = bytes_to_human_readable_size(self.size())
+        hashed = duplicates = 0
+        for task in self._results:
+            if task._content_hash is not None:
+                hashed += 1
+                if task._duplicate_of is not None:
+                    duplicates += 1
+        if hashed:
+            dedup = '{d} of {h} hashed objects ({r:.1f}%)'.format(
+                d=duplicates,
+                h=hashed,
+                r=100. * duplicates / hashed,
+            )
+        else:
+            dedup = '<disabled>'
         print(
             'Start time       : {start}\n'
             'End time         : {end}\n'
             'Duration         : {duration}\n'
             'Analyzed objects : {nobj}\n'
             'Total size       : {size} bytes ({hrsize})\n'
+            'Deduplicated     : {dedup}\n'
             'Top file types   : \n{top10}\n'.format(
                 start=self.start,
                 end=self.end,
@@ -219,25 +556,27 @@ class Results:
                 nobj=len(self._results),
                 size=self.size(),
                 hrsize=hrsize,
+                dedup=dedup,
                 top10=top10,
             )
         )
 
-    def in_range(self, start_time, end_time, assume_sorted=True):
+    def in_range(self, start_time, end_time, assume_sorted=None):
         '''
         Return all the tasks that are entirely in a given time range.
 
-        Assume that the tasks are sorted (they should be), unless assume_sorted
-        is False
+        The tasks are found with a binary search on their start times, so
+        `assume_sorted` is ignored and only kept for compatibility.
         '''
-        if not isinstance(start_time, datetime.datetime):
-            start_time = dateutil.parser.parse(start_time)
-        if not isinstance(end_time, datetime.datetime):
-            end_time = dateutil.parser.parse(end_time)
-        ret = []
-        for item in self._results:
-            if item.start_time >= start_time and item.end_time <= end_time:
-                ret.append(item)
-            if assume_sorted and item.start_time > end_time:
-                break
-        return Results(ret, self.start, self.end)
+        start_epoch, end_epoch = to_epoch(start_time), to_epoch(end_time)
+        by_start, sorted_starts = self._start_index()
+        epochs = self._epoch_index()
+        # a task in the range starts between start_time and end_time
+        first = bisect.bisect_left(sorted_starts, start_epoch)
+        last = bisect.bisect_right(sorted_starts, end_epoch)
+        positions = sorted(
+            position for position in by_start[first:last]
+            if epochs[position][1] <= end_epoch
+        )
+        return Results([self._results[p] for p in positions], self.start,
+                       self.end, _epochs=[epochs[p] for p in positions])
@@ -1,14 +1,22 @@
 import copy
+import json
 import time
-import asyncio
+import uuid
+import queue
 import datetime
 import threading
+import itertools
 import collections
+import multiprocessing
+import concurrent.futures
 
-import ipyparallel as parallel
-import ipyparallel.error
+try:
+    import ipyparallel
+except ImportError:
+    ipyparallel = None
 
-from . import task_queue, utils, basetask, results
+from . import (task_queue, utils, basetask, results, dedup, checkpoint,
+               config, knownhashes, broker, metrics, profiling)
 from .basetask import BaseTask
 
 _scheduler = None
@@ -16,6 +24,462 @@ _scheduler = None
 logger = utils.get_logger(__name__)
 
 
+def _run_task(task):
+    '''
+    Run a task on an IPyParallel engine. Follow-up tasks flushed by the task
+    while running are published to the client with `publish_data`, and picked
+    up by the scheduler before the task completes.
+    '''
+    from ipyparallel.datapub import publish_data
+    from forework import basetask
+
+    batch_ids = itertools.count()
+
+    def emit(batch):
+        publish_data({'next_tasks_{n}'.format(n=next(batch_ids)): batch})
+
+    basetask.set_emitter(emit)
+    try:
+        return task.start()
+    finally:
+        basetask.set_emitter(None)
+
+
+def _init_local_worker(stream_queue, investigation_config):
+    '''
+    Initialize a worker process of the local backend. Follow-up tasks flushed
+    by running tasks are sent to the scheduler through `stream_queue`, and the
+    configuration is registered once for all the tasks.
+    '''
+    basetask.set_emitter(stream_queue.put)
+    if investigation_config is not None:
+        config.register(investigation_config)
+
+
+def _run_local_task(task):
+    '''
+    Run a task in a worker process of the local backend
+    '''
+    return task.start()
+
+
+def _run_batch(tasks):
+    '''
+    Run a batch of tasks in a single call to a worker, and return the list of
+    completed tasks
+    '''
+    return [task.start() for task in tasks]
+
+
+class ExecutorBackend:
+    '''
+    Base class for the backends that execute the tasks on behalf of the
+    Scheduler.
+
+    A backend returns a `concurrent.futures.Future` for every submitted task,
+    whose result is the completed task, or for every submitted batch of tasks,
+    whose result is the list of completed tasks. Follow-up tasks streamed by
+    tasks still running are returned by `collect_streamed`.
+    '''
+
+    name = None
+
+    def __init__(self, config=None, **options):
+        self._config = config
+        self._options = options
+
+    def __repr__(self):
+        return '<{cls}(options={o!r})>'.format(
+            cls=self.__class__.__name__,
+            o=self._options,
+        )
+
+    def start(self):
+        '''
+        Prepare the backend to accept tasks
+        '''
+        pass
+
+    def submit(self, task):
+        '''
+        Submit a task for execution and return a future for it
+        '''
+        raise NotImplementedError
+
+    def submit_batch(self, tasks):
+        '''
+        Submit a list of tasks to be run by the same worker, and return a
+        future for them
+        '''
+        raise NotImplementedError
+
+    def result(self, future):
+        '''
+        Return the completed task from a done future
+        '''
+        return future.result()
+
+    def cancelled(self, future):
+        '''
+        Return True if a done future was cancelled by `abort` before its tasks
+        started
+        '''
+        return future.cancelled()
+
+    def collect_streamed(self, futures):
+        '''
+        Return the follow-up tasks (in JSON format) streamed by the tasks of
+        the given futures since the last call
+        '''
+        return []
+
+    def abort(self):
+        '''
+        Abort the tasks not yet started
+        '''
+        pass
+
+    def wait(self):
+        '''
+        Wait for the submitted tasks to complete
+        '''
+        pass
+
+    def stop(self):
+        '''
+        Release the resources held by the backend
+        '''
+        pass
+
+
+class IPyParallelBackend(ExecutorBackend):
+    '''
+    Backend executing the tasks on an IPyParallel cluster. Requires a running
+    `ipcluster`. Supported options:
+        profile: the IPython profile of the cluster
+    '''
+
+    name = 'ipyparallel'
+
+    def __init__(self, config=None, **options):
+        ExecutorBackend.__init__(self, config, **options)
+        self._client = None
+        self._lview = None
+        # IDs of the engines the configuration is registered on
+        self._engines = set()
+
+    def start(self):
+        if ipyparallel is None:
+            raise Exception('The ipyparallel backend requires ipyparallel')
+        logger.info('Connecting to the ipyparallel cluster')
+        self._client = ipyparallel.Client(profile=self._options.get('profile'))
+        self._lview = self._client.load_balanced_view()
+        self._engines = set()
+        self._register_engines()
+
+    def _register_engines(self):
+        '''
+        Register the configuration once on every engine that joined the
+        cluster since the last call, as tasks refer to it by ID, and restrict
+        the load-balanced view to the engines that know it
+        '''
+        engines = set(self._client.ids) - self._engines
+        if not engines:
+            return
+        if self._config is not None:
+            self._client[sorted(engines)].apply_sync(config.register,
+                                                     self._config)
+        self._engines |= engines
+        self._lview.targets = sorted(self._engines)
+
+    def submit(self, task):
+        self._register_engines()
+        return self._lview.apply_async(_run_task, task)
+
+    def submit_batch(self, tasks):
+        self._register_engines()
+        return self._lview.apply_async(_run_batch, tasks)
+
+    def result(self, future):
+        return future.get()
+
+    def cancelled(self, future):
+        try:
+            future.get(0)
+        except ipyparallel.error.TaskAborted:
+            return True
+        except Exception:
+            pass
+        return False
+
+    def collect_streamed(self, futures):
+        jsontasks = []
+        for future in futures:
+            data = self._client.metadata[future.msg_ids[0]]['data']
+            for key in list(data.keys()):
+                if key.startswith('next_tasks_'):
+                    jsontasks.extend(data.pop(key))
+        return jsontasks
+
+    def abort(self):
+        if self._client is not None:
+            self._client.abort()
+
+    def wait(self):
+        if self._client is not None:
+            self._client.wait()
+
+    def stop(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+class ProcessPoolBackend(ExecutorBackend):
+    '''
+    Backend executing the tasks in a pool of local processes, with no cluster
+    to set up. Supported options:
+        workers: number of worker processes (default: number of CPUs)
+    '''
+
+    name = 'local'
+
+    def __init__(self, config=None, **options):
+        ExecutorBackend.__init__(self, config, **options)
+        self._pool = None
+        self._stream_queue = None
+        # futures of the submitted tasks not yet done, to cancel them on abort
+        # (`shutdown(cancel_futures=True)` needs Python 3.9)
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        workers = self._options.get('workers') or multiprocessing.cpu_count()
+        logger.info('Starting {n} local workers'.format(n=workers))
+        # a SimpleQueue writes synchronously to its pipe, so the streamed tasks
+        # are always sent before the result of the task that streamed them
+        self._stream_queue = multiprocessing.SimpleQueue()
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_local_worker,
+            initargs=(self._stream_queue, self._config),
+        )
+
+    def _track(self, future):
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._untrack)
+        return future
+
+    def _untrack(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def submit(self, task):
+        return self._track(self._pool.submit(_run_local_task, task))
+
+    def submit_batch(self, tasks):
+        return self._track(self._pool.submit(_run_batch, tasks))
+
+    def collect_streamed(self, futures):
+        # the stream queue is shared by all the workers
+        jsontasks = []
+        while not self._stream_queue.empty():
+            jsontasks.extend(self._stream_queue.get())
+        return jsontasks
+
+    def abort(self):
+        # the running tasks cannot be cancelled, and complete normally
+        with self._lock:
+            futures = list(self._pending)
+        for future in futures:
+            future.cancel()
+
+    def wait(self):
+        with self._lock:
+            futures = list(self._pending)
+        concurrent.futures.wait(futures)
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+class BrokerBackend(ExecutorBackend):
+    '''
+    Backend publishing the tasks to a message broker, from which workers pull
+    them (see `broker.Worker`). Workers get task descriptors rather than
+    pickled tasks, and acknowledge every message with its result once done,
+    so that the messages of a worker that dies are delivered to another one.
+    The follow-up tasks streamed by the tasks of a message delivered again
+    can then be enqueued twice (see `broker.SQLiteBroker`).
+    Supported options:
+        url: broker URL, 'memory://' or 'sqlite:///path/to/db' (see
+            `broker.open_broker`, default: 'memory://')
+        workers: number of workers started by the backend, as threads for
+            the in-memory broker and as local processes otherwise. With 0,
+            the tasks are run by the workers started separately with
+            `python -m forework.broker` (default: number of CPUs)
+        prefetch: number of messages fetched at once by a worker
+        visibility_timeout: seconds before a message fetched by a worker and
+            not acknowledged is delivered again
+        max_attempts: number of deliveries of a message before it fails
+        poll_interval: seconds between two polls of the broker
+    '''
+
+    name = 'broker'
+
+    def __init__(self, config=None, **options):
+        ExecutorBackend.__init__(self, config, **options)
+        self._broker = None
+        # message ID -> (future, True if the message is a batch)
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._collector = None
+        self._workers = []
+        self._threads = []
+        self._processes = []
+
+    def start(self):
+        url = self._options.get('url', 'memory://')
+        self._broker = broker.open_broker(url, self._options.get(
+            'max_attempts', broker.DEFAULT_MAX_ATTEMPTS))
+        self._poll_interval = self._options.get(
+            'poll_interval', broker.DEFAULT_POLL_INTERVAL)
+        worker_options = {
+            'prefetch': self._options.get('prefetch', broker.DEFAULT_PREFETCH),
+            'visibility_timeout': self._options.get(
+                'visibility_timeout', broker.DEFAULT_VISIBILITY_TIMEOUT),
+            'poll_interval': self._poll_interval,
+        }
+        workers = self._options.get('workers')
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        logger.info('Starting {n} workers for the broker {b!r}'.format(
+            n=workers,
+            b=self._broker,
+        ))
+        for _ in range(workers):
+            if isinstance(self._broker, broker.MemoryBroker):
+                worker = broker.Worker(self._broker, self._config,
+                                       **worker_options)
+                thread = threading.Thread(target=worker.run, daemon=True)
+                thread.start()
+                self._workers.append(worker)
+                self._threads.append(thread)
+            else:
+                process = multiprocessing.Process(
+                    target=broker.run_worker,
+                    args=(url, self._config),
+                    kwargs=worker_options,
+                    daemon=True,
+                )
+                process.start()
+                self._processes.append(process)
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def _collect(self):
+        # resolve the futures of the messages acknowledged by the workers
+        while not self._stopped.wait(self._poll_interval):
+            try:
+                records = self._broker.take((broker.RESULT, broker.ERROR))
+            except Exception as exc:
+                logger.error('Cannot retrieve the results from {b!r}: '
+                             '{e}'.format(b=self._broker, e=exc))
+                continue
+            for record in records:
+                with self._lock:
+                    entry = self._futures.pop(record.message_id, None)
+                if entry is None:
+                    continue
+                future, batch = entry
+                if record.kind == broker.ERROR:
+                    future.set_exception(Exception(record.payload))
+                    continue
+                completed = [BaseTask.from_dict(taskdict, self._config)
+                             for taskdict in json.loads(record.payload)]
+                future.set_result(completed if batch else completed[0])
+
+    def _publish(self, tasks, batch):
+        message_id = uuid.uuid4().hex
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._futures[message_id] = (future, batch)
+        self._broker.publish([(message_id, broker.encode_message(tasks))])
+        return future
+
+    def submit(self, task):
+        return self._publish([task], False)
+
+    def submit_batch(self, tasks):
+        return self._publish(tasks, True)
+
+    def collect_streamed(self, futures):
+        # like the local backend, the streamed tasks of all the workers are
+        # collected at once
+        jsontasks = []
+        for record in self._broker.take((broker.STREAM, )):
+            jsontasks.extend(json.loads(record.payload))
+        return jsontasks
+
+    def abort(self):
+        if self._broker is None:
+            return
+        for message_id in self._broker.purge():
+            with self._lock:
+                entry = self._futures.pop(message_id, None)
+            if entry is not None:
+                entry[0].cancel()
+
+    def wait(self):
+        with self._lock:
+            futures = [future for (future, _) in self._futures.values()]
+        concurrent.futures.wait(futures)
+
+    def stop(self):
+        for worker in self._workers:
+            worker.stop()
+        for thread in self._threads:
+            thread.join()
+        for process in self._processes:
+            process.terminate()
+            process.join()
+        self._stopped.set()
+        if self._collector is not None:
+            self._collector.join()
+        if self._broker is not None:
+            self._broker.close()
+            self._broker = None
+        self._workers, self._threads, self._processes = [], [], []
+
+
+BACKENDS = {
+    backend.name: backend for backend in (IPyParallelBackend,
+                                          ProcessPoolBackend,
+                                          BrokerBackend)
+}
+
+
+def get_backend(config):
+    '''
+    Create the execution backend selected in the investigation configuration
+    (see `config.ForeworkConfig.backend`)
+    '''
+    options = dict(config.backend)
+    name = options.pop('name', IPyParallelBackend.name)
+    try:
+        cls = BACKENDS[name]
+    except KeyError:
+        raise Exception('Unknown backend {b!r}, valid backends are: {v}'.format(
+            b=name,
+            v=', '.join(sorted(BACKENDS)),
+        ))
+    return cls(config, **options)
+
+
 class Scheduler(threading.Thread):
     '''
     Task scheduler
@@ -24,19 +488,246 @@ class Scheduler(threading.Thread):
     tasks
     '''
 
+    # how long the scheduler sleeps when there is nothing to do. New tasks
+    # and completions wake it up immediately
+    IDLE_TIMEOUT = 1
+    # how often the follow-up tasks streamed by running tasks are collected
+    STREAM_POLL_INTERVAL = 1e-1
+    # maximum number of tasks submitted to the cluster at any time. The others
+    # wait in the priority queue, so that high priority tasks discovered later
+    # can overtake them
+    DEFAULT_MAX_IN_FLIGHT = 256
+    # see `enqueue_many`
+    ENQUEUE_WAKEUP_INTERVAL = 1000
+
     def __init__(self):
-        self._task_queue = task_queue.get()
-        self._client = None
+        self._task_queue = task_queue.PriorityTaskQueue()
+        self._backend = None
         self._running = False
         self._finished_tasks = []
         logger.debug('Initialized scheduler')
         self._config = None
         self._start_time = None
         self._end_time = None
+        # set whenever there are new tasks or completions to handle
+        self._wakeup = threading.Event()
+        # futures of the completed tasks, filled by `_on_done`
+        self._completed = queue.Queue()
+        # tasks in progress, by future. Batches of tasks are lists
+        self._in_flight = {}
+        # futures of the tasks in progress that stream follow-up tasks
+        self._streaming = set()
+        # known-file filtering stage, if enabled in the configuration
+        self._known = None
+        # (task, future) pairs of the tasks whose content was hashed by the
+        # known-file filter, filled by `_on_known_hashed`
+        self._known_hashed = queue.Queue()
+        # content deduplication stage, if enabled in the configuration
+        self._dedup = None
+        # (task, future) pairs of the tasks whose content was hashed, filled
+        # by `_on_hashed`
+        self._hashed = queue.Queue()
+        # sink writing the finished tasks as they complete, if a results store
+        # is configured
+        self._sink = None
+        self._keep_results = True
+        # keys of the finished tasks (see `BaseTask.key`), kept if
+        # checkpointing is enabled
+        self._finished_keys = set()
+        # if True, tasks already finished are not run again (see `resume`)
+        self._skip_finished = False
+        self._last_checkpoint = time.monotonic()
+        self._checkpoint_requested = False
+        self._resumed_start_time = None
+        # counters and histograms of the run (see `metrics`)
+        self._metrics = metrics.SchedulerMetrics()
+        self._last_metrics_export = time.monotonic()
+        # profiles of the sampled task runs, by task class (see `profiling`)
+        self._profiles = profiling.ProfileAggregator()
         threading.Thread.__init__(self)
 
     def set_config(self, config):
         self._config = config
+        self._task_queue.set_priority(config.priority)
+        if config.aging_rate is not None:
+            self._task_queue.set_aging_rate(config.aging_rate)
+
+    def set_priority(self, task_names):
+        '''
+        Set the list of task names to prioritize, in order of importance. This
+        applies to the queued tasks too.
+        '''
+        self._task_queue.set_priority(task_names)
+
+    def reprioritize(self, task_name, priority):
+        '''
+        Change the priority (see `basetask.PRIO_*`) of the queued tasks with the
+        given name, and return how many tasks were changed
+        '''
+        return self._task_queue.reprioritize(task_name, priority)
+
+    @property
+    def max_in_flight(self):
+        if self._config is None or self._config.max_in_flight is None:
+            return self.DEFAULT_MAX_IN_FLIGHT
+        return self._config.max_in_flight
+
+    @property
+    def in_flight(self):
+        '''
+        Return the number of tasks dequeued and not yet completed, including
+        those being hashed for known-file filtering or deduplication
+        '''
+        in_flight = sum(
+            len(tasks) if isinstance(tasks, list) else 1
+            for tasks in self._in_flight.values()
+        )
+        if self._known is not None:
+            in_flight += self._known.hashing
+        if self._dedup is not None:
+            in_flight += self._dedup.hashing
+        return in_flight
+
+    @property
+    def queued(self):
+        '''
+        Return the number of tasks waiting in the queue
+        '''
+        return len(self._task_queue)
+
+    @property
+    def checkpoint_file(self):
+        '''
+        Return the checkpoint file name, or None if checkpointing is disabled
+        '''
+        if self._config is None or self._config.checkpoint is None:
+            return None
+        return self._config.checkpoint.get(
+            'path', checkpoint.DEFAULT_CHECKPOINT_FILE)
+
+    def checkpoint(self):
+        '''
+        Request a checkpoint of the investigation, which is saved by the
+        scheduler thread as soon as possible
+        '''
+        if self.checkpoint_file is None:
+            raise Exception('Checkpointing is not enabled in the configuration')
+        self._checkpoint_requested = True
+        self._wakeup.set()
+
+    def _save_checkpoint(self):
+        '''
+        Save the pending, in-flight and finished tasks to the checkpoint file.
+        The tasks streamed by in-flight tasks are left out, as they are
+        streamed again when the in-flight tasks are resumed. Must be called
+        from the scheduler thread.
+        '''
+        in_flight = []
+        for tasks in self._in_flight.values():
+            if isinstance(tasks, list):
+                in_flight.extend(tasks)
+            else:
+                in_flight.append(tasks)
+        waiting = []
+        if self._known is not None:
+            waiting.extend(self._known.pending_tasks())
+        if self._dedup is not None:
+            waiting.extend(self._dedup.pending_tasks())
+        waiting.extend(self._task_queue.snapshot())
+        running = set(task.key for task in in_flight)
+        pending = in_flight + [
+            task for task in waiting if task._parent not in running]
+        finished_tasks = None
+        if self._sink is None:
+            finished_tasks = [task.to_dict() for task in self._finished_tasks]
+        else:
+            # make sure the results store is not behind the checkpoint
+            self._sink.flush()
+        checkpoint.Checkpoint(
+            pending=[task.to_dict() for task in pending],
+            finished_keys=self._finished_keys,
+            finished_tasks=finished_tasks,
+            start_time=self._start_time,
+        ).save(self.checkpoint_file)
+        self._last_checkpoint = time.monotonic()
+        self._checkpoint_requested = False
+
+    def _checkpoint_due(self):
+        if self.checkpoint_file is None:
+            return False
+        interval = self._config.checkpoint.get(
+            'interval', checkpoint.DEFAULT_INTERVAL)
+        return self._checkpoint_requested or \
+            time.monotonic() - self._last_checkpoint >= interval
+
+    def metrics(self):
+        '''
+        Return a snapshot of the metrics of the run as a dict: rates and totals
+        of the tasks enqueued, dispatched, completed and failed and of the
+        bytes processed, queue depth by priority, wait and run times by task
+        type, busy ratio of each worker, and time spent by the scheduler in
+        each iteration of its loop (see `metrics.SchedulerMetrics`)
+        '''
+        return self._metrics.snapshot(self._task_queue.depths(),
+                                      self.in_flight)
+
+    @property
+    def profiles(self):
+        '''
+        Return the profiles of the task runs sampled by the workers, merged by
+        task class, if profiling is enabled in the configuration (see
+        `profiling.ProfileAggregator`), e.g.
+        `sched.profiles.report('PDFFile')`
+        '''
+        return self._profiles
+
+    @property
+    def metrics_file(self):
+        '''
+        Return the file where the metrics are exported in the Prometheus text
+        format, or None if they are not exported
+        '''
+        if self._config is None or self._config.metrics is None:
+            return None
+        return self._config.metrics.get('prometheus')
+
+    def _export_metrics(self):
+        '''
+        Write the metrics to the metrics file. Must be called from the
+        scheduler thread.
+        '''
+        try:
+            self._metrics.write_prometheus(
+                self.metrics_file, self._task_queue.depths(), self.in_flight)
+        except OSError as exc:
+            logger.error('Cannot write the metrics to {f!r}: {e}'.format(
+                f=self.metrics_file,
+                e=exc,
+            ))
+        self._last_metrics_export = time.monotonic()
+
+    def _metrics_export_due(self):
+        if self.metrics_file is None:
+            return False
+        interval = self._config.metrics.get(
+            'interval', metrics.DEFAULT_EXPORT_INTERVAL)
+        return time.monotonic() - self._last_metrics_export >= interval
+
+    def resume(self, filename=None):
+        '''
+        Resume an investigation from a checkpoint (by default the one in the
+        configuration). The pending tasks are enqueued, and the tasks already
+        finished are not run again. Call this before starting the scheduler.
+        '''
+        if filename is None:
+            filename = self.checkpoint_file
+        state = checkpoint.Checkpoint.load(filename)
+        logger.info('Resuming from {c!r}'.format(c=state))
+        self._finished_keys = set(state.finished_keys)
+        self._skip_finished = True
+        self._finished_tasks.extend(state.completed_tasks(self._config))
+        self._resumed_start_time = state.start_time
+        self.enqueue_many(state.pending_tasks(self._config))
 
     def enqueue(self, task):
         '''
@@ -46,19 +737,28 @@ class Scheduler(threading.Thread):
         '''
         logger.debug('Adding task: {t}'.format(t=task))
         self._task_queue.put_nowait(task)
+        self._metrics.task_enqueued()
+        self._wakeup.set()
 
     def enqueue_many(self, tasks):
         '''
         Add multiple tasks to the task queue, and start processing them.
 
-        `tasks` is an iterable of BaseTask subclasses.
+        `tasks` is an iterable of BaseTask subclasses, possibly a generator
+        (e.g. `dfxml.import_tasks`): the scheduler is woken up every
+        ENQUEUE_WAKEUP_INTERVAL tasks, so that it starts processing them while
+        the others are still being produced.
         '''
-        logger.debug('Adding {n} tasks: {t}'.format(
-            n=len(tasks),
-            t=str(tasks)[:30],
-        ))
+        count = 0
         for task in tasks:
             self._task_queue.put_nowait(task)
+            count += 1
+            if count % self.ENQUEUE_WAKEUP_INTERVAL == 0:
+                self._metrics.task_enqueued(self.ENQUEUE_WAKEUP_INTERVAL)
+                self._wakeup.set()
+        self._metrics.task_enqueued(count % self.ENQUEUE_WAKEUP_INTERVAL)
+        logger.debug('Added {n} tasks'.format(n=count))
+        self._wakeup.set()
 
     def enqueue_from_json(self, jsondata):
         '''
@@ -66,12 +766,259 @@ class Scheduler(threading.Thread):
         '''
         self.enqueue(BaseTask.from_json(jsondata, self._config))
 
-    def _connect(self):
+    def _on_done(self, future):
         '''
-        Connect to the IPyParallel cluster
+        Completion callback for the submitted tasks. This may be called from a
+        backend thread, so it only hands the future over to the scheduler
+        thread.
         '''
-        logger.info('Connecting to the ipyparallel cluster')
-        self._client = parallel.Client()
+        self._completed.put(future)
+        self._wakeup.set()
+
+    def _on_hashed(self, task, future):
+        '''
+        Callback for the tasks whose content was hashed by the deduplication
+        stage. Like `_on_done`, it is called from another thread.
+        '''
+        self._hashed.put((task, future))
+        self._wakeup.set()
+
+    def _on_known_hashed(self, task, future):
+        '''
+        Callback for the tasks whose content was hashed by the known-file
+        filter. Like `_on_done`, it is called from another thread.
+        '''
+        self._known_hashed.put((task, future))
+        self._wakeup.set()
+
+    def _submit(self, tasks):
+        '''
+        Submit tasks to the backend, after filtering the known files and
+        deduplicating them if enabled
+        '''
+        ready = []
+        digests = {}
+        for task in tasks:
+            if self._skip_finished and task.key in self._finished_keys:
+                logger.debug('Skipping finished task {t!r}'.format(t=task))
+                continue
+            if self._known is not None:
+                # deprioritized known files were hashed already
+                task_digests = self._known.take_digests(task)
+                if task_digests is not None:
+                    digests[task] = task_digests
+                elif self._known.applies_to(task):
+                    self._known.hash(task, self._on_known_hashed)
+                    continue
+            ready.append(task)
+        self._deduplicate(ready, digests)
+
+    def _deduplicate(self, tasks, digests=None):
+        '''
+        Submit tasks to the backend, after deduplicating them if enabled.
+        `digests` maps tasks to the digests computed by the known-file filter,
+        by algorithm, so that their files are not hashed again.
+        '''
+        ready = []
+        for task in tasks:
+            if self._dedup is not None and self._dedup.applies_to(task):
+                digest = (digests or {}).get(task, {}).get(
+                    self._dedup.algorithm)
+                self._dedup.hash(task, self._on_hashed, digest)
+            else:
+                ready.append(task)
+        self._submit_batched(ready)
+
+    def _submit_batched(self, tasks):
+        '''
+        Submit tasks to the backend, grouping the tasks of the classes run in
+        batches (see `BaseTask.BATCH_SIZE`)
+        '''
+        batches = {}
+        for task in tasks:
+            if task.BATCH_SIZE <= 1:
+                self._submit_task(task)
+                continue
+            batch = batches.setdefault(task._name, [])
+            batch.append(task)
+            if len(batch) >= task.BATCH_SIZE:
+                self._submit_batch(batches.pop(task._name))
+        for batch in batches.values():
+            self._submit_batch(batch)
+
+    def _submit_task(self, task):
+        '''
+        Submit a task to the backend. Each task completes independently.
+        '''
+        future = self._backend.submit(task)
+        self._in_flight[future] = task
+        if task.STREAMS_NEXT_TASKS:
+            self._streaming.add(future)
+        future.add_done_callback(self._on_done)
+
+    def _submit_batch(self, tasks):
+        '''
+        Submit a list of tasks to be run by the same worker
+        '''
+        if len(tasks) == 1:
+            self._submit_task(tasks[0])
+            return
+        future = self._backend.submit_batch(tasks)
+        self._in_flight[future] = tasks
+        future.add_done_callback(self._on_done)
+
+    def _handle_known_hashed(self):
+        '''
+        Submit the hashed tasks whose files are not known, and record as
+        finished or enqueue again with a low priority the others
+        '''
+        ready = []
+        digests = {}
+        while True:
+            try:
+                task, future = self._known_hashed.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                task_digests = future.result()
+            except Exception as exc:
+                logger.warning('Cannot hash {p!r}, not checking if it is '
+                               'known: {e}'.format(p=task.path, e=exc))
+                self._known.hash_failed(task)
+                ready.append(task)
+                continue
+            action = self._known.check(task, task_digests)
+            if action == 'run':
+                ready.append(task)
+                digests[task] = task_digests
+            elif action == 'deprioritize':
+                self.enqueue(task)
+            else:
+                self._add_finished(task)
+        self._deduplicate(ready, digests)
+
+    def _handle_hashed(self):
+        '''
+        Submit the hashed tasks whose content was not seen before, and collect
+        the duplicates of tasks already completed
+        '''
+        ready = []
+        while True:
+            try:
+                task, future = self._hashed.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                digest = future.result()
+            # objects read from a source fail with the errors of their opener
+            # (e.g. KeyError for a missing zip member), not only OSError
+            except Exception as exc:
+                logger.warning('Cannot hash {p!r}, not deduplicating it: '
+                               '{e}'.format(p=task.path, e=exc))
+                self._dedup.hash_failed(task)
+                ready.append(task)
+                continue
+            if self._dedup.check(task, digest):
+                ready.append(task)
+        self._submit_batched(ready)
+        for duplicate in self._dedup.take_linked():
+            self._add_finished(duplicate)
+
+    def _add_finished(self, result):
+        '''
+        Record a completed task and enqueue its follow-up tasks
+        '''
+        if self._sink is not None:
+            self._sink.write(result)
+        if self.checkpoint_file is not None:
+            self._finished_keys.add(result.key)
+        if self._keep_results:
+            self._finished_tasks.append(result)
+        for jsontask in result.next_tasks:
+            self.enqueue_from_json(jsontask)
+        logger.info('Result: {r!r}'.format(r=result))
+
+    def _dequeue(self, count):
+        '''
+        Retrieve up to `count` tasks from the queue, in order of priority
+        '''
+        tasks = []
+        while len(tasks) < count:
+            try:
+                task, waited = self._task_queue.get_timed_nowait()
+            except queue.Empty:
+                break
+            self._metrics.task_dispatched(task, waited)
+            tasks.append(task)
+        return tasks
+
+    def _enqueue_streamed_tasks(self, futures):
+        '''
+        Enqueue the follow-up tasks published by the given tasks while they
+        were running (see `basetask.BaseTask.flush_next_tasks`)
+        '''
+        for jsontask in self._backend.collect_streamed(futures):
+            self.enqueue_from_json(jsontask)
+
+    def _handle_completed(self):
+        '''
+        Collect the results of the completed tasks and enqueue their follow-up
+        tasks
+        '''
+        while True:
+            try:
+                future = self._completed.get_nowait()
+            except queue.Empty:
+                break
+            tasks = self._in_flight.pop(future)
+            if self._backend.cancelled(future):
+                # aborted before starting: the tasks are pending, not failed,
+                # and are saved with the queue in the checkpoint
+                self._streaming.discard(future)
+                if not isinstance(tasks, list):
+                    tasks = [tasks]
+                for task in tasks:
+                    self._task_queue.put_nowait(task)
+                continue
+            if future in self._streaming:
+                self._streaming.discard(future)
+                self._enqueue_streamed_tasks([future])
+            try:
+                result = self._backend.result(future)
+            except Exception as exc:
+                logger.error('Cannot retrieve the result of {t!r}: {e}'.format(
+                    t=tasks,
+                    e=exc,
+                ))
+                result = None
+            if not isinstance(tasks, list):
+                self._task_completed(tasks, result)
+                continue
+            if result is None:
+                result = [None] * len(tasks)
+            for (task, task_result) in zip(tasks, result):
+                self._task_completed(task, task_result)
+
+    def _task_completed(self, task, result):
+        '''
+        Record the result of a task, None meaning that it failed
+        '''
+        self._metrics.task_completed(task, result)
+        if result is not None and result._profile is not None:
+            self._profiles.add(result._name, result._profile)
+            # profiles are not kept with the results
+            result._profile = None
+        if result is not None:
+            self._add_finished(result)
+        if self._dedup is not None:
+            for duplicate in self._dedup.completed(task, result):
+                if result is None and not self._running:
+                    # shutting down, the duplicate is run on resume
+                    self._task_queue.put_nowait(duplicate)
+                elif result is None:
+                    self._submit_task(duplicate)
+                else:
+                    self._add_finished(duplicate)
 
     def run(self):
         self._running = True
@@ -80,93 +1027,85 @@ class Scheduler(threading.Thread):
         # search for available task handlers
         self._tasks = basetask.find_tasks()
 
-        # connect to the ipcluster instance
-        self._connect()
+        # start the execution backend, e.g. connect to the ipcluster instance
+        self._backend = get_backend(self._config)
+        self._backend.start()
+        if self._config.dedup is not None:
+            self._dedup = dedup.Deduplicator(**self._config.dedup)
+        if self._config.known_hashes is not None:
+            algorithms = []
+            if self._dedup is not None:
+                algorithms.append(self._dedup.algorithm)
+            self._known = knownhashes.KnownFileFilter(
+                algorithms=algorithms, **self._config.known_hashes)
+        if self._config.results is not None:
+            settings = self._config.results
+            self._sink = results.open_sink(
+                settings['store'],
+                settings.get('batch_size', results.DEFAULT_SINK_BATCH_SIZE),
+            )
+            self._keep_results = settings.get('keep_in_memory', False)
 
-        lview = self._client.load_balanced_view()
-        pending = set()
-        tasks_to_retry_to_fetch = set()
-        self._start_time = basetask.now()
+        self._start_time = self._resumed_start_time or basetask.now()
         self._end_time = None
+        self._metrics.start()
         while True:
             # stop if requested explicitly
             if not self._running:
-                self._client.abort()
+                self._backend.abort()
                 break
 
-            # wait for completed tasks from the client
-            try:
-                self._client.wait(pending, 1e-1)
-            except parallel.TimeoutError:
-                pass
-
-            # update finished and pending task sets
-            finished = pending.difference(self._client.outstanding)
-            pending = pending.difference(finished)
-
-            # retrieve and start new tasks from the queue
-            new_tasks = []
-            while True:
-                try:
-                    new_tasks.append(self._task_queue.get_nowait())
-                except asyncio.QueueEmpty:
-                    break
-            # sort tasks by task priority
-            priority_tasks, remaining_tasks = [], []
-            for task in new_tasks:
-                if task.__class__.__name__ in self._config.priority:
-                    priority_tasks.append(task)
-                else:
-                    remaining_tasks.append(task)
-            prioritized_tasks = priority_tasks + remaining_tasks
-
-            # add pending tasks to the pending task set used early in this loop
-            amr = lview.map(lambda t: t.start(), prioritized_tasks)
-            if amr:
-                pending = pending.union(set(amr.msg_ids))
-
-            # check if there are tasks to retry to fetch
-            for msg_id in tasks_to_retry_to_fetch:
-                try:
-                    results = self._client.get_result(msg_id).get()
-                except (ipyparallel.error.RemoteError, TypeError):
-                    # will retry later
-                    continue
-                tasks_to_retry_to_fetch.remove(msg_id)
-                # TODO this loop duplicates the code below. Remove duplication
-                for result in results:
-                    self._finished_tasks.append(result)
-                    for jsontask in result.next_tasks:
-                        self.enqueue_from_json(jsontask)
-                    logger.info('Result: {r!r}'.format(r=result))
-
-            # do something with the completed tasks
-            for msg_id in finished:
-                try:
-                    results = self._client.get_result(msg_id).get()
-                except (ipyparallel.error.RemoteError, TypeError):
-                    tasks_to_retry_to_fetch.add(msg_id)
-                    continue
-                # NOTE keep this loop in sync with the loop above until the code
-                # duplication is removed
-                for result in results:
-                    self._finished_tasks.append(result)
-                    for jsontask in result.next_tasks:
-                        self.enqueue_from_json(jsontask)
-                    logger.info('Result: {r!r}'.format(r=result))
+            # sleep until there are new tasks or completions. Tasks streaming
+            # follow-up tasks have to be polled though
+            if self._streaming:
+                timeout = self.STREAM_POLL_INTERVAL
+            else:
+                timeout = self.IDLE_TIMEOUT
+            if not self._wakeup.wait(timeout) and self._sink is not None:
+                # idle, make the finished tasks visible to the store readers
+                self._sink.flush()
+            self._wakeup.clear()
+            loop_start = time.monotonic()
+
+            self._handle_completed()
+            if self._known is not None:
+                self._handle_known_hashed()
+            if self._dedup is not None:
+                self._handle_hashed()
+            if self._streaming:
+                self._enqueue_streamed_tasks(self._streaming)
+            self._submit(self._dequeue(self.max_in_flight - self.in_flight))
+            if self._checkpoint_due():
+                self._save_checkpoint()
+            self._metrics.loop_iteration(time.monotonic() - loop_start)
+            if self._metrics_export_due():
+                self._export_metrics()
 
         self._end_time = basetask.now()
+        # let the tasks still running complete, and collect their results and
+        # profiles before saving anything
+        self._backend.wait()
+        self._handle_completed()
+        if self.checkpoint_file is not None:
+            self._save_checkpoint()
+        if self.metrics_file is not None:
+            self._export_metrics()
+        if self._config.profiling is not None and \
+                self._config.profiling.get('output'):
+            self._profiles.dump(self._config.profiling['output'])
 
-        if self._client is not None:
-            self._client.wait()
-            self.client = None
+        self._backend.stop()
+        if self._known is not None:
+            self._known.stop()
+        if self._dedup is not None:
+            self._dedup.stop()
+        if self._sink is not None:
+            self._sink.close()
         self._running = False
 
     def stop(self):
         self._running = False
-        if self._client is not None:
-            self._client.wait()
-
+        self._wakeup.set()
         self.join()
 
     def wait(self):
@@ -180,6 +1119,13 @@ class Scheduler(threading.Thread):
 
     @property
     def results(self):
+        '''
+        Return the finished tasks as a `results.Results` object. If they are
+        not kept in memory, return the results store opened lazily instead
+        (see `results.StoredResults`).
+        '''
+        if not self._keep_results:
+            return results.Results.open(self._sink.filename)
         start_time = self._start_time
         end_time = self._end_time
         tasks = copy.copy(self._finished_tasks)
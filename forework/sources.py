@@ -0,0 +1,358 @@
+import io
+import mmap
+import bisect
+import zipfile
+import tempfile
+import threading
+import contextlib
+import collections
+
+from . import utils, config
+
+
+logger = utils.get_logger(__name__)
+
+# source type -> function opening a source, see `register_opener`
+_openers = {}
+# Number of zip archives kept open by each thread to read their members, see
+# `_open_zip_member`
+ARCHIVE_CACHE_SIZE = 4
+
+
+def register_opener(source_type, opener):
+    '''
+    Register the function opening the sources of a given type. The function
+    receives the source dict, and returns a readable and seekable binary file
+    object.
+    '''
+    _openers[source_type] = opener
+
+
+def open_source(path, source=None):
+    '''
+    Open the object analyzed by a task, and return a readable and seekable
+    binary file object.
+
+    Objects that are not files of their own (e.g. archive members) are located
+    by a source: a JSON-serializable dict with a 'type' key selecting how to
+    open it, and type-specific keys. Without a source, `path` is opened.
+    '''
+    if source is None:
+        return open(path, 'rb')
+    try:
+        opener = _openers[source['type']]
+    except KeyError:
+        raise Exception('Unsupported source type {t!r} for {p!r}'.format(
+            t=source.get('type'),
+            p=path,
+        ))
+    return opener(source)
+
+
+def spool(fd, max_size=config.SPOOL_SIZE):
+    '''
+    Copy a readable binary file object to a seekable one, kept in memory up to
+    `max_size` bytes and written to a temporary file beyond
+    '''
+    data = fd.read(max_size)
+    more = fd.read(config.HASH_CHUNK_SIZE)
+    if not more:
+        return io.BytesIO(data)
+    spooled = tempfile.TemporaryFile()
+    spooled.write(data)
+    while more:
+        spooled.write(more)
+        more = fd.read(config.HASH_CHUNK_SIZE)
+    spooled.seek(0)
+    return spooled
+
+
+def read_header(path, source=None, size=config.FILE_TYPE_HEADER_SIZE):
+    '''
+    Return the first `size` bytes of the object located by `source`
+    '''
+    with open_source(path, source) as fd:
+        return fd.read(size)
+
+
+def zip_member(archive, member, parent=None, size=None):
+    '''
+    Return the source of a member of a zip archive. `parent` is the source of
+    the archive itself, if it is not a file of its own (e.g. nested archives).
+    '''
+    return {
+        'type': 'zip',
+        'archive': archive,
+        'parent': parent,
+        'member': member,
+        'size': size,
+    }
+
+
+class SliceFile(io.RawIOBase):
+    '''
+    Read-only file object exposing `length` bytes of another seekable file
+    object, starting at `offset`
+    '''
+
+    def __init__(self, fd, offset, length):
+        io.RawIOBase.__init__(self)
+        self._fd = fd
+        self._offset = offset
+        self._length = length
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._length
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._length - self._position)
+        if size <= 0:
+            return 0
+        self._fd.seek(self._offset + self._position)
+        data = self._fd.read(size)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def close(self):
+        self._fd.close()
+        io.RawIOBase.close(self)
+
+
+def byte_range(path, offset, length, parent=None):
+    '''
+    Return the source of `length` bytes at `offset` in a file (e.g. a carved
+    object, or an unallocated region of a disk image). `parent` is the source
+    of the file itself, if it is not a file of its own.
+    '''
+    return {
+        'type': 'slice',
+        'path': path,
+        'parent': parent,
+        'offset': offset,
+        'size': length,
+    }
+
+
+class RunsFile(io.RawIOBase):
+    '''
+    Read-only file object concatenating runs of bytes of another seekable file
+    object, e.g. the fragments of a file in a disk image. Runs are (offset,
+    length) tuples, and runs with a None offset are sparse (zero-filled).
+    '''
+
+    def __init__(self, fd, runs):
+        io.RawIOBase.__init__(self)
+        self._fd = fd
+        self._runs = [(offset, length) for (offset, length) in runs]
+        # position of the first byte of every run in the file
+        self._starts = []
+        self._length = 0
+        for (_, length) in self._runs:
+            self._starts.append(self._length)
+            self._length += length
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._length
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer):
+        if self._position >= self._length:
+            return 0
+        index = bisect.bisect_right(self._starts, self._position) - 1
+        offset, length = self._runs[index]
+        skip = self._position - self._starts[index]
+        size = min(len(buffer), length - skip)
+        if offset is None:
+            buffer[:size] = bytes(size)
+        else:
+            self._fd.seek(offset + skip)
+            data = self._fd.read(size)
+            size = len(data)
+            buffer[:size] = data
+        self._position += size
+        return size
+
+    def close(self):
+        self._fd.close()
+        io.RawIOBase.close(self)
+
+
+def byte_runs(path, runs, parent=None):
+    '''
+    Return the source of a file made of runs of bytes of another file (see
+    `RunsFile`), e.g. a fragmented file in a disk image. A single run is a
+    plain byte range (see `byte_range`). `parent` is the source of the file
+    itself, if it is not a file of its own.
+    '''
+    runs = [list(run) for run in runs]
+    if len(runs) == 1 and runs[0][0] is not None:
+        return byte_range(path, runs[0][0], runs[0][1], parent)
+    return {
+        'type': 'runs',
+        'path': path,
+        'parent': parent,
+        'runs': runs,
+        'size': sum(length for (_, length) in runs),
+    }
+
+
+@contextlib.contextmanager
+def map_source(path, source=None):
+    '''
+    Memory-map the object located by `source`, and yield (data, start, end,
+    make_source): the mapped data, the range of the object in it, and a
+    function returning the source of a byte range of the data, as
+    `make_source(offset, length)`. Byte ranges of files are mapped in the file
+    itself, while objects that are not files of their own are spooled first.
+    Empty and in-memory objects are read as bytes.
+    '''
+    if source is None:
+        fd = open(path, 'rb')
+        start = 0
+        end = fd.seek(0, io.SEEK_END)
+
+        def make_source(offset, length):
+            return byte_range(path, offset, length)
+    elif source['type'] == 'slice' and source.get('parent') is None:
+        fd = open(source['path'], 'rb')
+        start = source['offset']
+        end = start + source['size']
+
+        def make_source(offset, length):
+            return byte_range(source['path'], offset, length)
+    else:
+        with open_source(path, source) as raw:
+            fd = spool(raw)
+        start = 0
+        end = fd.seek(0, io.SEEK_END)
+
+        def make_source(offset, length):
+            return byte_range(path, offset, length, source)
+    with fd:
+        try:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError, io.UnsupportedOperation):
+            fd.seek(0)
+            data = fd.read(end)
+        try:
+            yield (data, start, min(end, len(data)), make_source)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+def _open_byte_range(source):
+    fd = open_source(source['path'], source.get('parent'))
+    return io.BufferedReader(SliceFile(fd, source['offset'], source['size']))
+
+
+def _open_byte_runs(source):
+    fd = open_source(source['path'], source.get('parent'))
+    return io.BufferedReader(RunsFile(fd, source['runs']))
+
+
+class OpenCache(threading.local):
+    '''
+    Cache of the last `size` objects opened to read sources (e.g. zip
+    archives), by key. `close` is called with the objects evicted.
+
+    Each thread has its own cache: sources are read by the hashing threads of
+    the scheduler and the worker threads of the in-memory broker, and an
+    object evicted by a thread must not be closed while another one reads it.
+    '''
+
+    def __init__(self, size, close):
+        self._size = size
+        self._close = close
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, opener):
+        '''
+        Return the object cached for `key`, or open it with `opener()`
+        '''
+        try:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        except KeyError:
+            pass
+        value = self._entries[key] = opener()
+        if len(self._entries) > self._size:
+            self._close(self._entries.popitem(last=False)[1])
+        return value
+
+    def clear(self):
+        '''
+        Close and forget the objects cached by the calling thread
+        '''
+        while self._entries:
+            self._close(self._entries.popitem(last=False)[1])
+
+
+def _open_archive(archive, parent):
+    fd = open_source(archive, parent)
+    try:
+        return (fd, zipfile.ZipFile(fd))
+    except Exception:
+        fd.close()
+        raise
+
+
+def _close_archive(entry):
+    fd, zf = entry
+    zf.close()
+    fd.close()
+
+
+# (archive path, parent source) -> (file object, ZipFile)
+_archives = OpenCache(ARCHIVE_CACHE_SIZE, _close_archive)
+
+
+def _get_archive(archive, parent):
+    return _archives.get((archive, repr(parent)),
+                         lambda: _open_archive(archive, parent))[1]
+
+
+def _open_zip_member(source):
+    '''
+    Open a member of a zip archive. The last archives opened are kept open,
+    so that the members of an archive are read without opening it again, and
+    nested archives are spooled only once.
+    '''
+    zf = _get_archive(source['archive'], source.get('parent'))
+    with zf.open(source['member']) as member:
+        return spool(member)
+
+
+register_opener('slice', _open_byte_range)
+register_opener('runs', _open_byte_runs)
+register_opener('zip', _open_zip_member)
@@ -1,14 +1,191 @@
-import asyncio
+import heapq
+import queue
+import time
+import threading
+import itertools
+import collections
 
-_task_queue = None
 
-def init(maxsize=0):
-    global _task_queue
-    _task_queue = asyncio.Queue(maxsize)
+class PriorityTaskQueue:
+    '''
+    Thread-safe priority queue of tasks.
 
+    Tasks are served in order of:
+      * rank of the task name in the investigation `priority` list (tasks not
+        in the list come last)
+      * the task's own priority (see `basetask.PRIO_*`), highest first
+      * depth in the discovery tree, shallowest first
+    These criteria are folded into a score, lowest first. Tasks age while they
+    wait: every second spent in the queue lowers the score of a task by
+    `aging_rate`, so low-priority tasks are eventually served even when higher
+    priority ones keep coming. Since all the queued tasks age at the same rate,
+    aging is obtained by adding `aging_rate * enqueue_time` to the score, which
+    does not change while the task is queued.
+    '''
+
+    # score weights. Ranks dominate priorities (which range from PRIO_LOW to
+    # PRIO_HIGH), which dominate depths (capped to MAX_DEPTH)
+    RANK_WEIGHT = 1000
+    PRIORITY_WEIGHT = 10
+    DEPTH_WEIGHT = 1
+    MAX_DEPTH = 9
+    # by default, a task waiting for a second gains as much as one level of
+    # depth, and gains one rank in less than 17 minutes
+    DEFAULT_AGING_RATE = 1
+
+    def __init__(self, maxsize=0, priority=None,
+                 aging_rate=DEFAULT_AGING_RATE):
+        self._maxsize = maxsize
+        self._heap = []
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        # tie breaker to keep FIFO order between tasks with the same score
+        self._counter = itertools.count()
+        self._epoch = time.monotonic()
+        self._ranks = {}
+        self._aging_rate = aging_rate
+        # number of queued tasks by priority
+        self._depths = collections.Counter()
+        self.set_priority(priority or [])
+
+    def __len__(self):
+        return self.qsize()
+
+    def __repr__(self):
+        return '<{cls}(tasks={n}, priority={p!r}, aging_rate={a})>'.format(
+            cls=self.__class__.__name__,
+            n=len(self),
+            p=sorted(self._ranks, key=self._ranks.get),
+            a=self._aging_rate,
+        )
+
+    def qsize(self):
+        return len(self._heap)
+
+    def empty(self):
+        return not self._heap
+
+    def full(self):
+        return 0 < self._maxsize <= len(self._heap)
+
+    def _score(self, task, enqueue_time):
+        name = task.__class__.__name__
+        rank = self._ranks.get(name, len(self._ranks))
+        depth = min(getattr(task, '_depth', 0), self.MAX_DEPTH)
+        return (rank * self.RANK_WEIGHT -
+                task._priority * self.PRIORITY_WEIGHT +
+                depth * self.DEPTH_WEIGHT +
+                enqueue_time * self._aging_rate)
+
+    def _rebuild(self):
+        '''
+        Recompute the scores of all the queued tasks. Must be called with the
+        lock held.
+        '''
+        self._heap = [
+            (self._score(task, enqueue_time), seq, enqueue_time, task)
+            for (_, seq, enqueue_time, task) in self._heap
+        ]
+        heapq.heapify(self._heap)
+
+    def put_nowait(self, task):
+        with self._lock:
+            if 0 < self._maxsize <= len(self._heap):
+                raise queue.Full
+            enqueue_time = time.monotonic() - self._epoch
+            heapq.heappush(self._heap, (
+                self._score(task, enqueue_time),
+                next(self._counter),
+                enqueue_time,
+                task,
+            ))
+            self._depths[task._priority] += 1
+            self._not_empty.notify()
+
+    put = put_nowait
+
+    def _pop(self):
+        # must be called with the lock held
+        (_, _, enqueue_time, task) = heapq.heappop(self._heap)
+        self._depths[task._priority] -= 1
+        return task, time.monotonic() - self._epoch - enqueue_time
+
+    def get_nowait(self):
+        '''
+        Remove and return the task with the highest priority, or raise
+        `queue.Empty`
+        '''
+        return self.get_timed_nowait()[0]
+
+    def get_timed_nowait(self):
+        '''
+        Like `get_nowait`, but return a (task, seconds spent in the queue)
+        tuple
+        '''
+        with self._lock:
+            if not self._heap:
+                raise queue.Empty
+            return self._pop()
+
+    def get(self, timeout=None):
+        '''
+        Remove and return the task with the highest priority, waiting up to
+        `timeout` seconds (or forever if None) for one to be available
+        '''
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._heap, timeout):
+                raise queue.Empty
+            return self._pop()[0]
+
+    def set_priority(self, task_names):
+        '''
+        Set the list of task names to prioritize, in order of importance, and
+        reorder the queued tasks accordingly
+        '''
+        with self._lock:
+            self._ranks = {name: rank for (rank, name) in
+                           enumerate(task_names)}
+            self._rebuild()
+
+    def set_aging_rate(self, aging_rate):
+        '''
+        Set how much the score of a task is lowered for every second spent in
+        the queue. 0 disables aging.
+        '''
+        with self._lock:
+            self._aging_rate = aging_rate
+            self._rebuild()
+
+    def reprioritize(self, task_name, priority):
+        '''
+        Change the priority of all the queued tasks with the given name.
+        Return the number of tasks affected.
+        '''
+        count = 0
+        with self._lock:
+            for (_, _, _, task) in self._heap:
+                if task.__class__.__name__ == task_name:
+                    self._depths[task._priority] -= 1
+                    self._depths[priority] += 1
+                    task._priority = priority
+                    count += 1
+            if count:
+                self._rebuild()
+        return count
+
+    def depths(self):
+        '''
+        Return the number of queued tasks by priority (see `basetask.PRIO_*`)
+        '''
+        with self._lock:
+            return {priority: count for (priority, count)
+                    in self._depths.items() if count}
+
+    def snapshot(self):
+        '''
+        Return the list of queued tasks in the order they would be served,
+        without removing them
+        '''
+        with self._lock:
+            return [item[-1] for item in sorted(self._heap)]
 
-def get():
-    global _task_queue
-    if _task_queue is None:
-        init()
-    return _task_queue
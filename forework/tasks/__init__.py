@@ -6,4 +6,6 @@ __all__ = [
     'jpeg',
     'pdf',
     'zip',
+    'carver',
+    'entropy',
 ]
@@ -0,0 +1,239 @@
+import re
+import struct
+import collections
+
+from ..basetask import BaseTask, find_tasks_by_filetype
+from .. import utils, config, sources
+
+
+logger = utils.get_logger(__name__)
+
+Signature = collections.namedtuple(
+    'Signature', ['magic', 'header', 'footer', 'footer_extra', 'max_size'])
+
+# Signatures of the carved file types: literal first bytes, regular expression
+# matching the whole header, footer (None if unknown), number of bytes
+# following the footer, and maximum size of a carved object
+SIGNATURES = collections.OrderedDict([
+    ('jpeg', Signature(b'\xff\xd8\xff', b'\xff\xd8\xff[\xc0-\xfe]', b'\xff\xd9',
+                       0, 32 * 1024 ** 2)),
+    ('png', Signature(b'\x89PNG', b'\x89PNG\r\n\x1a\n', b'IEND\xaeB`\x82', 0,
+                      32 * 1024 ** 2)),
+    ('gif', Signature(b'GIF8', b'GIF8[79]a', b'\x00\x3b', 0, 16 * 1024 ** 2)),
+    ('pdf', Signature(b'%PDF-', b'%PDF-1\\.[0-9]', b'%%EOF', 0,
+                      128 * 1024 ** 2)),
+    # the end of central directory record is followed by a comment, see
+    # `Carver._footer_end`
+    ('zip', Signature(b'PK\x03\x04', b'PK\x03\x04', b'PK\x05\x06', 18,
+                      512 * 1024 ** 2)),
+])
+
+
+def compile_signatures(names=None):
+    '''
+    Return the (name, signature, compiled header) of the given signatures (by
+    default all of them)
+    '''
+    if names is None:
+        names = list(SIGNATURES)
+    return [
+        (name, SIGNATURES[name], re.compile(SIGNATURES[name].header))
+        for name in names
+    ]
+
+
+def find_header(data, signatures, candidates, position, end):
+    '''
+    Return the (name, offset) of the first header found in
+    `data[position:end]`, or None. The magic bytes of every signature are
+    searched with `find`, which runs at memory speed, and `candidates` keeps
+    the next occurrence of each between calls, so the data is read once per
+    signature and never looped over in Python. Candidates are then checked
+    against the full header.
+    '''
+    while True:
+        best = None
+        for (index, (name, signature, _)) in enumerate(signatures):
+            offset = candidates.get(name)
+            if offset is None or 0 <= offset < position:
+                # -1 means that there are no more occurrences
+                offset = candidates[name] = data.find(
+                    signature.magic, position, end)
+            if offset >= 0 and (best is None or offset < best[0]):
+                best = (offset, index)
+        if best is None:
+            return None
+        offset, index = best
+        name, _, header = signatures[index]
+        if header.match(data, offset, end) is not None:
+            return (name, offset)
+        position = offset + 1
+
+
+# JPEG markers standing alone, without a segment length: TEM, RST0-7 and SOI
+JPEG_STANDALONE_MARKERS = frozenset([0x01] + list(range(0xd0, 0xd9)))
+JPEG_EOI = 0xd9
+JPEG_SOS = 0xda
+# end of the entropy-coded data of a scan: the first 0xff that is not followed
+# by 0x00 (stuffing), RST0-7 or another 0xff (fill)
+_jpeg_scan_end = re.compile(b'\xff[^\x00\xd0-\xd7\xff]')
+
+
+def find_jpeg_footer(data, offset, limit):
+    '''
+    Return the offset of the EOI marker of the JPEG file starting at `offset`,
+    or -1 if its structure is broken. The segments are skipped by their
+    length, and the entropy-coded data of every scan is searched for the next
+    marker, so that the EOI of an embedded thumbnail (e.g. in the EXIF APP1
+    segment) is not mistaken for the end of the file.
+    '''
+    position = offset + 2
+    while position + 4 <= limit:
+        if data[position] != 0xff:
+            return -1
+        marker = data[position + 1]
+        if marker == 0xff:
+            # fill byte
+            position += 1
+            continue
+        if marker == JPEG_EOI:
+            return position
+        if marker in JPEG_STANDALONE_MARKERS:
+            position += 2
+            continue
+        length = struct.unpack('>H', data[position + 2:position + 4])[0]
+        if length < 2:
+            return -1
+        position += 2 + length
+        if marker == JPEG_SOS:
+            match = _jpeg_scan_end.search(data, position, limit)
+            if match is None:
+                return -1
+            position = match.start()
+    if position + 2 <= limit and data[position:position + 2] == b'\xff\xd9':
+        return position
+    return -1
+
+
+def find_footer(data, name, offset, header_end, limit):
+    '''
+    Return the offset of the footer of the object of type `name` starting at
+    `offset`, searched in `data[header_end:limit]`, or -1. JPEG files are
+    walked segment by segment (see `find_jpeg_footer`), falling back to the
+    first footer if their structure is broken. PDF files end at their last
+    footer before the next PDF header, since incremental updates append
+    content after the first one.
+    '''
+    footer = SIGNATURES[name].footer
+    if name == 'jpeg':
+        found = find_jpeg_footer(data, offset, limit)
+        if found >= 0:
+            return found
+    elif name == 'pdf':
+        next_header = data.find(SIGNATURES[name].magic, header_end, limit)
+        if next_header >= 0:
+            limit = next_header
+        return data.rfind(footer, header_end, limit)
+    return data.find(footer, header_end, limit)
+
+
+class Carver(BaseTask):
+    '''
+    Task to carve objects out of raw data, such as disk images or their
+    unallocated regions, by searching header and footer signatures (see
+    SIGNATURES).
+
+    The data is memory-mapped and searched for the headers and footers with
+    `find` (see `find_header` and `find_footer`), so the search never loops
+    over bytes in Python. The carved objects are not copied out: they are identified from
+    their first bytes and dispatched with byte range sources (see
+    `sources.byte_range`). An object whose footer was found is carved
+    entirely, and the search resumes after it. Otherwise it is carved up to
+    the maximum size of its type, and the search resumes after its header.
+
+    Carver is not selected by file type, it must be requested by name (see
+    also the `carve` option of Image). Supported configuration:
+        signatures: names of the signatures to search (default: all)
+        batch_size: number of follow-up tasks to collect before handing them to
+                    the scheduler
+    '''
+
+    __slots__ = ()
+
+    MAGIC_PATTERN = '.*'
+    DISPATCHABLE = False
+    MODIFIERS = [
+        'signatures',
+        'batch_size',
+    ]
+    STREAMS_NEXT_TASKS = True
+    DEFAULT_BATCH_SIZE = 1000
+
+    def __init__(self, path, *args, **kwargs):
+        BaseTask.__init__(self, path, *args, **kwargs)
+
+    def run(self):
+        conf = self.conf or {}
+        self._result = self._carve(
+            compile_signatures(conf.get('signatures')),
+            conf.get('batch_size', self.DEFAULT_BATCH_SIZE),
+        )
+
+    @staticmethod
+    def _footer_end(data, name, footer_start, limit):
+        signature = SIGNATURES[name]
+        end = footer_start + len(signature.footer) + signature.footer_extra
+        if name == 'zip' and end <= limit:
+            # the end of central directory record ends with a comment
+            end += struct.unpack('<H', data[end - 2:end])[0]
+        return min(end, limit)
+
+    def _carve(self, signatures, batch_size):
+        counts = collections.Counter()
+        unknown = 0
+        with sources.map_source(self._path, self._source) as mapped:
+            data, start, end, make_source = mapped
+            position = start
+            candidates = {}
+            while True:
+                found = find_header(data, signatures, candidates, position,
+                                    end)
+                if found is None:
+                    break
+                name, offset = found
+                signature = SIGNATURES[name]
+                header_end = offset + len(signature.magic)
+                limit = min(end, offset + signature.max_size)
+                footer = find_footer(data, name, offset, header_end, limit)
+                if footer >= 0:
+                    length = self._footer_end(data, name, footer, limit) - \
+                        offset
+                    position = offset + length
+                else:
+                    length = limit - offset
+                    position = header_end
+                header = data[offset:offset + min(
+                    length, config.FILE_TYPE_HEADER_SIZE)]
+                filetype = utils.get_buffer_type(header)
+                tasknames = find_tasks_by_filetype(filetype)
+                if len(tasknames) < 1:
+                    unknown += 1
+                    continue
+                counts[name] += 1
+                self.add_next_task({
+                    'name': tasknames,
+                    'path': '{p}@{o}'.format(p=self._path, o=offset - start),
+                    'filetype': filetype,
+                    'source': make_source(offset, length),
+                })
+                if len(self._next_tasks) >= batch_size:
+                    self.flush_next_tasks()
+        self.flush_next_tasks()
+        logger.info('Carved {n} objects from {p!r}'.format(
+            n=sum(counts.values()),
+            p=self._path,
+        ))
+        return {
+            'carved': dict(counts),
+            'unknown': unknown,
+        }
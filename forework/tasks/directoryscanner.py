@@ -8,37 +8,97 @@ logger = utils.get_logger(__name__)
 
 
 class DirectoryScanner(BaseTask):
+    '''
+    Task to scan a directory and schedule a follow-up task for every entry.
+
+    The directory is read with `os.scandir`, and the follow-up tasks are handed
+    to the scheduler in batches while the scan is still running. Supported
+    configuration:
+        recursive: if true, walk the subdirectories within this task instead of
+                   scheduling a new DirectoryScanner for each of them
+        batch_size: number of follow-up tasks to collect before handing them to
+                    the scheduler (default: 1000)
+    '''
+
+    __slots__ = ()
 
     MAGIC_PATTERN = 'directory'
+    MODIFIERS = [
+        'recursive',
+        'batch_size',
+    ]
+    DEFAULT_BATCH_SIZE = 1000
+    STREAMS_NEXT_TASKS = True
 
     def __init__(self, path, *args, **kwargs):
-        BaseTask.__init__(self, path, args, kwargs)
+        BaseTask.__init__(self, path, *args, **kwargs)
+
+    def _get_file_type(self, entry):
+        '''
+        Identify a directory entry, using the type information cached in the
+        `os.DirEntry` and calling libmagic only for regular files
+        '''
+        if entry.is_symlink():
+            return 'symbolic link'
+        if entry.is_dir():
+            return 'directory'
+        return utils.get_file_type(
+            entry.path,
+            stat_result=entry.stat(follow_symlinks=False),
+        )
 
     def run(self):
-        logger.info('Scanning directory point {mp}'.format(mp=self._path))
-        # FIXME listdir can be put in trouble with directories with a large
-        # number of files. Use a proper streaming scheduler and yield the files
-        # while they are found
-        for dirent in os.listdir(self._path):
-            path = os.path.join(self._path, dirent)
+        conf = self.conf or {}
+        recursive = conf.get('recursive', False)
+        batch_size = conf.get('batch_size', self.DEFAULT_BATCH_SIZE)
+        logger.info('Scanning directory point {mp}{r}'.format(
+            mp=self._path,
+            r=' recursively' if recursive else '',
+        ))
+        unknown = 0
+        directories = [self._path]
+        while directories:
+            directory = directories.pop()
             try:
-                filetype = utils.get_file_type(path)
-            except FileNotFoundError as exc:
-                msg = 'The file {f!r} cannot be read, skipping'.format(f=path)
+                entries = os.scandir(directory)
+            except OSError as exc:
+                msg = 'The directory {d!r} cannot be read, skipping'.format(
+                    d=directory,
+                )
                 self.add_warning(msg)
-                logger.warning(msg)
                 logger.exception(exc)
                 continue
-            tasknames = find_tasks_by_filetype(filetype)
-            if len(tasknames) < 1:
-                msg = 'Cannot find a task for {fn}'.format(fn=path)
-                self.add_warning(msg)
-                continue
-            self.add_next_task({
-                'name': tasknames,
-                'path': path,
-            })
+            with entries:
+                for entry in entries:
+                    try:
+                        if recursive and entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                            continue
+                        filetype = self._get_file_type(entry)
+                    except OSError as exc:
+                        msg = 'The file {f!r} cannot be read, skipping'.format(
+                            f=entry.path,
+                        )
+                        self.add_warning(msg)
+                        logger.exception(exc)
+                        continue
+                    tasknames = find_tasks_by_filetype(filetype)
+                    if len(tasknames) < 1:
+                        msg = 'Cannot find a task for {fn}'.format(
+                            fn=entry.path,
+                        )
+                        self.add_warning(msg)
+                        unknown += 1
+                        continue
+                    self.add_next_task({
+                        'name': tasknames,
+                        'path': entry.path,
+                        'filetype': filetype,
+                    })
+                    if len(self._next_tasks) >= batch_size:
+                        self.flush_next_tasks()
+        self.flush_next_tasks()
         self._result = 'Found {tn} tasks, and {uf} unknown file types'.format(
-            tn=len(self._next_tasks),
-            uf=len(self._warnings),
+            tn=self._emitted + len(self._next_tasks),
+            uf=unknown,
         )
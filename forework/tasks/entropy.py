@@ -0,0 +1,183 @@
+import base64
+
+import numpy
+
+from ..basetask import BaseTask, PRIO_HIGH
+from .. import utils, sources
+
+
+logger = utils.get_logger(__name__)
+
+# Number of bytes whose histograms are computed by a single numpy call. The
+# histograms of at most 256 blocks are computed together, so that the bins
+# fit 16-bit indices, and the working set fits the CPU caches
+CHUNK_SIZE = 256 * 1024
+# Entropy profiles are stored with one byte per block, in steps of 1/32 bit
+PROFILE_SCALE = 32
+
+
+def block_entropy(data, block_size, start=0, end=None):
+    '''
+    Return the Shannon entropy, in bits per byte, of the consecutive blocks
+    of `block_size` bytes of `data[start:end]` (the last block may be
+    shorter), as a numpy array. `data` is any object supporting the buffer
+    protocol, e.g. a memory map: it is viewed as an array of bytes, and the
+    byte histograms of the blocks are computed by `numpy.bincount` without
+    looping in Python over the bytes.
+    '''
+    array = numpy.frombuffer(data, dtype=numpy.uint8)
+    if end is None:
+        end = len(array)
+    chunk_blocks = max(1, min(256, CHUNK_SIZE // block_size))
+    chunk_size = chunk_blocks * block_size
+    # entropy = log2(n) - sum(c * log2(c)) / n, for the byte counts c of the
+    # blocks of n bytes. c * log2(c) is looked up in a table
+    table = numpy.zeros(block_size + 1)
+    counts = numpy.arange(1, block_size + 1)
+    table[1:] = counts * numpy.log2(counts)
+    # bin offsets of the blocks of a chunk, so that the histograms of all the
+    # blocks are computed by a single bincount
+    bins = (numpy.arange(chunk_blocks, dtype=numpy.uint16) * 256)[:, None]
+    full_end = start + (end - start) // block_size * block_size
+    entropy = numpy.empty(-(-(end - start) // block_size))
+    index = 0
+    for offset in range(start, full_end, chunk_size):
+        blocks = array[offset:min(offset + chunk_size, full_end)].reshape(
+            -1, block_size)
+        count = len(blocks)
+        indices = blocks.astype(numpy.uint16)
+        indices += bins[:count]
+        histograms = numpy.bincount(
+            indices.ravel(), minlength=count * 256).reshape(count, 256)
+        entropy[index:index + count] = numpy.log2(block_size) - \
+            table[histograms].sum(axis=1) / block_size
+        index += count
+    if full_end < end:
+        size = end - full_end
+        histogram = numpy.bincount(array[full_end:end], minlength=256)
+        entropy[index] = numpy.log2(size) - table[histogram].sum() / size
+    return entropy
+
+
+def encode_profile(entropy):
+    '''
+    Encode an array of block entropies as a compact string, with one byte per
+    block (see `decode_profile`)
+    '''
+    quantized = numpy.minimum(
+        numpy.rint(entropy * PROFILE_SCALE), 255).astype(numpy.uint8)
+    return base64.b64encode(quantized.tobytes()).decode('ascii')
+
+
+def decode_profile(profile):
+    '''
+    Decode an entropy profile returned by `encode_profile` to an array of
+    block entropies, to the nearest 1/32 bit
+    '''
+    quantized = numpy.frombuffer(base64.b64decode(profile), dtype=numpy.uint8)
+    return quantized / PROFILE_SCALE
+
+
+def find_regions(entropy, threshold, min_blocks):
+    '''
+    Return the (first block, number of blocks) of the runs of at least
+    `min_blocks` consecutive blocks whose entropy is at least `threshold`
+    '''
+    high = numpy.concatenate(
+        ([False], numpy.asarray(entropy) >= threshold, [False]))
+    edges = numpy.flatnonzero(high[1:] != high[:-1])
+    starts, ends = edges[::2], edges[1::2]
+    return [
+        (int(first), int(last - first))
+        for (first, last) in zip(starts, ends)
+        if last - first >= min_blocks
+    ]
+
+
+class Entropy(BaseTask):
+    '''
+    Task to compute the entropy profile of raw data, such as disk images, and
+    find the high-entropy regions, which are typical of encrypted containers
+    and compressed data.
+
+    The data is memory-mapped and the Shannon entropy of each block is
+    computed with numpy (see `block_entropy`). The results hold the profile
+    encoded with one byte per block (see `decode_profile`) and the high-entropy
+    regions, which are also scheduled with high priority for the tasks listed
+    in `region_tasks`, reading them as byte ranges (see `sources.byte_range`).
+
+    Entropy is not selected by file type, it must be requested by name.
+    Supported configuration:
+        block_size: size of the blocks, in bytes (default: 4096)
+        threshold: minimum entropy of the high-entropy blocks, in bits per
+                   byte (default: 7.8)
+        min_region_size: minimum size of the high-entropy regions, in bytes
+                         (default: 1MB)
+        region_tasks: names of the tasks to run on the high-entropy regions
+                      (default: Carver), or an empty list for none
+        batch_size: number of follow-up tasks to collect before handing them to
+                    the scheduler
+    '''
+
+    __slots__ = ()
+
+    MAGIC_PATTERN = '.*'
+    DISPATCHABLE = False
+    MODIFIERS = [
+        'block_size',
+        'threshold',
+        'min_region_size',
+        'region_tasks',
+        'batch_size',
+    ]
+    STREAMS_NEXT_TASKS = True
+    DEFAULT_BLOCK_SIZE = 4096
+    DEFAULT_THRESHOLD = 7.8
+    DEFAULT_MIN_REGION_SIZE = 1024 * 1024
+    DEFAULT_REGION_TASKS = ['Carver']
+    DEFAULT_BATCH_SIZE = 1000
+
+    def __init__(self, path, *args, **kwargs):
+        BaseTask.__init__(self, path, *args, **kwargs)
+
+    def run(self):
+        conf = self.conf or {}
+        block_size = conf.get('block_size', self.DEFAULT_BLOCK_SIZE)
+        threshold = conf.get('threshold', self.DEFAULT_THRESHOLD)
+        min_blocks = max(1, -(-conf.get('min_region_size',
+                                        self.DEFAULT_MIN_REGION_SIZE) //
+                              block_size))
+        region_tasks = conf.get('region_tasks', self.DEFAULT_REGION_TASKS)
+        batch_size = conf.get('batch_size', self.DEFAULT_BATCH_SIZE)
+        regions = []
+        with sources.map_source(self._path, self._source) as mapped:
+            data, start, end, make_source = mapped
+            entropy = block_entropy(data, block_size, start, end)
+            for (first, count) in find_regions(entropy, threshold,
+                                               min_blocks):
+                offset = first * block_size
+                length = min(count * block_size, end - start - offset)
+                regions.append([offset, length])
+                if not region_tasks:
+                    continue
+                self.add_next_task({
+                    'name': list(region_tasks),
+                    'path': '{p}@{o}+{n}'.format(p=self._path, o=offset,
+                                                 n=length),
+                    'priority': PRIO_HIGH,
+                    'source': make_source(start + offset, length),
+                })
+                if len(self._next_tasks) >= batch_size:
+                    self.flush_next_tasks()
+        self.flush_next_tasks()
+        logger.info('Found {n} high-entropy regions in {p!r}'.format(
+            n=len(regions),
+            p=self._path,
+        ))
+        self._result = {
+            'block_size': block_size,
+            'blocks': len(entropy),
+            'mean': float(entropy.mean()) if len(entropy) else None,
+            'profile': encode_profile(entropy),
+            'regions': regions,
+        }
@@ -1,23 +1,188 @@
+import io
+
+import pytsk3
 import imagemounter
 
 from ..basetask import BaseTask, find_tasks_by_filetype
-from .. import utils
+from .. import utils, config, sources
 
 
 logger = utils.get_logger(__name__)
 
+# Number of file systems kept open by each thread to read the files found in
+# them, see `open_tsk_file`
+FILESYSTEM_CACHE_SIZE = 4
+
+
+class FileObjectImage(pytsk3.Img_Info):
+    '''
+    Disk image read from a file object, for the images that are not files of
+    their own (see `sources`)
+    '''
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._size = fd.seek(0, io.SEEK_END)
+        pytsk3.Img_Info.__init__(self, url='',
+                                 type=pytsk3.TSK_IMG_TYPE_EXTERNAL)
+
+    def read(self, offset, size):
+        self._fd.seek(offset)
+        return self._fd.read(size)
+
+    def get_size(self):
+        return self._size
+
+    def close(self):
+        self._fd.close()
+
+
+def open_image(path, source=None):
+    '''
+    Open a disk image with pytsk3
+    '''
+    if source is None:
+        return pytsk3.Img_Info(path)
+    return FileObjectImage(sources.open_source(path, source))
+
+
+def _open_filesystem(image, parent, offset):
+    img = open_image(image, parent)
+    try:
+        return (img, pytsk3.FS_Info(img, offset=offset))
+    except Exception:
+        img.close()
+        raise
+
+
+# (image path, parent source, offset) -> (image, file system), per thread (see
+# `sources.OpenCache`)
+_filesystems = sources.OpenCache(FILESYSTEM_CACHE_SIZE,
+                                 lambda entry: entry[0].close())
+
+
+def _get_filesystem(image, parent, offset):
+    return _filesystems.get((image, repr(parent), offset),
+                            lambda: _open_filesystem(image, parent, offset))[1]
+
+
+class TskFile(io.RawIOBase):
+    '''
+    Read-only file object reading the content of a file from a file system
+    opened with pytsk3
+    '''
+
+    def __init__(self, tsk_file):
+        io.RawIOBase.__init__(self)
+        self._file = tsk_file
+        self._size = tsk_file.info.meta.size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._size - self._position)
+        if size <= 0:
+            return 0
+        data = self._file.read_random(self._position, size)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+def tsk_file(image, offset, inode, parent=None, size=None):
+    '''
+    Return the source of a file in a file system of a disk image, located by
+    the byte offset of the file system and the file's inode. `parent` is the
+    source of the image itself, if it is not a file of its own.
+    '''
+    return {
+        'type': 'tsk',
+        'image': image,
+        'parent': parent,
+        'offset': offset,
+        'inode': inode,
+        'size': size,
+    }
+
+
+def open_tsk_file(source):
+    '''
+    Open a file of a disk image, reading its content directly from the image.
+    The last file systems opened are kept open, so that the files of a file
+    system are read without opening it again.
+    '''
+    filesystem = _get_filesystem(source['image'], source.get('parent'),
+                                 source['offset'])
+    tsk = filesystem.open_meta(inode=source['inode'])
+    return io.BufferedReader(TskFile(tsk))
+
+
+sources.register_opener('tsk', open_tsk_file)
+
 
 class Image(BaseTask):
     '''
     Task to handle MBR objects
+
+    Supported configuration:
+        mode: 'mount' (the default) to mount the volumes with imagemounter and
+              scan them, or 'tsk' to walk the file systems with pytsk3, which
+              requires no mounts nor privileges
+        deleted: in tsk mode, if true, analyze the unallocated files too
+        carve: in tsk mode, if true, carve the unallocated regions of the
+               partition table with the Carver task
+        batch_size: in tsk mode, number of follow-up tasks to collect before
+                    handing them to the scheduler
+
+    In tsk mode, an image with a partition table schedules an Image task for
+    every partition, at the partition's byte offset, so that partitions are
+    walked in parallel. The files found get virtual paths made of the path of
+    the image, the offset of their file system and their path in it, and are
+    read directly from the image (see `tsk_file`).
     '''
 
+    __slots__ = ()
+
     MAGIC_PATTERN = (
         '^DOS/MBR boot sector.*|'
         '^EWF/Expert Witness/EnCase image file format$'
     )
+    MODIFIERS = [
+        'mode',
+        'deleted',
+        'carve',
+        'batch_size',
+    ]
+    STREAMS_NEXT_TASKS = True
+    DEFAULT_BATCH_SIZE = 1000
 
     def run(self):
+        conf = self.conf or {}
+        if conf.get('mode', 'mount') == 'tsk':
+            self._result = self._run_tsk(conf)
+        else:
+            self._result = self._run_mount()
+
+    def _run_mount(self):
+        if self._source is not None:
+            raise Exception('Cannot mount image {p!r}, it is not a file'
+                            .format(p=self._path))
         logger.info('Parsing image {p}, ignoring offset'.format(p=self._path))
         image = imagemounter.ImageParser([self._path], volume_detector='parted')
         try:
@@ -49,7 +214,122 @@ class Image(BaseTask):
             })
             valid_volumes.append(volume)
         # NOTE do not unmount the volumes or the next tasks will fail
-        self._result = 'Volumes: {vv} valid, {iv} skipped'.format(
+        return 'Volumes: {vv} valid, {iv} skipped'.format(
             vv=len(valid_volumes),
             iv=len(skipped_volumes),
         )
+
+    def _run_tsk(self, conf):
+        img = open_image(self._path, self._source)
+        try:
+            if self._offset == 0:
+                partitions, unallocated = self._find_partitions(img)
+                if partitions:
+                    for offset in partitions:
+                        self.add_next_task({
+                            'name': [self._name],
+                            'path': self._path,
+                            'offset': offset,
+                            'filetype': self._filetype,
+                            'source': self._source,
+                        })
+                    if conf.get('carve', False):
+                        for (offset, length) in unallocated:
+                            self.add_next_task({
+                                'name': ['Carver'],
+                                'path': '{p}@{o}+{n}'.format(
+                                    p=self._path, o=offset, n=length),
+                                'source': sources.byte_range(
+                                    self._path, offset, length, self._source),
+                            })
+                    return 'Partitions: {n} found'.format(n=len(partitions))
+            filesystem = pytsk3.FS_Info(img, offset=self._offset)
+            return self._walk(filesystem, conf)
+        finally:
+            img.close()
+
+    def _find_partitions(self, img):
+        '''
+        Return the byte offsets of the allocated partitions of an image, and
+        the (offset, length) of its unallocated regions, or empty lists if it
+        has no partition table
+        '''
+        try:
+            volume = pytsk3.Volume_Info(img)
+        except IOError:
+            return [], []
+        block_size = volume.info.block_size
+        partitions = []
+        unallocated = []
+        for partition in volume:
+            if partition.flags == pytsk3.TSK_VS_PART_FLAG_ALLOC:
+                partitions.append(partition.start * block_size)
+            elif partition.flags == pytsk3.TSK_VS_PART_FLAG_UNALLOC and \
+                    partition.len > 0:
+                unallocated.append((partition.start * block_size,
+                                    partition.len * block_size))
+        return partitions, unallocated
+
+    def _walk(self, filesystem, conf):
+        deleted = conf.get('deleted', False)
+        batch_size = conf.get('batch_size', self.DEFAULT_BATCH_SIZE)
+        prefix = '{p}@{o}'.format(p=self._path, o=self._offset)
+        unknown = 0
+        root = filesystem.open_dir(path='/')
+        visited = {root.info.fs_file.meta.addr}
+        directories = [('', root)]
+        while directories:
+            dirpath, directory = directories.pop()
+            for entry in directory:
+                name = entry.info.name.name
+                meta = entry.info.meta
+                if name in (b'.', b'..') or meta is None:
+                    continue
+                if not deleted and (
+                        meta.flags & pytsk3.TSK_FS_META_FLAG_UNALLOC or
+                        entry.info.name.flags &
+                        pytsk3.TSK_FS_NAME_FLAG_UNALLOC):
+                    continue
+                path = '{d}/{n}'.format(
+                    d=dirpath,
+                    n=name.decode('utf-8', 'replace'),
+                )
+                if meta.type == pytsk3.TSK_FS_META_TYPE_DIR:
+                    if meta.addr not in visited:
+                        visited.add(meta.addr)
+                        try:
+                            directories.append((path, entry.as_directory()))
+                        except IOError as exc:
+                            self.add_warning('The directory {d!r} cannot be '
+                                             'read, skipping: {e}'.format(
+                                                 d=prefix + path, e=exc))
+                    continue
+                if meta.type != pytsk3.TSK_FS_META_TYPE_REG or meta.size == 0:
+                    continue
+                try:
+                    header = entry.read_random(
+                        0, min(meta.size, config.FILE_TYPE_HEADER_SIZE))
+                except IOError as exc:
+                    self.add_warning('The file {f!r} cannot be read, '
+                                     'skipping: {e}'.format(f=prefix + path,
+                                                            e=exc))
+                    continue
+                filetype = utils.get_buffer_type(header)
+                tasknames = find_tasks_by_filetype(filetype)
+                if len(tasknames) < 1:
+                    unknown += 1
+                    continue
+                self.add_next_task({
+                    'name': tasknames,
+                    'path': prefix + path,
+                    'filetype': filetype,
+                    'source': tsk_file(self._path, self._offset, meta.addr,
+                                       self._source, meta.size),
+                })
+                if len(self._next_tasks) >= batch_size:
+                    self.flush_next_tasks()
+        self.flush_next_tasks()
+        return 'Found {tn} tasks, and {uf} unknown file types'.format(
+            tn=self._emitted + len(self._next_tasks),
+            uf=unknown,
+        )
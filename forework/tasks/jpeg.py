@@ -1,4 +1,7 @@
-import PIL.Image
+import struct
+import binascii
+
+import PIL.ExifTags
 
 from ..basetask import BaseTask
 from .. import utils
@@ -6,29 +9,296 @@ from .. import utils
 
 logger = utils.get_logger(__name__)
 
+# JPEG markers
+SOI = 0xd8
+EOI = 0xd9
+SOS = 0xda
+APP1 = 0xe1
+APP13 = 0xed
+COM = 0xfe
+# markers without a length nor data: TEM and RST0 to RST7
+STANDALONE_MARKERS = {0x01} | set(range(0xd0, 0xd8))
+EXIF_HEADER = b'Exif\0\0'
+PHOTOSHOP_HEADER = b'Photoshop 3.0\0'
+IPTC_RESOURCE_ID = 0x0404
+
+# TIFF field types: (struct format, size)
+TIFF_TYPES = {
+    1: ('B', 1),    # BYTE
+    2: ('s', 1),    # ASCII
+    3: ('H', 2),    # SHORT
+    4: ('I', 4),    # LONG
+    5: ('II', 8),   # RATIONAL
+    6: ('b', 1),    # SBYTE
+    7: ('s', 1),    # UNDEFINED
+    8: ('h', 2),    # SSHORT
+    9: ('i', 4),    # SLONG
+    10: ('ii', 8),  # SRATIONAL
+    11: ('f', 4),   # FLOAT
+    12: ('d', 8),   # DOUBLE
+}
+EXIF_IFD_TAG = 0x8769
+GPS_IFD_TAG = 0x8825
+# tags not worth reporting: pointers to other IFDs, and vendor blobs
+SKIPPED_TAGS = {EXIF_IFD_TAG, GPS_IFD_TAG, 0xa005, 0x927c, 0x02bc}
+# Maximum size of the binary values reported, as hex strings
+MAX_BINARY_SIZE = 64
+
+# IPTC IIM datasets of the application record (2)
+IPTC_TAGS = {
+    5: 'ObjectName',
+    25: 'Keywords',
+    55: 'DateCreated',
+    60: 'TimeCreated',
+    80: 'By-line',
+    85: 'By-lineTitle',
+    90: 'City',
+    95: 'Province-State',
+    101: 'Country',
+    105: 'Headline',
+    110: 'Credit',
+    115: 'Source',
+    116: 'CopyrightNotice',
+    120: 'Caption-Abstract',
+    122: 'Writer-Editor',
+}
+IPTC_REPEATABLE = {'Keywords', 'By-line'}
+
+
+def read_segments(fd, markers=(APP1, APP13, COM)):
+    '''
+    Read the segments of a JPEG file up to the first scan (SOS), so that the
+    image data is never read. Yield (marker, data) tuples for the segments
+    with the given markers, and skip the others.
+    '''
+    if fd.read(2) != b'\xff\xd8':
+        raise Exception('Not a JPEG file')
+    while True:
+        byte = fd.read(1)
+        if not byte:
+            return
+        if byte != b'\xff':
+            raise Exception('Invalid JPEG marker at offset {o}'.format(
+                o=fd.tell() - 1,
+            ))
+        # markers may be preceded by fill bytes
+        while byte == b'\xff':
+            byte = fd.read(1)
+        if not byte:
+            return
+        marker = byte[0]
+        if marker in (SOS, EOI):
+            return
+        if marker in STANDALONE_MARKERS:
+            continue
+        header = fd.read(2)
+        if len(header) < 2:
+            return
+        length = struct.unpack('>H', header)[0] - 2
+        if marker in markers:
+            yield (marker, fd.read(length))
+        else:
+            fd.seek(length, 1)
+
+
+def _decode_value(field_type, count, raw, endian):
+    fmt, size = TIFF_TYPES[field_type]
+    if field_type == 2:
+        return raw.split(b'\0', 1)[0].decode('utf-8', 'replace').strip()
+    if field_type == 7:
+        if len(raw) > MAX_BINARY_SIZE:
+            return None
+        if raw.isascii() and raw.rstrip(b'\0').isalnum():
+            return raw.rstrip(b'\0').decode('ascii')
+        return binascii.hexlify(raw).decode('ascii')
+    values = struct.unpack(endian + fmt * count, raw)
+    if field_type in (5, 10):
+        values = [
+            values[i] / values[i + 1] if values[i + 1] else None
+            for i in range(0, len(values), 2)
+        ]
+    if count == 1:
+        return values[0]
+    return list(values)
+
+
+def _read_ifd(tiff, offset, endian, names):
+    '''
+    Read an IFD of a TIFF structure. Return a dict of the tags by name, and a
+    dict of the offsets of the sub-IFDs by tag.
+    '''
+    tags = {}
+    pointers = {}
+    count = struct.unpack_from(endian + 'H', tiff, offset)[0]
+    for index in range(count):
+        entry = offset + 2 + index * 12
+        tag, field_type, value_count = struct.unpack_from(
+            endian + 'HHI', tiff, entry)
+        if tag in (EXIF_IFD_TAG, GPS_IFD_TAG):
+            pointers[tag] = struct.unpack_from(endian + 'I', tiff,
+                                               entry + 8)[0]
+            continue
+        if tag in SKIPPED_TAGS or field_type not in TIFF_TYPES:
+            continue
+        size = TIFF_TYPES[field_type][1] * value_count
+        if size <= 4:
+            start = entry + 8
+        else:
+            start = struct.unpack_from(endian + 'I', tiff, entry + 8)[0]
+        raw = tiff[start:start + size]
+        if len(raw) < size:
+            continue
+        value = _decode_value(field_type, value_count, raw, endian)
+        if value is not None:
+            tags[names.get(tag, '0x{t:04x}'.format(t=tag))] = value
+    return tags, pointers
+
+
+def parse_exif(tiff):
+    '''
+    Parse the TIFF structure of an EXIF segment (after the EXIF header).
+    Return the tags of the main image and of the Exif IFD, and the GPS tags,
+    as two dicts. The thumbnail IFD is ignored.
+    '''
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        raise Exception('Invalid EXIF byte order {b!r}'.format(b=tiff[:2]))
+    ifd0 = struct.unpack_from(endian + 'I', tiff, 4)[0]
+    tags, pointers = _read_ifd(tiff, ifd0, endian, PIL.ExifTags.TAGS)
+    gps = {}
+    if EXIF_IFD_TAG in pointers:
+        tags.update(_read_ifd(tiff, pointers[EXIF_IFD_TAG], endian,
+                              PIL.ExifTags.TAGS)[0])
+    if GPS_IFD_TAG in pointers:
+        gps = _read_ifd(tiff, pointers[GPS_IFD_TAG], endian,
+                        PIL.ExifTags.GPSTAGS)[0]
+    return tags, gps
+
+
+def parse_iptc(data):
+    '''
+    Parse the IPTC IIM records of a Photoshop segment (after its header), and
+    return the datasets of the application record as a dict
+    '''
+    iptc = {}
+    offset = 0
+    while offset + 12 <= len(data) and data[offset:offset + 4] == b'8BIM':
+        resource_id = struct.unpack_from('>H', data, offset + 4)[0]
+        # the resource name is a Pascal string, padded to an even size
+        name_size = data[offset + 6]
+        offset += 6 + name_size + 1 + (name_size + 1) % 2
+        size = struct.unpack_from('>I', data, offset)[0]
+        offset += 4
+        if resource_id == IPTC_RESOURCE_ID:
+            iptc.update(_parse_iim(data[offset:offset + size]))
+        offset += size + size % 2
+    return iptc
+
+
+def _parse_iim(data):
+    iptc = {}
+    offset = 0
+    while offset + 5 <= len(data) and data[offset] == 0x1c:
+        record, dataset, size = struct.unpack_from('>BBH', data, offset + 1)
+        offset += 5
+        if size & 0x8000:
+            # extended datasets are not used by the application record
+            break
+        value = data[offset:offset + size]
+        offset += size
+        name = IPTC_TAGS.get(dataset)
+        if record != 2 or name is None:
+            continue
+        value = value.decode('utf-8', 'replace')
+        if name in IPTC_REPEATABLE:
+            iptc.setdefault(name, []).append(value)
+        else:
+            iptc[name] = value
+    return iptc
+
+
+def _gps_coordinate(gps, name):
+    value = gps.get('GPS' + name)
+    ref = gps.get('GPS' + name + 'Ref')
+    if not isinstance(value, list) or len(value) != 3 or None in value:
+        return None
+    coordinate = value[0] + value[1] / 60 + value[2] / 3600
+    if ref in ('S', 'W'):
+        coordinate = -coordinate
+    return coordinate
+
+
+def _iso_datetime(value):
+    # EXIF dates are formatted as YYYY:MM:DD HH:MM:SS
+    if not isinstance(value, str) or len(value) < 19:
+        return None
+    return '{d}T{t}'.format(d=value[:10].replace(':', '-'), t=value[11:19])
+
+
+def read_metadata(fd):
+    '''
+    Extract the EXIF, GPS, IPTC and comment metadata of a JPEG file, reading
+    only the segments before the image data
+    '''
+    exif = {}
+    gps = {}
+    iptc = {}
+    comments = []
+    for (marker, data) in read_segments(fd):
+        try:
+            if marker == APP1 and data.startswith(EXIF_HEADER):
+                tags, gps_tags = parse_exif(data[len(EXIF_HEADER):])
+                exif.update(tags)
+                gps.update(gps_tags)
+            elif marker == APP13 and data.startswith(PHOTOSHOP_HEADER):
+                iptc.update(parse_iptc(data[len(PHOTOSHOP_HEADER):]))
+            elif marker == COM:
+                comments.append(
+                    data.rstrip(b'\0').decode('utf-8', 'replace'))
+        except struct.error:
+            logger.warning('Truncated metadata segment 0x{m:02x}'.format(
+                m=marker,
+            ))
+    return {
+        'exif': exif,
+        'gps': gps,
+        'iptc': iptc,
+        'comments': comments,
+        'datetime_original': _iso_datetime(
+            exif.get('DateTimeOriginal', exif.get('DateTime'))),
+        'latitude': _gps_coordinate(gps, 'Latitude'),
+        'longitude': _gps_coordinate(gps, 'Longitude'),
+    }
+
 
 class JpegFile(BaseTask):
+    '''
+    Task to extract the metadata of JPEG files: EXIF and GPS tags, IPTC
+    datasets and comments. Only the segments before the image data are read,
+    the image is never decoded. JPEG files are numerous and quick to analyze,
+    so they are run in batches (see `BaseTask.BATCH_SIZE`).
+    '''
+
+    __slots__ = ()
 
     MAGIC_PATTERN = '^JPEG image data.*'
+    BATCH_SIZE = 64
 
     def __init__(self, path, *args, **kwargs):
         BaseTask.__init__(self, path, *args, **kwargs)
 
     def run(self):
-        # Extract EXIF data
-        # TODO Extract IPTC info too
-        # TODO Extract non-exif comments (i.e. fields starting with \xff\xfe)
-        image = PIL.Image.open(self._path)
-        try:
-            tags = image._exiftags()
-        except AttributeError:
-            msg = 'Warning: no EXIF tags found for {f!r}'.format(f=self._path)
-            self.add_warnings(msg)
-            logger.warning(msg)
-        image.close()
-        msg = 'Extracted {n} EXIF tags from {p!r}'.format(
-            n=len(tags),
+        with self.open() as fd:
+            metadata = read_metadata(fd)
+        if not (metadata['exif'] or metadata['iptc'] or metadata['comments']):
+            self.add_warning('No metadata found in {f!r}'.format(
+                f=self._path,
+            ))
+        logger.info('Extracted {n} EXIF tags from {p!r}'.format(
+            n=len(metadata['exif']) + len(metadata['gps']),
             p=self._path,
-        )
-        logger.info(msg)
-        self._result = msg
+        ))
+        self._result = metadata
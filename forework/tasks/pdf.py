@@ -1,34 +1,107 @@
-import os
-# import json
-# import zlib
-import tempfile
-import subprocess
+import io
 
 from pdfminer.pdfparser import PDFParser
 from pdfminer.pdfdocument import PDFDocument
-from pdfminer.pdftypes import resolve1
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdftypes import resolve1, PDFObjRef, PDFStream
 
 from ..basetask import BaseTask
-from .directoryscanner import DirectoryScanner
-from .. import utils
+from .jpeg import JpegFile
+from .. import utils, sources
 
 
 logger = utils.get_logger(__name__)
 
+# file type of the DCTDecode streams, which are JPEG files
+JPEG_FILETYPE = 'JPEG image data'
+# Number of documents kept open by each thread to read the objects found in
+# them, see `open_pdf_object`
+DOCUMENT_CACHE_SIZE = 4
+
+
+def _filter_names(stream):
+    filters = resolve1(stream.get('Filter'))
+    if filters is None:
+        return []
+    if not isinstance(filters, list):
+        filters = [filters]
+    return [getattr(resolve1(f), 'name', None) for f in filters]
+
+
+def _open_document(document, parent):
+    fd = sources.open_source(document, parent)
+    try:
+        return (fd, PDFDocument(PDFParser(fd)))
+    except Exception:
+        fd.close()
+        raise
+
+
+# (document path, parent source) -> (file object, PDFDocument), per thread
+# (see `sources.OpenCache`)
+_documents = sources.OpenCache(DOCUMENT_CACHE_SIZE,
+                               lambda entry: entry[0].close())
+
+
+def _get_document(document, parent):
+    return _documents.get((document, repr(parent)),
+                          lambda: _open_document(document, parent))[1]
+
+
+def pdf_object(document, objid, parent=None, size=None):
+    '''
+    Return the source of a stream object of a PDF document. `parent` is the
+    source of the document itself, if it is not a file of its own.
+    '''
+    return {
+        'type': 'pdf',
+        'document': document,
+        'parent': parent,
+        'objid': objid,
+        'size': size,
+    }
+
+
+def open_pdf_object(source):
+    '''
+    Open the decoded data of a PDF stream object. JPEG streams (DCTDecode) are
+    returned as they are. The last documents opened are kept open, so that
+    the objects of a document are read without parsing it again.
+    '''
+    doc = _get_document(source['document'], source.get('parent'))
+    stream = resolve1(doc.getobj(source['objid']))
+    return io.BytesIO(stream.get_data())
+
+
+sources.register_opener('pdf', open_pdf_object)
+
 
 class PDFFile(BaseTask):
+    '''
+    Task to extract the metadata of PDF documents, and optionally their
+    pictures.
+
+    Pages are only parsed if pictures are requested. The image XObjects of
+    the pages (forms included) are found in process: JPEG images are
+    dispatched to JpegFile, reading them straight from the document (see
+    `pdf_object`), while the other images are only listed in the results.
+    Supported configuration:
+        extract_pictures: if true, extract the pictures
+    '''
+
+    __slots__ = ()
 
     MAGIC_PATTERN = '^PDF document.*'
     MODIFIERS = [
         'extract_pictures',
-        'outdir',
     ]
 
     def __init__(self, path, config, *args, **kwargs):
         BaseTask.__init__(self, path, config, *args, **kwargs)
 
     def run(self):
-        with open(self._path, 'rb') as fd:
+        conf = self.conf or {}
+        with self.open() as fd:
             parser = PDFParser(fd)
             doc = PDFDocument(parser)
 
@@ -40,32 +113,60 @@ class PDFFile(BaseTask):
             if 'Metadata' in doc.catalog:
                 metadata = str(resolve1(doc.catalog['Metadata']).get_data())
 
+            pages = None
+            if 'Pages' in doc.catalog:
+                pages = resolve1(resolve1(doc.catalog['Pages']).get('Count'))
+
             # check the modifiers
             extracted_images = []
-            outdir = None
-            if self.conf['extract_pictures']:
-                if self.conf['outdir']:
-                    outdir = self.conf['outdir']
-                else:
-                    outdir = tempfile.mkdtemp(prefix=self.conf)
-                try:
-                    os.makedirs(outdir)
-                except FileExistsError:
-                    logger.warning('Directory {d!r} already exists, going '
-                                   'ahead anyway'.format(d=outdir))
-
-                # TODO horrible hack, in need for a pure Python implementation
-                prefix = os.path.join(outdir, self._config.name)
-                subprocess.check_call(['pdfimages', '-j', self._path, prefix])
-                extracted_images = os.listdir(outdir)
-                self.add_next_task({
-                    'name': [DirectoryScanner.__name__],
-                    'path': outdir,
-                })
+            other_images = []
+            if conf.get('extract_pictures'):
+                for (objid, stream) in self._find_images(doc):
+                    filters = _filter_names(stream)
+                    if filters and filters[-1] == 'DCTDecode':
+                        extracted_images.append(objid)
+                        self.add_next_task({
+                            'name': [JpegFile.__name__],
+                            'path': '{p}#{o}'.format(p=self._path, o=objid),
+                            'filetype': JPEG_FILETYPE,
+                            'source': pdf_object(
+                                self._path, objid, self._source,
+                                resolve1(stream.get('Length')),
+                            ),
+                        })
+                    else:
+                        other_images.append([objid, filters])
 
         self._result = {
             'Info': info,
             'Metadata': metadata,
+            'pages': pages,
             'images': extracted_images,
-            'outdir': outdir,
+            'other_images': other_images,
         }
+
+    def _find_images(self, doc):
+        '''
+        Yield the (object ID, stream) of the image XObjects of the document's
+        pages, walking the pages lazily. Images used more than once are
+        yielded once.
+        '''
+        seen = set()
+        for page in PDFPage.create_pages(doc):
+            resources = [page.resources]
+            while resources:
+                xobjects = resolve1((resolve1(resources.pop()) or {})
+                                    .get('XObject')) or {}
+                for ref in xobjects.values():
+                    if not isinstance(ref, PDFObjRef) or ref.objid in seen:
+                        continue
+                    seen.add(ref.objid)
+                    stream = resolve1(ref)
+                    if not isinstance(stream, PDFStream):
+                        continue
+                    subtype = getattr(resolve1(stream.get('Subtype')),
+                                      'name', None)
+                    if subtype == 'Image':
+                        yield (ref.objid, stream)
+                    elif subtype == 'Form' and 'Resources' in stream:
+                        resources.append(stream['Resources'])
@@ -11,8 +11,12 @@ class Raw(BaseTask):
     starting point to analyze unknown artifacts. Requires filemagic .
     '''
 
+    __slots__ = ()
+
     # This is a special task, and the MAGIC_PATTERN is actually ignored
     MAGIC_PATTERN = '.*'
+    # Raw can handle anything, selecting it by file type would cause loops
+    DISPATCHABLE = False
 
     def __init__(self, path, *args, **kwargs):
         BaseTask.__init__(self, path, *args, **kwargs)
@@ -23,10 +27,12 @@ class Raw(BaseTask):
             o=self._offset,
         ))
         # Try to recognize the file content using libmagic
-        filetype = utils.get_file_type(self._path)
+        filetype = self.filetype
         self.add_next_task({
             'name': find_tasks_by_filetype(filetype),
-            'path': self._path
+            'path': self._path,
+            'filetype': filetype,
+            'source': self._source,
         })
         logger.info('File {p} (offset {o}) identified as {t}'.format(
             p=self._path,
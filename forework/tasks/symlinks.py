@@ -3,10 +3,12 @@ from ..basetask import BaseTask
 
 class SymLinks(BaseTask):
 
+    __slots__ = ()
+
     MAGIC_PATTERN = '^symbolic link.*'
 
     def __init__(self, path, *args, **kwargs):
-        BaseTask.__init__(path, *args, **kwargs)
+        BaseTask.__init__(self, path, *args, **kwargs)
 
     def run(self):
         self._result = 'No action for symlink: {s!r}'.format(s=self._path)
@@ -1,50 +1,228 @@
 import re
 import mmap
+import functools
 
 from ..basetask import BaseTask
 from .. import utils
+from .. import keywords
 
 
 logger = utils.get_logger(__name__)
 
+DEFAULT_FLAGS = ['MULTILINE', 'IGNORECASE', 'DOTALL']
+DEFAULT_ENCODING = 'utf-8'
+# Maximum number of matches reported per file, None for no limit
+DEFAULT_MAX_MATCHES = 1000
+# Size of the chunks read when a file cannot be memory-mapped, and overlap
+# of context kept between consecutive chunks, for anchors and lookarounds
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+DEFAULT_OVERLAP = 64 * 1024
+# Maximum number of bytes of each match returned by the search functions, and
+# included in the results: a greedy pattern can match most of a file
+MAX_MATCH_PREVIEW = 256
+
+
+@functools.lru_cache(maxsize=64)
+def compile_pattern(pattern, flags=tuple(DEFAULT_FLAGS),
+                    encoding=DEFAULT_ENCODING):
+    '''
+    Compile a pattern to a bytes regular expression. `flags` is a tuple of
+    names of `re` flags. Compiled patterns are cached, so that every worker
+    compiles each pattern only once.
+    '''
+    value = 0
+    for flag in flags:
+        value |= getattr(re, flag.upper())
+    return re.compile(pattern.encode(encoding), value)
+
+
+def finditer_chunked(fd, pattern, chunk_size=DEFAULT_CHUNK_SIZE,
+                     overlap=DEFAULT_OVERLAP):
+    '''
+    Search a binary file object in chunks, yielding (start, end, preview)
+    tuples for all the non-overlapping matches, `preview` being the first
+    MAX_MATCH_PREVIEW bytes of the match. Up to `overlap` bytes are kept around
+    the position where the search resumes, so that matches crossing a chunk
+    boundary are found and anchors and lookarounds see their context. Matches
+    reaching the end of a chunk are searched again with the next one, as they
+    may extend.
+    '''
+    base = 0
+    buf = b''
+    pos = 0
+    min_start = 0
+    while True:
+        data = fd.read(chunk_size)
+        final = not data
+        buf += data
+        resume = len(buf) if final else max(pos, len(buf) - overlap)
+        for match in pattern.finditer(buf, pos):
+            if match.start() >= resume:
+                break
+            if not final and match.end() == len(buf):
+                resume = match.start()
+                break
+            start = base + match.start()
+            if start < min_start:
+                continue
+            yield (start, base + match.end(),
+                   buf[match.start():min(match.end(),
+                                         match.start() + MAX_MATCH_PREVIEW)])
+            min_start = base + max(match.end(), match.start() + 1)
+            resume = max(resume, match.end())
+        if final:
+            return
+        drop = max(0, resume - overlap)
+        buf = buf[drop:]
+        base += drop
+        pos = resume - drop
+
+
+def finditer_file(path, pattern, chunk_size=DEFAULT_CHUNK_SIZE,
+                  overlap=DEFAULT_OVERLAP):
+    '''
+    Search a file, yielding (start, end, preview) tuples for all the
+    non-overlapping matches. See `finditer_fileobj`.
+    '''
+    with open(path, 'rb') as fd:
+        yield from finditer_fileobj(fd, pattern, chunk_size, overlap)
+
+
+def finditer_fileobj(fd, pattern, chunk_size=DEFAULT_CHUNK_SIZE,
+                     overlap=DEFAULT_OVERLAP):
+    '''
+    Search a binary file object, yielding (start, end, preview) tuples for all
+    the non-overlapping matches, `preview` being the first MAX_MATCH_PREVIEW
+    bytes of the match. The file is memory-mapped if possible, so it is never
+    loaded entirely in memory, and searched in chunks otherwise.
+    '''
+    try:
+        mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        # empty files, special files and in-memory objects cannot be mapped
+        yield from finditer_chunked(fd, pattern, chunk_size, overlap)
+        return
+    with mapped:
+        for match in pattern.finditer(mapped):
+            start, end = match.span()
+            yield (start, end,
+                   mapped[start:min(end, start + MAX_MATCH_PREVIEW)])
+
 
 class TextFile(BaseTask):
+    '''
+    Task to search text files for a regular expression, and for a list of
+    keywords.
+
+    Files are searched as bytes, so they are never decoded nor loaded entirely
+    in memory. Supported configuration:
+        grep: the regular expression to search
+        flags: list of `re` flag names (default: DEFAULT_FLAGS)
+        encoding: encoding of the pattern and keywords, and of the matches in
+                  the results. Must be ASCII-compatible (default: utf-8)
+        max_matches: maximum number of matches reported (default:
+                     DEFAULT_MAX_MATCHES), null for no limit
+        chunk_size, overlap: chunking of the files that cannot be mapped
+        keywords: list of keywords, or name of a file with one keyword per
+                  line, all searched in a single pass (see
+                  `keywords.KeywordAutomaton`)
+        case_sensitive: whether keywords are case sensitive (default: false)
+        max_hits: maximum number of offsets reported per keyword (default:
+                  keywords.DEFAULT_MAX_HITS), null for no limit
+    '''
+
+    __slots__ = ()
 
     MAGIC_PATTERN = '^ASCII text.*'
+    MODIFIERS = [
+        'grep',
+        'flags',
+        'encoding',
+        'max_matches',
+        'chunk_size',
+        'overlap',
+        'keywords',
+        'case_sensitive',
+        'max_hits',
+    ]
 
     def __init__(self, path, conf, pattern=None, *args, **kwargs):
-        self._path = path
         BaseTask.__init__(self, path, conf, *args, **kwargs)
 
     def run(self):
-        try:
-            grep = self._config.get(self.__class__.__name__)['grep']
-        except KeyError:
+        conf = self.conf or {}
+        if conf.get('grep') is None and not conf.get('keywords'):
             msg = 'No pattern requested for {path!r}'.format(
                 path=self._path,
             )
             logger.info(msg)
             self._result = msg
             return
-        except TypeError:
-            # configuration not set for TextFile
-            msg = ('Cannot get configuration for TextFile, possibly not set in '
-                   'the YML config'
-                   )
-            logger.debug(msg)
-            pass
-
-        # TODO handle regex flags in configuration
-        pattern = re.compile(grep, re.MULTILINE | re.IGNORECASE | re.DOTALL)
-        # TODO implement grep for large text files. Can't mix mmap and text
-        #      regex'es.
-        with open(self._path) as fd:
-            match = pattern.search(fd.read())
-            msg = 'Pattern {pattern!r} {found}found in {path!r}{at}'.format(
-                pattern=grep,
-                found='' if match else 'not ',
-                path=self._path,
-                at='' if match is None else ' at {}'.format(match.span()),
+
+        result = {}
+        if conf.get('grep') is not None:
+            result.update(self._grep(conf))
+        if conf.get('keywords'):
+            result.update(self._search_keywords(conf))
+        self._result = result
+
+    def _grep(self, conf):
+        grep = conf['grep']
+        encoding = conf.get('encoding', DEFAULT_ENCODING)
+        pattern = compile_pattern(
+            grep,
+            tuple(conf.get('flags', DEFAULT_FLAGS)),
+            encoding,
+        )
+        max_matches = conf.get('max_matches', DEFAULT_MAX_MATCHES)
+        matches = []
+        truncated = False
+        with self.open() as fd:
+            for (start, end, preview) in finditer_fileobj(
+                    fd, pattern,
+                    conf.get('chunk_size', DEFAULT_CHUNK_SIZE),
+                    conf.get('overlap', DEFAULT_OVERLAP)):
+                if max_matches is not None and len(matches) >= max_matches:
+                    truncated = True
+                    break
+                matches.append([
+                    start,
+                    end,
+                    preview.decode(encoding, 'replace'),
+                ])
+        logger.info('Pattern {pattern!r} found {n}{more} times in '
+                    '{path!r}'.format(
+                        pattern=grep,
+                        n=len(matches),
+                        more='+' if truncated else '',
+                        path=self._path,
+                    ))
+        return {
+            'pattern': grep,
+            'matches': matches,
+            'truncated': truncated,
+        }
+
+    def _search_keywords(self, conf):
+        keyword_list = conf['keywords']
+        if not isinstance(keyword_list, str):
+            keyword_list = tuple(keyword_list)
+        automaton = keywords.get_automaton(
+            keyword_list,
+            conf.get('case_sensitive', False),
+            conf.get('encoding', DEFAULT_ENCODING),
+        )
+        with self.open() as fd:
+            hits, truncated = automaton.scan(
+                fd,
+                conf.get('max_hits', keywords.DEFAULT_MAX_HITS),
             )
-            logger.info(msg)
-            self._result = msg
+        logger.info('{n} of {total} keywords found in {path!r}'.format(
+            n=len(hits),
+            total=len(automaton),
+            path=self._path,
+        ))
+        return {
+            'keywords': hits,
+            'keywords_truncated': truncated,
+        }
@@ -1,25 +1,96 @@
 import zipfile
-import tempfile
 
-from ..basetask import BaseTask
+from ..basetask import BaseTask, find_tasks_by_filetype
 from .directoryscanner import DirectoryScanner
-from .. import utils
+from .. import utils, config, sources
 
 
 logger = utils.get_logger(__name__)
 
 
 class ZipFile(BaseTask):
+    '''
+    Task to analyze zip archives.
+
+    By default the archive is not extracted: every member is identified from
+    its first bytes, and the follow-up tasks read it from the archive (see
+    `sources.zip_member`), so nested archives are never written to disk either.
+    The members get virtual paths made of the path of the archive and their
+    name. Supported configuration:
+        outdir: extract the archive to this directory, and scan it, instead
+        max_members: maximum number of members of an archive
+        max_total_size: maximum total uncompressed size of an archive
+        max_ratio: maximum compression ratio of a member larger than
+                   RATIO_MIN_SIZE. Members over it are skipped
+        batch_size: number of follow-up tasks to collect before handing them to
+                    the scheduler
+    The archives over max_members or max_total_size (e.g. zip bombs) are not
+    analyzed.
+    '''
+
+    __slots__ = ()
 
     MAGIC_PATTERN = '^Zip archive data.*'
+    MODIFIERS = [
+        'outdir',
+        'max_members',
+        'max_total_size',
+        'max_ratio',
+        'batch_size',
+    ]
+    STREAMS_NEXT_TASKS = True
+    DEFAULT_MAX_MEMBERS = 100000
+    DEFAULT_MAX_TOTAL_SIZE = 16 * 1024 ** 3
+    DEFAULT_MAX_RATIO = 100
+    RATIO_MIN_SIZE = 1024 * 1024
+    DEFAULT_BATCH_SIZE = 1000
 
     def __init__(self, path, *args, **kwargs):
         BaseTask.__init__(self, path, *args, **kwargs)
 
     def run(self):
-        outdir = self.conf.get('outdir', tempfile.mkdtemp())
-        with zipfile.ZipFile(self._path) as zf:
-            zf.extractall(outdir)
+        conf = self.conf or {}
+        with self.open() as fd, zipfile.ZipFile(fd) as zf:
+            members = self._check_limits(zf, conf)
+            if 'outdir' in conf:
+                self._result = self._extract(zf, members, conf['outdir'])
+            else:
+                self._result = self._scan(zf, members, conf)
+
+    def _check_limits(self, zf, conf):
+        '''
+        Return the members of the archive to analyze, raising an exception if
+        the archive exceeds the configured limits. Sizes are read from the
+        archive directory, and members cannot be decompressed beyond them.
+        '''
+        members = [info for info in zf.infolist() if not info.is_dir()]
+        max_members = conf.get('max_members', self.DEFAULT_MAX_MEMBERS)
+        if len(members) > max_members:
+            raise Exception('Zip file {z!r} has {n} members, more than the '
+                            'limit of {m}'.format(z=self._path, n=len(members),
+                                                  m=max_members))
+        total_size = sum(info.file_size for info in members)
+        max_total_size = conf.get('max_total_size',
+                                  self.DEFAULT_MAX_TOTAL_SIZE)
+        if total_size > max_total_size:
+            raise Exception('Zip file {z!r} expands to {s} bytes, more than '
+                            'the limit of {m}'.format(z=self._path,
+                                                      s=total_size,
+                                                      m=max_total_size))
+        max_ratio = conf.get('max_ratio', self.DEFAULT_MAX_RATIO)
+        checked = []
+        for info in members:
+            if info.file_size > self.RATIO_MIN_SIZE and \
+                    info.file_size > max_ratio * max(info.compress_size, 1):
+                self.add_warning('Skipping {m!r} in {z!r}: compression ratio '
+                                 'over {r}'.format(m=info.filename,
+                                                   z=self._path, r=max_ratio))
+                continue
+            checked.append(info)
+        return checked
+
+    def _extract(self, zf, members, outdir):
+        zf.extractall(outdir, members)
         msg = 'Zip file {z!r} extracted at {t!r}'.format(
             z=self._path,
             t=outdir,
@@ -29,4 +100,41 @@ class ZipFile(BaseTask):
             'name': [DirectoryScanner.__name__],
             'path': outdir,
         })
-        self._result = msg
+        return msg
+
+    def _scan(self, zf, members, conf):
+        batch_size = conf.get('batch_size', self.DEFAULT_BATCH_SIZE)
+        unknown = 0
+        for info in members:
+            path = '{z}/{m}'.format(z=self._path, m=info.filename)
+            try:
+                with zf.open(info) as member:
+                    header = member.read(config.FILE_TYPE_HEADER_SIZE)
+            except (RuntimeError, NotImplementedError, zipfile.BadZipFile,
+                    OSError) as exc:
+                # e.g. encrypted members, or unsupported compression methods
+                self.add_warning('The member {m!r} cannot be read, skipping: '
+                                 '{e}'.format(m=path, e=exc))
+                continue
+            filetype = utils.get_buffer_type(header)
+            tasknames = find_tasks_by_filetype(filetype)
+            if len(tasknames) < 1:
+                self.add_warning('Cannot find a task for {m}'.format(m=path))
+                unknown += 1
+                continue
+            self.add_next_task({
+                'name': tasknames,
+                'path': path,
+                'filetype': filetype,
+                'source': sources.zip_member(self._path, info.filename,
+                                             self._source, info.file_size),
+            })
+            if len(self._next_tasks) >= batch_size:
+                self.flush_next_tasks()
+        self.flush_next_tasks()
+        msg = 'Zip file {z!r}: found {tn} tasks, and {uf} unknown file ' \
+              'types'.format(z=self._path,
+                             tn=self._emitted + len(self._next_tasks),
+                             uf=unknown)
+        logger.info(msg)
+        return msg
@@ -1,6 +1,11 @@
 import os
+import stat
 import time
+import socket
+import hashlib
 import logging
+import threading
+import collections
 
 import magic
 
@@ -8,6 +13,16 @@ from . import config
 
 
 mage = magic.Magic()
+# (st_dev, st_ino, st_size, st_mtime_ns) -> file type
+_file_type_cache = collections.OrderedDict()
+# (st_dev, st_ino, st_size, st_mtime_ns) -> first bytes of the file
+_header_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+# types given by libmagic to content it does not recognize. Some formats are
+# recognized from bytes beyond the header (e.g. offsets in the file, or the
+# end of the file), so these buffer results are checked on the whole file
+GENERIC_FILE_TYPES = ('data', 'application/octet-stream')
+_hostname = socket.gethostname()
 
 
 def get_logger(name):
@@ -34,9 +49,130 @@ def get_logger(name):
     return logger
 
 
-def get_file_type(path):
-    if os.path.isdir(path):
-        return 'directory'
-    if os.path.islink(path):
+def worker_id():
+    '''
+    Return an identifier of the worker running in this thread: the host and
+    the process, plus the thread name if it is not the main thread (e.g. the
+    workers of the in-memory broker)
+    '''
+    worker = '{h}:{p}'.format(h=_hostname, p=os.getpid())
+    thread = threading.current_thread()
+    if thread is not threading.main_thread():
+        worker = '{w}:{t}'.format(w=worker, t=thread.name)
+    return worker
+
+
+def _cache_get(cache, key):
+    with _cache_lock:
+        try:
+            cache.move_to_end(key)
+        except KeyError:
+            return None
+        return cache[key]
+
+
+def _cache_put(cache, key, value, maxsize):
+    with _cache_lock:
+        cache[key] = value
+        if len(cache) > maxsize:
+            cache.popitem(last=False)
+
+
+def _stat_key(stat_result):
+    return (stat_result.st_dev, stat_result.st_ino, stat_result.st_size,
+            stat_result.st_mtime_ns)
+
+
+def read_header(path, size=config.FILE_TYPE_HEADER_SIZE, stat_result=None):
+    '''
+    Return the first `size` bytes of a file, reusing the buffer read by
+    `get_file_type` if it is still cached in this process
+    '''
+    if stat_result is None:
+        stat_result = os.stat(path)
+    key = _stat_key(stat_result)
+    header = _cache_get(_header_cache, key)
+    if header is None or (len(header) < size and
+                          len(header) < stat_result.st_size):
+        with open(path, 'rb') as fd:
+            header = fd.read(max(size, config.FILE_TYPE_HEADER_SIZE))
+        _cache_put(_header_cache, key, header, config.HEADER_CACHE_SIZE)
+    return header[:size]
+
+
+def get_buffer_type(buffer):
+    '''
+    Identify the content of a buffer (e.g. the first FILE_TYPE_HEADER_SIZE
+    bytes of a file) with libmagic, and return its type as a string
+    '''
+    return mage.from_buffer(buffer)
+
+
+def get_file_type(path, stat_result=None):
+    '''
+    Identify a file with libmagic, and return its type as a string.
+
+    Regular files are identified from a buffer holding their first
+    FILE_TYPE_HEADER_SIZE bytes, which is kept for `read_header`. Larger files
+    whose header is not recognized (see GENERIC_FILE_TYPES) are identified
+    again from the whole file, as libmagic may need more. Results are
+    memoized by device, inode, size and modification time, so a file seen
+    twice is identified only once. `stat_result` is the result of
+    `os.lstat(path)`, if the caller already has it (e.g. from an
+    `os.DirEntry`).
+    '''
+    if stat_result is None:
+        stat_result = os.lstat(path)
+    if stat.S_ISLNK(stat_result.st_mode):
+        # symbolic links to directories are followed
+        if os.path.isdir(path):
+            return 'directory'
         return 'symbolic link'
-    return mage.from_file(path)
+    if stat.S_ISDIR(stat_result.st_mode):
+        return 'directory'
+    key = _stat_key(stat_result)
+    filetype = _cache_get(_file_type_cache, key)
+    if filetype is not None:
+        return filetype
+    if stat.S_ISREG(stat_result.st_mode):
+        with open(path, 'rb') as fd:
+            header = fd.read(config.FILE_TYPE_HEADER_SIZE)
+        _cache_put(_header_cache, key, header, config.HEADER_CACHE_SIZE)
+        filetype = get_buffer_type(header)
+        if (filetype in GENERIC_FILE_TYPES and
+                stat_result.st_size > len(header)):
+            filetype = mage.from_file(path)
+    else:
+        # devices, FIFOs and sockets must not be read
+        filetype = mage.from_file(path)
+    _cache_put(_file_type_cache, key, filetype, config.FILE_TYPE_CACHE_SIZE)
+    return filetype
+
+
+def hash_file(path, algorithms=('sha256',), chunk_size=config.HASH_CHUNK_SIZE):
+    '''
+    Compute the digests of a file with one or more hashlib algorithms, reading
+    it only once in chunks of `chunk_size` bytes. Return a dictionary mapping
+    algorithm names to hex digests.
+    '''
+    with open(path, 'rb') as fd:
+        return hash_fileobj(fd, algorithms, chunk_size)
+
+
+def hash_fileobj(fd, algorithms=('sha256',),
+                 chunk_size=config.HASH_CHUNK_SIZE):
+    '''
+    Same as `hash_file`, for a binary file object read from its current
+    position
+    '''
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    while True:
+        chunk = fd.read(chunk_size)
+        if not chunk:
+            break
+        for hash_ in hashes:
+            hash_.update(chunk)
+    return {
+        algorithm: hash_.hexdigest()
+        for (algorithm, hash_) in zip(algorithms, hashes)
+    }
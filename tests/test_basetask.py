@@ -0,0 +1,47 @@
+from forework import basetask
+
+
+def test_find_tasks_by_filetype():
+    assert basetask.find_tasks_by_filetype('PDF document, version 1.4') == \
+        ['PDFFile']
+    assert basetask.find_tasks_by_filetype(
+        'EWF/Expert Witness/EnCase image file format') == ['Image']
+    assert basetask.find_tasks_by_filetype('unknown data') == []
+
+
+def test_dispatch_index_matches_can_handle():
+    tasks = basetask.find_tasks()
+    index = basetask.DispatchIndex(tasks)
+    for filetype in ('directory', 'ASCII text', 'JPEG image data, JFIF',
+                     'Zip archive data', 'symbolic link to /tmp', 'data'):
+        expected = [t.__name__ for t in tasks if t.can_handle(filetype)][:1]
+        assert list(index.lookup(filetype, True)) == expected
+
+
+def test_dispatch_stats():
+    index = basetask.DispatchIndex(basetask.find_tasks())
+    index.lookup('ASCII text', True)
+    index.lookup('ASCII text', True)
+    stats = index.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['cached_filetypes'] == 1
+
+
+def test_compact_task(tmp_path, make_conf):
+    import pickle
+    from forework.tasks.raw import Raw
+    conf = make_conf()
+    task = Raw(str(tmp_path), conf).start()
+    assert not hasattr(task, '__dict__')
+    assert isinstance(task._start, float)
+    assert task.duration >= 0
+    # the configuration is referenced by ID, and not pickled with the task
+    assert conf.id.encode() in pickle.dumps(task)
+    assert b'investigation' not in pickle.dumps(task)
+    copy = pickle.loads(pickle.dumps(task))
+    assert copy._config is conf
+    taskdict = task.to_dict()
+    assert isinstance(taskdict['start'], str)
+    restored = basetask.BaseTask.from_dict(taskdict, conf)
+    assert abs(restored._start - task._start) < 1e-3
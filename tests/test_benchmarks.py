@@ -0,0 +1,33 @@
+import os
+
+from benchmarks import evidence, micro, endtoend
+
+
+def test_generate(tmp_path):
+    counts = {'text': 20, 'jpeg': 5, 'pdf': 2, 'zip': 2}
+    manifest = evidence.generate(str(tmp_path / 'a'), counts, depth=2,
+                                 fanout=3, duplicates=0.5, seed=1)
+    assert manifest['files'] == counts
+    assert manifest['directories'] == 1 + 3 + 9
+    assert 0 < manifest['duplicates'] < sum(counts.values())
+    paths = micro.list_files(str(tmp_path / 'a'))
+    assert len(paths) == sum(counts.values())
+    assert manifest['size'] == sum(os.path.getsize(p) for p in paths)
+    # the same seed generates the same tree
+    again = evidence.generate(str(tmp_path / 'b'), counts, depth=2, fanout=3,
+                              duplicates=0.5, seed=1)
+    assert again['size'] == manifest['size']
+    assert [os.path.relpath(p, str(tmp_path / 'b')) for p in
+            micro.list_files(str(tmp_path / 'b'))] == \
+        [os.path.relpath(p, str(tmp_path / 'a')) for p in paths]
+
+
+def test_micro(tmp_path):
+    root = str(tmp_path / 'evidence')
+    evidence.generate(root, {'text': 5, 'jpeg': 2, 'pdf': 0, 'zip': 1},
+                      depth=1, fanout=2)
+    config = endtoend.make_config(str(tmp_path), root, 'micro')
+    metrics = micro.run(root, config, repeat=1, results_size=100)
+    assert metrics['get_file_type_cold']['items'] == 8
+    assert metrics['from_json']['per_second'] > 0
+    assert metrics['results_in_range']['tasks'] == 100
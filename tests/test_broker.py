@@ -0,0 +1,114 @@
+import json
+import time
+import threading
+
+import pytest
+
+from forework import broker
+from forework.tasks.raw import Raw
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_broker(request, tmp_path):
+    def _make_broker(max_attempts=broker.DEFAULT_MAX_ATTEMPTS):
+        if request.param == 'memory':
+            return broker.MemoryBroker(max_attempts)
+        return broker.SQLiteBroker(str(tmp_path / 'broker.sqlite'),
+                                   max_attempts)
+    return _make_broker
+
+
+def test_fetch_ack(make_broker):
+    b = make_broker()
+    b.publish([('m{n}'.format(n=n), 'payload {n}'.format(n=n))
+               for n in range(5)])
+    # prefetch limit, in order of publication
+    assert b.fetch('w1', 2, 60) == [('m0', 'payload 0'), ('m1', 'payload 1')]
+    assert [m for (m, _) in b.fetch('w2', 10, 60)] == ['m2', 'm3', 'm4']
+    assert b.fetch('w1', 10, 60) == []
+    assert b.ack('m0', 'w1', broker.RESULT, 'done')
+    # only the worker holding the lease can acknowledge the message
+    assert not b.ack('m2', 'w1', broker.RESULT, 'done')
+    assert not b.ack('m0', 'w1', broker.RESULT, 'again')
+    assert b.stream('m1', 'w1', 'streamed')
+    # streams are checked like acknowledgements
+    assert not b.stream('m2', 'w1', 'streamed')
+    assert not b.stream('m0', 'w1', 'streamed')
+    assert b.take((broker.RESULT, broker.ERROR)) == [
+        broker.Record('m0', broker.RESULT, 'done')]
+    assert b.take((broker.RESULT, )) == []
+    assert b.take((broker.STREAM, )) == [
+        broker.Record('m1', broker.STREAM, 'streamed')]
+    b.close()
+
+
+def test_redelivery(make_broker):
+    b = make_broker(max_attempts=2)
+    b.publish([('m0', 'payload'), ('m1', 'payload')])
+    assert len(b.fetch('w1', 2, 0.2)) == 2
+    b.extend(['m1'], 'w1', 60)
+    assert b.stream('m0', 'w1', 'first')
+    time.sleep(.3)
+    # the lease of m0 expired, it is delivered again and w1 lost it
+    assert b.fetch('w2', 10, 0.2) == [('m0', 'payload')]
+    assert not b.ack('m0', 'w1', broker.RESULT, 'late')
+    assert not b.stream('m0', 'w1', 'late')
+    # the tasks of the new delivery stream again
+    assert b.stream('m0', 'w2', 'second')
+    time.sleep(.3)
+    # m0 was delivered twice and fails
+    assert b.fetch('w2', 10, 60) == []
+    records = b.take((broker.RESULT, broker.ERROR))
+    assert [(r.message_id, r.kind) for r in records] == [
+        ('m0', broker.ERROR)]
+    # nothing is streamed for a message with a result
+    assert not b.stream('m0', 'w2', 'failed')
+    assert b.take((broker.STREAM, )) == [
+        broker.Record('m0', broker.STREAM, 'first'),
+        broker.Record('m0', broker.STREAM, 'second')]
+    assert b.ack('m1', 'w1', broker.RESULT, 'done')
+    b.close()
+
+
+def test_purge(make_broker):
+    b = make_broker()
+    b.publish([('m0', 'payload'), ('m1', 'payload')])
+    b.fetch('w1', 1, 60)
+    assert b.purge() == ['m1']
+    assert b.fetch('w1', 10, 60) == []
+    assert b.ack('m0', 'w1', broker.RESULT, 'done')
+    b.close()
+
+
+def test_worker(tmp_path, make_conf, make_broker):
+    conf = make_conf()
+    (tmp_path / 'a.txt').write_text('hello\n')
+    b = make_broker()
+    b.publish([
+        ('m0', broker.encode_message([Raw(str(tmp_path / 'a.txt'), conf)])),
+        ('m1', json.dumps([{'name': 'NoSuchTask', 'path': 'x'}])),
+    ])
+    worker = broker.Worker(b, conf, prefetch=1, poll_interval=.05)
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    records = []
+    deadline = time.time() + 10
+    while len(records) < 2 and time.time() < deadline:
+        records.extend(b.take((broker.RESULT, broker.ERROR)))
+        time.sleep(.05)
+    worker.stop()
+    thread.join()
+    assert [(r.message_id, r.kind) for r in records] == [
+        ('m0', broker.RESULT), ('m1', broker.ERROR)]
+    completed = json.loads(records[0].payload)
+    assert completed[0]['name'] == 'Raw'
+    assert completed[0]['completed']
+    assert completed[0]['next_tasks']
+
+
+def test_open_broker(tmp_path):
+    assert isinstance(broker.open_broker('memory://'), broker.MemoryBroker)
+    b = broker.open_broker('sqlite://' + str(tmp_path / 'b.sqlite'))
+    assert isinstance(b, broker.SQLiteBroker)
+    with pytest.raises(Exception):
+        broker.open_broker('amqp://localhost')
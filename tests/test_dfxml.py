@@ -0,0 +1,127 @@
+import io
+import json
+import hashlib
+import xml.etree.ElementTree
+
+from forework import dfxml, sources, dedup
+from forework.results import Results
+from forework.tasks.textfile import TextFile
+
+
+FIWALK_INVENTORY = '''<?xml version="1.0" encoding="UTF-8"?>
+<dfxml xmlns="{ns}" version="1.0">
+  <volume offset="1024">
+    <fileobject>
+      <filename>dir</filename>
+      <name_type>d</name_type>
+    </fileobject>
+    <fileobject>
+      <filename>dir/photo.jpg</filename>
+      <filesize>{size}</filesize>
+      <alloc>1</alloc>
+      <libmagic>JPEG image data, JFIF standard 1.01</libmagic>
+      <byte_runs>
+        <byte_run file_offset="0" fs_offset="0" len="100"/>
+        <byte_run file_offset="100" fs_offset="2048" len="{rest}"/>
+      </byte_runs>
+    </fileobject>
+    <fileobject>
+      <filename>deleted.txt</filename>
+      <unalloc>1</unalloc>
+      <libmagic>ASCII text</libmagic>
+      <byte_runs><byte_run fs_offset="4096" len="5"/></byte_runs>
+    </fileobject>
+  </volume>
+</dfxml>
+'''
+
+
+def test_import_image(tmp_path, make_conf, make_jpeg):
+    jpeg = make_jpeg()
+    image = bytearray(8192)
+    # a fragmented JPEG in a volume at offset 1024
+    image[1024:1124] = jpeg[:100]
+    image[3072:3072 + len(jpeg) - 100] = jpeg[100:]
+    image_path = tmp_path / 'disk.raw'
+    image_path.write_bytes(bytes(image))
+    inventory = tmp_path / 'disk.xml'
+    inventory.write_text(FIWALK_INVENTORY.format(
+        ns=dfxml.DFXML_NAMESPACE, size=len(jpeg), rest=len(jpeg) - 100))
+
+    fileobjects = list(dfxml.iter_fileobjects(str(inventory)))
+    assert [f['filename'] for f in fileobjects] == [
+        'dir', 'dir/photo.jpg', 'deleted.txt']
+    assert fileobjects[1]['byte_runs'] == [(1024, 100),
+                                           (3072, len(jpeg) - 100)]
+    assert not fileobjects[2]['alloc']
+
+    conf = make_conf()
+    tasks = list(dfxml.import_tasks(str(inventory), conf,
+                                    root=str(image_path)))
+    assert len(tasks) == 1
+    task = tasks[0]
+    assert task._name == 'JpegFile'
+    assert task.path == '{i}/dir/photo.jpg'.format(i=image_path)
+    with task.open() as fd:
+        assert fd.read() == jpeg
+    assert task.start().results['exif']['Make'] == 'Canon'
+    deleted = list(dfxml.import_tasks(str(inventory), conf,
+                                      root=str(image_path), deleted=True))
+    assert [t._name for t in deleted] == ['JpegFile', 'TextFile']
+
+
+def test_export_import(tmp_path, make_conf):
+    root = tmp_path / 'evidence'
+    root.mkdir()
+    (root / 'a.txt').write_text('some <text> & more\n')
+    data = b'\0' * 10 + b'carved text\n'
+    (root / 'blob').write_bytes(data)
+    conf = make_conf({'TextFile': {'grep': 'text'}}, entrypoint=str(root))
+    tasks = [
+        TextFile(str(root / 'a.txt'), conf).start(),
+        TextFile(str(root / 'blob') + '@10', conf,
+                 source=sources.byte_range(str(root / 'blob'), 10, 12)),
+    ]
+    tasks[1]._filetype = 'ASCII text'
+    tasks[1].start()
+    deduplicator = dedup.Deduplicator(algorithm='md5', workers=1)
+    digest = hashlib.md5(b'some <text> & more\n').hexdigest()
+    deduplicator.check(tasks[0], digest)
+    deduplicator.stop()
+    results = Results(tasks)
+    output = str(tmp_path / 'results.xml')
+    assert results.save(output) == output
+
+    document = xml.etree.ElementTree.parse(output).getroot()
+    ns = {'d': dfxml.DFXML_NAMESPACE, 'fw': dfxml.FOREWORK_NAMESPACE}
+    fileobjects = document.findall('d:fileobject', ns)
+    assert len(fileobjects) == 2
+    assert fileobjects[0].find('d:filename', ns).text == str(root / 'a.txt')
+    assert fileobjects[0].find('d:filesize', ns).text == '19'
+    hashdigest = fileobjects[0].find('d:hashdigest', ns)
+    assert (hashdigest.get('type'), hashdigest.text) == ('md5', digest)
+    task = fileobjects[1].find('fw:task', ns)
+    assert task.get('name') == 'TextFile'
+    assert json.loads(task.find('fw:result', ns).text) == tasks[1].results
+    run = fileobjects[1].find('d:byte_runs/d:byte_run', ns)
+    assert (run.get('img_offset'), run.get('len')) == ('10', '12')
+
+    # the results can be imported again as an inventory of the entry point
+    imported = list(dfxml.import_tasks(output, conf))
+    assert [t.path for t in imported] == [str(root / 'a.txt'),
+                                          str(root / 'blob') + '@10']
+    # a.txt was not identified, Raw does it
+    assert [t._name for t in imported] == ['Raw', 'TextFile']
+    with imported[1].open() as fd:
+        assert fd.read() == b'carved text\n'
+
+
+def test_writer_streams(make_conf):
+    fd = io.StringIO()
+    writer = dfxml.DFXMLWriter(fd, image_filename='disk.raw')
+    writer.write({'name': 'Raw', 'path': '/a', 'result': 'data'})
+    # the file object is written right away
+    assert fd.getvalue().endswith('</fileobject>\n')
+    writer.close()
+    assert writer.count == 1
+    xml.etree.ElementTree.fromstring(fd.getvalue())
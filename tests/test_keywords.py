@@ -0,0 +1,48 @@
+import pytest
+
+from forework import keywords
+
+
+def find_all(data, words, case_sensitive=False):
+    if not case_sensitive:
+        data, words = data.lower(), [w.lower() for w in words]
+    found = []
+    for word in words:
+        start = data.find(word)
+        while start >= 0:
+            found.append((start, start + len(word), word))
+            start = data.find(word, start + 1)
+    return sorted(found)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 1024])
+def test_finditer(chunk_size):
+    words = ['he', 'she', 'his', 'hers', 'ushers']
+    data = b'ushers said his and she and hers'
+    automaton = keywords.KeywordAutomaton(words, native=False)
+    chunks = [data[i:i + chunk_size]
+              for i in range(0, len(data), chunk_size)]
+    found = sorted(automaton.finditer(chunks))
+    assert found == find_all(data.decode(), words)
+
+
+def test_case(tmp_path):
+    path = tmp_path / 'notes.txt'
+    path.write_text('Mail JOHN@example.com or john@example.com\n')
+    automaton = keywords.KeywordAutomaton(['john@example.com', 'alice'])
+    with path.open('rb') as fd:
+        hits, truncated = automaton.scan(fd, max_hits=1, chunk_size=4)
+    assert hits == {'john@example.com': [5]}
+    assert truncated
+    automaton = keywords.KeywordAutomaton(['john@example.com'],
+                                          case_sensitive=True)
+    with path.open('rb') as fd:
+        assert automaton.scan(fd) == ({'john@example.com': [25]}, False)
+
+
+def test_get_automaton(tmp_path):
+    path = tmp_path / 'keywords.txt'
+    path.write_text('# names\nalice\n\nbob\n')
+    automaton = keywords.get_automaton(str(path))
+    assert len(automaton) == 2
+    assert keywords.get_automaton(str(path)) is automaton
@@ -0,0 +1,59 @@
+import os
+import random
+import hashlib
+
+import pytest
+
+from forework import knownhashes
+
+
+def random_digests(count, seed=0):
+    rng = random.Random(seed)
+    return [bytes(rng.randrange(256) for _ in range(20))
+            for _ in range(count)]
+
+
+def test_build_index(tmp_path):
+    digests = random_digests(5000)
+    # digests sharing a prefix, and listed twice
+    digests += [b'\0' * 20, b'\0' * 19 + b'\1', b'\0\0\1' + b'\0' * 17]
+    half = len(digests) // 2
+    (tmp_path / 'a.txt').write_text(
+        '\n'.join(d.hex() for d in digests[:half]) + '\n')
+    # NSRL-style CSV, with upper case digests and other hashes
+    (tmp_path / 'b.csv').write_text('"SHA-1","MD5","FileName"\n' + ''.join(
+        '"{s}","{m}","file{i}"\n'.format(s=d.hex().upper(), m='0' * 32, i=i)
+        for (i, d) in enumerate(digests[half - 10:])
+    ))
+    output = str(tmp_path / 'known.idx')
+    count = knownhashes.build_index(
+        [str(tmp_path / 'a.txt'), str(tmp_path / 'b.csv')], output)
+    assert count == len(digests)
+    with knownhashes.KnownHashes(output) as index:
+        assert len(index) == len(digests)
+        assert index.algorithm == 'sha1'
+        for digest in digests:
+            assert digest in index
+            assert digest.hex() in index
+        for digest in random_digests(1000, seed=1):
+            assert digest not in index
+        assert b'\0' * 16 not in index
+
+
+def test_md5_index(tmp_path):
+    data = [b'known %d' % i for i in range(100)]
+    (tmp_path / 'md5.txt').write_text(''.join(
+        hashlib.md5(d).hexdigest() + '\n' for d in data))
+    output = str(tmp_path / 'known.idx')
+    knownhashes.build_index([str(tmp_path / 'md5.txt')], output, 'md5')
+    with knownhashes.KnownHashes(output) as index:
+        assert index.algorithm == 'md5'
+        assert hashlib.md5(data[0]).hexdigest() in index
+        assert hashlib.md5(b'unknown').hexdigest() not in index
+
+
+def test_invalid_index(tmp_path):
+    path = tmp_path / 'invalid.idx'
+    path.write_bytes(os.urandom(knownhashes.HEADER_SIZE))
+    with pytest.raises(Exception):
+        knownhashes.KnownHashes(str(path))
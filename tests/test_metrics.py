@@ -0,0 +1,67 @@
+from forework import metrics, task_queue
+from forework.basetask import PRIO_HIGH, PRIO_LOW
+from forework.tasks.raw import Raw
+
+
+def test_histogram():
+    histogram = metrics.Histogram((1, 2, 5))
+    for value in (0.5, 1, 1.5, 3, 10):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1, 1]
+    assert histogram.count == 5
+    assert histogram.sum == 16
+    assert histogram.quantile(.4) == 1
+    assert histogram.quantile(.5) == 2
+    assert histogram.quantile(.99) is None
+    assert metrics.Histogram().snapshot()['mean'] is None
+
+
+def test_queue_depths(make_conf):
+    conf = make_conf()
+    queue = task_queue.PriorityTaskQueue()
+    queue.put_nowait(Raw('a', conf, priority=PRIO_HIGH))
+    queue.put_nowait(Raw('b', conf))
+    queue.put_nowait(Raw('c', conf))
+    assert queue.depths() == {PRIO_HIGH: 1, 0: 2}
+    task, waited = queue.get_timed_nowait()
+    assert task.path == 'a'
+    assert waited >= 0
+    assert queue.reprioritize('Raw', PRIO_LOW) == 2
+    assert queue.depths() == {PRIO_LOW: 2}
+
+
+def test_prometheus(make_conf):
+    conf = make_conf()
+    scheduler_metrics = metrics.SchedulerMetrics()
+    scheduler_metrics.task_enqueued(2)
+    task = Raw('a "quoted" path', conf)
+    scheduler_metrics.task_dispatched(task, 0.003)
+    task.start()
+    scheduler_metrics.task_completed(task, task)
+    scheduler_metrics.task_completed(task, None)
+    snapshot = scheduler_metrics.snapshot({PRIO_HIGH: 3}, in_flight=1)
+    assert snapshot['enqueued']['total'] == 2
+    assert snapshot['completed']['total'] == 1
+    assert snapshot['failed']['total'] == 1
+    assert snapshot['queue_depth'] == {'high': 3}
+    assert snapshot['tasks']['Raw']['wait']['p50'] == 0.005
+    assert snapshot['tasks']['Raw']['run']['count'] == 1
+    assert list(snapshot['workers']) == [task._worker]
+    text = scheduler_metrics.prometheus({PRIO_HIGH: 3}, in_flight=1)
+    assert 'forework_tasks_enqueued_total 2.0\n' in text
+    assert 'forework_queue_depth{priority="high"} 3.0\n' in text
+    assert 'forework_task_wait_seconds_bucket{le="0.005",task="Raw"} 1.0\n' \
+        in text
+    assert 'forework_task_wait_seconds_bucket{le="+Inf",task="Raw"} 1.0\n' \
+        in text
+    assert '# TYPE forework_task_run_seconds histogram\n' in text
+
+
+def test_uptime(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(metrics.time, 'monotonic', lambda: clock[0])
+    scheduler_metrics = metrics.SchedulerMetrics()
+    clock[0] = 160.0
+    scheduler_metrics.start()
+    clock[0] = 170.0
+    assert scheduler_metrics.uptime == 10
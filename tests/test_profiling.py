@@ -0,0 +1,79 @@
+import sys
+import json
+
+import pytest
+
+from forework import profiling
+from forework.basetask import BaseTask
+from forework.tasks.raw import Raw
+
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+
+def profile_fib(n):
+    profiler = profiling.start_profiler('Raw', {'rate': 1})
+    fib(n)
+    return profiling.stop_profiler(profiler)
+
+
+def fib_calls(stats):
+    return [value[1] for (func, value) in stats.stats.items()
+            if func[2] == 'fib']
+
+
+def test_sampling():
+    assert profiling.start_profiler('Raw', None) is None
+    assert profiling.start_profiler('Raw', {'rate': 0}) is None
+    assert profiling.start_profiler('Raw', {'rate': 1,
+                                            'tasks': ['PDFFile']}) is None
+
+
+def test_aggregate(tmp_path):
+    data = profile_fib(10)
+    # the encoded profile survives a JSON round trip
+    data = json.loads(json.dumps(data))
+    aggregator = profiling.ProfileAggregator()
+    aggregator.add('Raw', data)
+    assert fib_calls(aggregator.stats('Raw')) == [177]
+    aggregator.add('Raw', profile_fib(5))
+    assert fib_calls(aggregator.stats('Raw')) == [177 + 15]
+    assert aggregator.counts == {'Raw': 2}
+    assert 'fib' in aggregator.report('Raw')
+    assert aggregator.report('PDFFile') == ''
+    assert aggregator.dump(str(tmp_path / 'profiles')) == [
+        str(tmp_path / 'profiles' / 'Raw.pstats')]
+
+
+def test_task_profile(tmp_path, make_conf):
+    conf = make_conf(profiling={'rate': 1, 'tasks': ['Raw']})
+    task = Raw(str(tmp_path), conf).start()
+    assert task._profile
+    restored = BaseTask.from_dict(json.loads(task.to_json()), conf)
+    assert restored._profile == json.loads(json.dumps(task._profile))
+    conf = make_conf()
+    assert Raw(str(tmp_path), conf).start()._profile is None
+
+
+def test_task_profile_errors(tmp_path, make_conf, monkeypatch):
+    conf = make_conf(profiling={'rate': 1, 'tasks': ['Raw']})
+
+    def interrupt(self):
+        raise KeyboardInterrupt()
+
+    # the profiler is stopped even if the run is interrupted
+    with monkeypatch.context() as patch:
+        patch.setattr(Raw, 'run', interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            Raw(str(tmp_path), conf).start()
+    assert sys.getprofile() is None
+
+    def active(self):
+        raise ValueError('Another profiling tool is already active')
+
+    # the run is not profiled if another profiler is active
+    monkeypatch.setattr(profiling.cProfile.Profile, 'enable', active)
+    task = Raw(str(tmp_path), conf).start()
+    assert task.done
+    assert task._profile is None
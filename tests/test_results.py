@@ -0,0 +1,50 @@
+import pytest
+
+from forework import results
+from forework.tasks.raw import Raw
+
+
+@pytest.mark.parametrize('store', ['results.jsonl', 'results.sqlite'])
+def test_store(tmp_path, make_conf, store):
+    conf = make_conf()
+    (tmp_path / 'a.txt').write_text('hello\n')
+    tasks = [Raw(str(tmp_path), conf).start(),
+             Raw(str(tmp_path / 'a.txt'), conf).start()]
+    filename = results.Results(tasks).save(str(tmp_path / store))
+    stored = results.Results.open(filename)
+    assert len(stored) == 2
+    assert stored[-1]['result'] == 'ASCII text'
+    assert [t['path'] for t in stored['Raw']] == [t.path for t in tasks]
+    loaded = stored.load(conf)
+    assert [t.results for t in loaded] == ['directory', 'ASCII text']
+    assert loaded[0].start_time == tasks[0].start_time
+    # saving again replaces the stored results
+    results.Results(tasks).save(filename)
+    assert len(results.Results.open(filename)) == 2
+
+
+def make_task(path, conf, start, end):
+    times = iter([results.to_epoch(start), results.to_epoch(end)])
+    task = Raw(path, conf, time_function=lambda: next(times))
+    task.done = False
+    task.done = True
+    return task
+
+
+def test_queries(tmp_path, make_conf):
+    conf = make_conf()
+    tasks = [
+        make_task('c', conf, '2016-01-01T10:00:00+00:00',
+                  '2016-01-01T10:00:05+00:00'),
+        make_task('a', conf, '2016-01-01T09:00:00+00:00',
+                  '2016-01-01T09:00:05+00:00'),
+        make_task('b', conf, '2016-01-01T09:00:03+00:00',
+                  '2016-01-01T11:00:00+00:00'),
+    ]
+    res = results.Results(tasks)
+    assert [t.path for t in res['Raw']] == ['c', 'a', 'b']
+    assert len(res['TextFile']) == 0
+    in_range = res.in_range('2016-01-01T08:00:00', '2016-01-01T10:30:00')
+    assert [t.path for t in in_range] == ['c', 'a']
+    assert [t.path for t in res[1:].in_range(
+        '2016-01-01T09:00:00', '2016-01-01T12:00:00')] == ['a', 'b']
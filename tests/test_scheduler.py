@@ -0,0 +1,507 @@
+import time
+import hashlib
+import zipfile
+import threading
+
+import pytest
+
+from forework import scheduler, knownhashes, sources, config, dedup
+from forework.tasks.raw import Raw
+from forework.tasks.jpeg import JpegFile
+from forework.tasks.directoryscanner import DirectoryScanner
+from forework.tasks.textfile import TextFile
+
+
+def wait_for_results(sched, count, timeout=30):
+    deadline = time.time() + timeout
+    while len(sched.results) < count and time.time() < deadline:
+        time.sleep(.1)
+    return sched.results
+
+
+def test_local_backend(tmp_path, make_conf):
+    root = tmp_path / 'evidence'
+    (root / 'sub').mkdir(parents=True)
+    (root / 'a.txt').write_text('hello\n')
+    (root / 'sub' / 'b.txt').write_text('world\n')
+    conf = make_conf(
+        {'DirectoryScanner': {'batch_size': 1}},
+        backend={'name': 'local', 'workers': 2},
+    )
+    sched = scheduler.Scheduler()
+    sched.set_config(conf)
+    sched.enqueue(Raw(str(root), conf))
+    sched.start()
+    try:
+        # Raw, 2 DirectoryScanners and 2 TextFiles
+        results = wait_for_results(sched, 5)
+    finally:
+        sched.stop()
+    names = sorted(task._name for task in results)
+    assert names == ['DirectoryScanner', 'DirectoryScanner', 'Raw',
+                     'TextFile', 'TextFile']
+
+
+def test_local_backend_abort(tmp_path, make_conf):
+    conf = make_conf(backend={'name': 'local', 'workers': 1})
+    backend = scheduler.get_backend(conf)
+    backend.start()
+    try:
+        futures = [backend.submit(Raw(str(tmp_path), conf))
+                   for _ in range(50)]
+        backend.abort()
+        backend.wait()
+    finally:
+        backend.stop()
+    assert all(future.done() for future in futures)
+    assert any(future.cancelled() for future in futures)
+
+
+def test_separate_queues(make_conf):
+    conf = make_conf()
+    first = scheduler.Scheduler()
+    second = scheduler.Scheduler()
+    first.enqueue(Raw('/nonexistent', conf))
+    assert first.queued == 1
+    assert second.queued == 0
+
+
+def test_dedup(tmp_path, make_conf):
+    root = tmp_path / 'evidence'
+    root.mkdir()
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        (root / name).write_text('same content\n')
+    conf = make_conf(
+        backend={'name': 'local', 'workers': 2},
+        dedup={'tasks': ['TextFile']},
+    )
+    sched = scheduler.Scheduler()
+    sched.set_config(conf)
+    sched.enqueue(Raw(str(root), conf))
+    sched.start()
+    try:
+        # Raw, DirectoryScanner and 3 TextFiles
+        results = wait_for_results(sched, 5)
+    finally:
+        sched.stop()
+    textfiles = results['TextFile']
+    assert len(textfiles) == 3
+    duplicates = [t for t in textfiles if t._duplicate_of is not None]
+    assert len(duplicates) == 2
+    assert len({t._content_hash for t in textfiles}) == 1
+    original = [t for t in textfiles if t._duplicate_of is None][0]
+    assert all(t._duplicate_of == original.path and
+               t.results == original.results for t in duplicates)
+
+
+def test_dedup_originals(tmp_path, make_conf):
+    conf = make_conf()
+    deduplicator = dedup.Deduplicator(tasks=['TextFile'], workers=1)
+    tasks = [TextFile(str(tmp_path / name), conf) for name in ('a', 'b')]
+    assert deduplicator.check(tasks[0], 'digest')
+    original = tasks.pop(0)
+    original._result = {'matches': []}
+    assert deduplicator.completed(original, original) == []
+    # the completed original is not kept to link its duplicates
+    assert deduplicator._originals == {
+        ('TextFile', 'digest'): ({'matches': []}, str(tmp_path / 'a'))}
+    assert not deduplicator.check(tasks[0], 'digest')
+    assert deduplicator.take_linked() == tasks
+    assert tasks[0].results == {'matches': []}
+    assert tasks[0]._duplicate_of == str(tmp_path / 'a')
+    deduplicator.stop()
+
+
+def test_dedup_hash_failure(tmp_path, make_conf):
+    archive = tmp_path / 'a.zip'
+    with zipfile.ZipFile(str(archive), 'w') as zf:
+        zf.writestr('a.txt', 'text\n')
+    conf = make_conf(
+        backend={'name': 'local', 'workers': 1},
+        dedup={'tasks': ['TextFile']},
+    )
+    # hashing a missing member raises a KeyError
+    source = sources.zip_member(str(archive), 'missing.txt', size=5)
+    sched = scheduler.Scheduler()
+    sched.set_config(conf)
+    sched.enqueue(TextFile(str(archive) + '/missing.txt', conf, source=source))
+    sched.start()
+    try:
+        # the task is run without deduplication
+        results = wait_for_results(sched, 1)
+    finally:
+        sched.stop()
+    assert [t._name for t in results] == ['TextFile']
+    assert results[0]._content_hash is None
+
+
+def test_known_hashes(tmp_path, make_conf):
+    root = tmp_path / 'evidence'
+    root.mkdir()
+    (root / 'known.txt').write_text('known content\n')
+    (root / 'copy.txt').write_text('known content\n')
+    (root / 'new.txt').write_text('new content\n')
+    (tmp_path / 'nsrl.txt').write_text(
+        hashlib.sha1(b'known content\n').hexdigest() + '\n')
+    index = str(tmp_path / 'nsrl.idx')
+    knownhashes.build_index([str(tmp_path / 'nsrl.txt')], index)
+
+    conf = make_conf(
+        backend={'name': 'local', 'workers': 2},
+        known_hashes=index,
+    )
+    sched = scheduler.Scheduler()
+    sched.set_config(conf)
+    sched.enqueue(Raw(str(root), conf))
+    sched.start()
+    try:
+        # Raw, DirectoryScanner, the unknown TextFile and the 2 known ones
+        results = wait_for_results(sched, 5)
+    finally:
+        sched.stop()
+    textfiles = results['TextFile']
+    assert [t.path for t in textfiles if not t._known] == \
+        [str(root / 'new.txt')]
+    known = [t for t in textfiles if t._known]
+    assert sorted(t.path for t in known) == [str(root / 'copy.txt'),
+                                             str(root / 'known.txt')]
+    # dropped known files are completed without being run
+    assert all(t.done and t.results is None for t in known)
+
+    # known files can be run last instead, deduplicated with no new hashing
+    conf = make_conf(
+        backend={'name': 'local', 'workers': 2},
+        known_hashes={'index': index, 'action': 'deprioritize'},
+        dedup={'tasks': ['TextFile']},
+    )
+    sched = scheduler.Scheduler()
+    sched.set_config(conf)
+    sched.enqueue(Raw(str(root), conf))
+    sched.start()
+    try:
+        results = wait_for_results(sched, 5)
+        snapshot = sched.metrics()
+    finally:
+        sched.stop()
+    textfiles = results['TextFile']
+    assert len(textfiles) == 3
+    known = [t for t in textfiles if t._known]
+    assert sorted(t.path for t in known) == [str(root / 'copy.txt'),
+                                             str(root / 'known.txt')]
+    assert all(t._priority < 0 for t in known)
+    assert len([t for t in known if t._duplicate_of is not None]) == 1
+    assert all(t._content_hash is not None for t in textfiles)
+    # Raw, DirectoryScanner and TextFile x3, plus the known files enqueued
+    # again with a lower priority
+    assert snapshot['enqueued']['total'] == 7
+
+
+def test_results_store(tmp_path, make_conf):
+    root = tmp_path / 'evidence'
+    root.mkdir()
+    (root / 'a.txt').write_text('hello\n')
+    store = tmp_path / 'results.sqlite'
+    conf = make_conf(
+        backend={'name': 'local', 'workers': 2},
+        results={'store': str(store), 'batch_size': 1},
+    )
+    sched = scheduler.Scheduler()
+    sched.set_config(conf)
+    sched.enqueue(Raw(str(root), conf))
+    sched.start()
+    try:
+        results = wait_for_results(sched, 3)
+    finally:
+        sched.stop()
+    assert sched._finished_tasks == []
+    assert len(results) == 3
+    assert [t['path'] for t in results['TextFile']] == [str(root / 'a.txt')]
+    loaded = results.load(conf, name='Raw')
+    assert loaded[0].done is True
+    assert loaded[0].results == 'directory'
+
+
+def run_until_idle(sched, timeout=30):
+    sched.start()
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            time.sleep(.2)
+            if not sched.queued and not sched.in_flight:
+                break
+    finally:
+        sched.stop()
+    return sched.results
+
+
+class FakeView:
+    def __init__(self, client, targets=None):
+        self.client = client
+        self.targets = targets
+
+    def apply_sync(self, func, *args):
+        self.client.calls.append((self.targets, func, args))
+
+    def apply_async(self, func, *args):
+        self.client.calls.append((self.targets, func, args))
+
+
+class FakeClient:
+    def __init__(self, profile=None):
+        self.ids = [0, 1]
+        self.calls = []
+
+    def __getitem__(self, targets):
+        return FakeView(self, targets)
+
+    def load_balanced_view(self):
+        return FakeView(self)
+
+
+def test_ipyparallel_config(make_conf, monkeypatch):
+    conf = make_conf()
+    monkeypatch.setattr(scheduler.ipyparallel, 'Client', FakeClient)
+    backend = scheduler.IPyParallelBackend(conf)
+    backend.start()
+    client = backend._client
+    task = Raw('a', conf)
+    backend.submit(task)
+    # engines joining later get the configuration once, before their tasks
+    client.ids.append(2)
+    backend.submit(task)
+    backend.submit_batch([task])
+    assert client.calls == [
+        ([0, 1], config.register, (conf, )),
+        ([0, 1], scheduler._run_task, (task, )),
+        ([2], config.register, (conf, )),
+        ([0, 1, 2], scheduler._run_task, (task, )),
+        ([0, 1, 2], scheduler._run_batch, ([task], )),
+    ]
+
+
+def test_checkpoint_resume(tmp_path, make_conf):
+    root = tmp_path / 'evidence'
+    root.mkdir()
+    (root / 'a.txt').write_text('hello\n')
+    checkpoint_file = tmp_path / 'inv.checkpoint'
+    conf = make_conf(
+        backend={'name': 'local', 'workers': 2},
+        checkpoint={'path': str(checkpoint_file), 'interval': 3600},
+    )
+    sched = scheduler.Scheduler()
+    sched.set_config(conf)
+    sched.enqueue(Raw(str(root), conf))
+    sched.start()
+    try:
+        wait_for_results(sched, 3)
+    finally:
+        sched.stop()
+    assert checkpoint_file.exists()
+
+    resumed = scheduler.Scheduler()
+    resumed.set_config(conf)
+    resumed.resume()
+    assert len(resumed.results) == 3
+    # finished tasks are not run again
+    resumed.enqueue(Raw(str(root), conf))
+    results = run_until_idle(resumed)
+    assert len(results) == 3
+    assert resumed.metrics()['completed']['total'] == 0
+
+
+def test_checkpoint_streaming(tmp_path, make_conf, monkeypatch):
+    root = tmp_path / 'evidence'
+    root.mkdir()
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        (root / name).write_text(name + '\n')
+    checkpoint_file = tmp_path / 'inv.checkpoint'
+    conf = make_conf(
+        {'DirectoryScanner': {'batch_size': 1}},
+        backend={'name': 'broker', 'workers': 2},
+        checkpoint={'path': str(checkpoint_file), 'interval': 3600},
+        # the streamed tasks wait in the queue while the scanner runs
+        max_in_flight=1,
+    )
+    run = DirectoryScanner.run
+    streamed = threading.Event()
+
+    def slow_run(self):
+        run(self)
+        streamed.set()
+        time.sleep(1)
+
+    monkeypatch.setattr(DirectoryScanner, 'run', slow_run)
+    sched = scheduler.Scheduler()
+    sched.set_config(conf)
+    sched.enqueue(DirectoryScanner(str(root), conf))
+    sched.start()
+    try:
+        assert streamed.wait(10)
+        deadline = time.time() + 10
+        while sched.queued < 3 and time.time() < deadline:
+            time.sleep(.05)
+    finally:
+        sched.stop()
+    assert sched.queued == 3
+
+    # the scanner is run again, and its follow-up tasks are run only once,
+    # even if they are all submitted at once
+    conf = make_conf(
+        {'DirectoryScanner': {'batch_size': 1}},
+        backend={'name': 'broker', 'workers': 1},
+        checkpoint={'path': str(checkpoint_file), 'interval': 3600},
+    )
+    resumed = scheduler.Scheduler()
+    resumed.set_config(conf)
+    resumed.resume()
+    results = run_until_idle(resumed)
+    names = sorted(task._name for task in results)
+    assert names == ['DirectoryScanner', 'TextFile', 'TextFile', 'TextFile']
+
+
+def test_checkpoint_stop(tmp_path, make_conf, monkeypatch):
+    root = tmp_path / 'evidence'
+    root.mkdir()
+    checkpoint_file = tmp_path / 'inv.checkpoint'
+    conf = make_conf(
+        backend={'name': 'local', 'workers': 1},
+        checkpoint={'path': str(checkpoint_file), 'interval': 3600},
+    )
+    run = TextFile.run
+
+    def slow_run(self):
+        time.sleep(.2)
+        run(self)
+
+    # the worker processes are forked with the slow run
+    monkeypatch.setattr(TextFile, 'run', slow_run)
+    sched = scheduler.Scheduler()
+    sched.set_config(conf)
+    for index in range(20):
+        path = root / '{i}.txt'.format(i=index)
+        path.write_text('{i}\n'.format(i=index))
+        sched.enqueue(TextFile(str(path), conf))
+    sched.start()
+    time.sleep(1)
+    sched.stop()
+    # the tasks submitted but not started are pending, not failed
+    snapshot = sched.metrics()
+    assert snapshot['failed']['total'] == 0
+    assert 0 < len(sched.results) < 20
+
+    monkeypatch.setattr(TextFile, 'run', run)
+    resumed = scheduler.Scheduler()
+    resumed.set_config(conf)
+    resumed.resume()
+    results = run_until_idle(resumed)
+    assert sorted(task.path for task in results) == sorted(
+        str(root / '{i}.txt'.format(i=index)) for index in range(20))
+
+
+def test_batches(tmp_path, make_conf, monkeypatch, make_jpeg):
+    conf = make_conf(backend={'name': 'local', 'workers': 2})
+    tasks = []
+    for index in range(JpegFile.BATCH_SIZE + 2):
+        path = tmp_path / '{i}.jpg'.format(i=index)
+        make_jpeg(path)
+        tasks.append(JpegFile(str(path), conf))
+    sched = scheduler.Scheduler()
+    sched.set_config(conf)
+    submitted = []
+    submit_batch = scheduler.ProcessPoolBackend.submit_batch
+
+    def spy(backend, batch):
+        submitted.append(len(batch))
+        return submit_batch(backend, batch)
+
+    monkeypatch.setattr(scheduler.ProcessPoolBackend, 'submit_batch', spy)
+    sched.enqueue_many(tasks)
+    sched.start()
+    try:
+        results = wait_for_results(sched, len(tasks))
+    finally:
+        sched.stop()
+    assert len(results) == len(tasks)
+    assert all(t.results['exif']['Make'] == 'Canon' for t in results)
+    assert submitted == [JpegFile.BATCH_SIZE, 2]
+
+
+@pytest.mark.parametrize('url', ['memory://', 'sqlite'])
+def test_broker_backend(tmp_path, make_conf, url):
+    root = tmp_path / 'evidence'
+    (root / 'sub').mkdir(parents=True)
+    (root / 'a.txt').write_text('hello\n')
+    (root / 'sub' / 'b.txt').write_text('world\n')
+    if url == 'sqlite':
+        url = 'sqlite://' + str(tmp_path / 'broker.sqlite')
+    conf = make_conf(
+        {'DirectoryScanner': {'batch_size': 1}},
+        backend={'name': 'broker', 'url': url, 'workers': 2,
+                 'poll_interval': .02},
+    )
+    sched = scheduler.Scheduler()
+    sched.set_config(conf)
+    sched.enqueue(Raw(str(root), conf))
+    sched.start()
+    try:
+        # Raw, 2 DirectoryScanners and 2 TextFiles
+        results = wait_for_results(sched, 5)
+    finally:
+        sched.stop()
+    names = sorted(task._name for task in results)
+    assert names == ['DirectoryScanner', 'DirectoryScanner', 'Raw',
+                     'TextFile', 'TextFile']
+
+
+def test_metrics(tmp_path, make_conf):
+    root = tmp_path / 'evidence'
+    root.mkdir()
+    (root / 'a.txt').write_text('hello\n')
+    prometheus = tmp_path / 'forework.prom'
+    conf = make_conf(
+        backend={'name': 'local', 'workers': 2},
+        metrics={'prometheus': str(prometheus), 'interval': 0},
+    )
+    sched = scheduler.Scheduler()
+    sched.set_config(conf)
+    sched.enqueue(Raw(str(root), conf))
+    sched.start()
+    try:
+        # Raw, DirectoryScanner and TextFile
+        wait_for_results(sched, 3)
+        snapshot = sched.metrics()
+    finally:
+        sched.stop()
+    assert snapshot['enqueued']['total'] == 3
+    assert snapshot['completed']['total'] == 3
+    assert snapshot['queued'] == 0
+    assert sorted(snapshot['tasks']) == ['DirectoryScanner', 'Raw',
+                                         'TextFile']
+    assert 0 < len(snapshot['workers']) <= 2
+    assert snapshot['scheduler_loop']['count'] > 0
+    assert 'forework_tasks_completed_total 3.0' in prometheus.read_text()
+
+
+def test_profiling(tmp_path, make_conf):
+    root = tmp_path / 'evidence'
+    root.mkdir()
+    (root / 'a.txt').write_text('hello\n')
+    output = tmp_path / 'profiles'
+    conf = make_conf(
+        backend={'name': 'local', 'workers': 2},
+        profiling={'rate': 1, 'output': str(output)},
+    )
+    sched = scheduler.Scheduler()
+    sched.set_config(conf)
+    sched.enqueue(Raw(str(root), conf))
+    sched.start()
+    try:
+        # Raw, DirectoryScanner and TextFile
+        results = wait_for_results(sched, 3)
+    finally:
+        sched.stop()
+    assert sched.profiles.counts == {'Raw': 1, 'DirectoryScanner': 1,
+                                     'TextFile': 1}
+    assert all(task._profile is None for task in results)
+    assert sorted(p.name for p in output.iterdir()) == [
+        'DirectoryScanner.pstats', 'Raw.pstats', 'TextFile.pstats']
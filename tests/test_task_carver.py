@@ -0,0 +1,79 @@
+import io
+import struct
+import zipfile
+
+import PIL.Image
+
+from forework import sources
+from forework.basetask import BaseTask
+from forework.tasks.carver import Carver
+
+
+def make_blob(tmp_path, make_jpeg, make_pdf):
+    pdf = tmp_path / 'doc.pdf'
+    make_pdf(pdf)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('a.txt', 'text\n')
+    objects = [make_jpeg(), pdf.read_bytes(), archive.getvalue()]
+    junk = b'\0junk\xff' * 100
+    return junk + junk.join(objects) + junk, objects
+
+
+def test_carve(tmp_path, make_conf, make_jpeg, make_pdf):
+    blob, objects = make_blob(tmp_path, make_jpeg, make_pdf)
+    path = tmp_path / 'blob.raw'
+    path.write_bytes(blob)
+    conf = make_conf()
+    task = Carver(str(path), conf).start()
+    assert task.results == {
+        'carved': {'jpeg': 1, 'pdf': 1, 'zip': 1},
+        'unknown': 0,
+    }
+    carved = [BaseTask.from_json(t, conf) for t in task.next_tasks]
+    assert [t._name for t in carved] == ['JpegFile', 'PDFFile', 'ZipFile']
+    for (task, data) in zip(carved, objects):
+        assert task.path == '{p}@{o}'.format(p=path, o=blob.index(data))
+        with task.open() as fd:
+            assert fd.read() == data
+    assert carved[0].start().results['exif']['Make'] == 'Canon'
+
+
+def test_carve_range(tmp_path, make_conf, make_jpeg, make_pdf):
+    blob, objects = make_blob(tmp_path, make_jpeg, make_pdf)
+    path = tmp_path / 'blob.raw'
+    path.write_bytes(blob)
+    conf = make_conf({'Carver': {'signatures': ['jpeg', 'zip']}})
+    # only the end of the blob, with the zip file
+    offset = blob.index(objects[2]) - 3
+    source = sources.byte_range(str(path), offset, len(blob) - offset)
+    task = Carver(str(path) + '@tail', conf, source=source).start()
+    assert task.results['carved'] == {'zip': 1}
+    carved = BaseTask.from_json(task.next_tasks[0], conf)
+    with carved.open() as fd:
+        assert fd.read() == objects[2]
+
+
+def test_carve_footers(tmp_path, make_conf, make_jpeg, make_pdf):
+    # a JPEG with a thumbnail in its EXIF segment, which has its own EOI
+    thumbnail = io.BytesIO()
+    PIL.Image.new('RGB', (4, 4)).save(thumbnail, 'JPEG')
+    exif = b'Exif\0\0II*\0\x08\0\0\0' + thumbnail.getvalue()
+    picture = make_jpeg()
+    picture = picture[:2] + b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + \
+        exif + picture[2:]
+    # a PDF with an incremental update, after its first %%EOF
+    pdf = tmp_path / 'doc.pdf'
+    make_pdf(pdf)
+    document = pdf.read_bytes() + b'% update\ntrailer\n<<>>\n%%EOF\n'
+    objects = [picture, document, document]
+    junk = b'\0junk\xff' * 100
+    path = tmp_path / 'blob.raw'
+    path.write_bytes(junk + junk.join(objects))
+    conf = make_conf({'Carver': {'signatures': ['jpeg', 'pdf']}})
+    task = Carver(str(path), conf).start()
+    assert task.results['carved'] == {'jpeg': 1, 'pdf': 2}
+    carved = [BaseTask.from_json(t, conf) for t in task.next_tasks]
+    for (task, data) in zip(carved, objects):
+        with task.open() as fd:
+            assert fd.read().rstrip(b'\n') == data.rstrip(b'\n')
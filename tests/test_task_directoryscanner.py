@@ -0,0 +1,50 @@
+import json
+
+from forework import basetask
+from forework.tasks.directoryscanner import DirectoryScanner
+
+
+def make_tree(root):
+    (root / 'sub').mkdir(parents=True)
+    (root / 'a.txt').write_text('hello\n')
+    (root / 'sub' / 'b.txt').write_text('world\n')
+    return root
+
+
+def next_task_paths(task):
+    return sorted(json.loads(t)['path'] for t in task.to_dict()['next_tasks'])
+
+
+def test_run(tmp_path, make_conf):
+    root = make_tree(tmp_path / 'evidence')
+    task = DirectoryScanner(str(root), make_conf())
+    task.start()
+    assert task.done is True
+    assert next_task_paths(task) == [str(root / 'a.txt'), str(root / 'sub')]
+
+
+def test_run_recursive(tmp_path, make_conf):
+    root = make_tree(tmp_path / 'evidence')
+    conf = make_conf({'DirectoryScanner': {'recursive': True}})
+    task = DirectoryScanner(str(root), conf)
+    task.start()
+    assert next_task_paths(task) == [
+        str(root / 'a.txt'),
+        str(root / 'sub' / 'b.txt'),
+    ]
+
+
+def test_run_streaming(tmp_path, make_conf):
+    root = make_tree(tmp_path / 'evidence')
+    conf = make_conf({'DirectoryScanner': {'recursive': True, 'batch_size': 1}})
+    batches = []
+    basetask.set_emitter(batches.append)
+    try:
+        task = DirectoryScanner(str(root), conf)
+        task.start()
+    finally:
+        basetask.set_emitter(None)
+    assert len(batches) == 2
+    assert all(len(batch) == 1 for batch in batches)
+    assert task.to_dict()['next_tasks'] == []
+    assert task.results.startswith('Found 2 tasks')
@@ -0,0 +1,69 @@
+import math
+import random
+import collections
+
+from forework import sources
+from forework.basetask import BaseTask, PRIO_HIGH
+from forework.tasks.entropy import (Entropy, block_entropy, decode_profile,
+                                    find_regions)
+
+
+def entropy(data):
+    counts = collections.Counter(data)
+    return -sum(c / len(data) * math.log2(c / len(data))
+                for c in counts.values())
+
+
+def test_block_entropy():
+    rng = random.Random(0)
+    data = bytes(rng.randrange(256) for _ in range(10000)) + b'a' * 300
+    values = block_entropy(data, 512)
+    assert len(values) == 21
+    for (index, value) in enumerate(values):
+        assert math.isclose(value, entropy(data[index * 512:][:512]),
+                            abs_tol=1e-9)
+    assert list(block_entropy(data, 512, 1024, 2048)) == list(values[2:4])
+    assert len(block_entropy(b'', 512)) == 0
+
+
+def test_find_regions():
+    assert find_regions([8, 1, 8, 8, 8, 1, 8, 8], 7, 2) == [(2, 3), (6, 2)]
+
+
+def test_run(tmp_path, make_conf):
+    rng = random.Random(0)
+    noise = bytes(rng.randrange(256) for _ in range(64 * 1024))
+    data = b'\0' * 8192 + noise + b'text ' * 2000
+    path = tmp_path / 'disk.raw'
+    path.write_bytes(data)
+    conf = make_conf({'Entropy': {'block_size': 1024, 'threshold': 7.5,
+                                  'min_region_size': 16 * 1024}})
+    task = Entropy(str(path), conf).start()
+    results = task.results
+    assert results['blocks'] == 82
+    assert results['regions'] == [[8192, len(noise)]]
+    profile = decode_profile(results['profile'])
+    assert len(profile) == 82
+    assert max(profile[:8]) == 0
+    assert min(profile[8:72]) > 7.5
+    assert max(profile[72:]) < 3
+    region = BaseTask.from_json(task.next_tasks[0], conf)
+    assert region._name == 'Carver'
+    assert region._priority == PRIO_HIGH
+    with region.open() as fd:
+        assert fd.read() == noise
+
+
+def test_run_range(tmp_path, make_conf):
+    rng = random.Random(0)
+    noise = bytes(rng.randrange(256) for _ in range(4096))
+    path = tmp_path / 'disk.raw'
+    path.write_bytes(b'\0' * 1000 + noise + b'\0' * 1000)
+    conf = make_conf({'Entropy': {'block_size': 512, 'threshold': 7,
+                                  'min_region_size': 0,
+                                  'region_tasks': []}})
+    source = sources.byte_range(str(path), 1000, 4096)
+    task = Entropy(str(path) + '@1000', conf, source=source).start()
+    assert task.results['blocks'] == 8
+    assert task.results['regions'] == [[0, 4096]]
+    assert task.next_tasks == []
@@ -0,0 +1,89 @@
+import shutil
+import struct
+import threading
+import subprocess
+
+import pytest
+
+from forework.basetask import BaseTask
+from forework.tasks.image import Image
+
+
+PARTITION_OFFSET = 1024 * 1024
+
+
+def make_disk(tmp_path):
+    '''
+    Build a disk image with an MBR and a single ext4 partition
+    '''
+    content = tmp_path / 'content'
+    (content / 'sub').mkdir(parents=True)
+    (content / 'sub' / 'a.txt').write_text('secret: 1\n')
+    (content / 'b.txt').write_text('hello\n')
+    filesystem = tmp_path / 'fs.img'
+    with filesystem.open('wb') as fd:
+        fd.truncate(4 * 1024 * 1024)
+    subprocess.check_call(['mkfs.ext4', '-q', '-F', '-d', str(content),
+                           str(filesystem)])
+    sectors = filesystem.stat().st_size // 512
+    entry = struct.pack('<B3sB3sII', 0, b'\0' * 3, 0x83, b'\0' * 3,
+                        PARTITION_OFFSET // 512, sectors)
+    mbr = b'\0' * 446 + entry + b'\0' * 48 + b'\x55\xaa'
+    disk = tmp_path / 'disk.img'
+    with disk.open('wb') as fd:
+        fd.write(mbr)
+        fd.seek(PARTITION_OFFSET)
+        fd.write(filesystem.read_bytes())
+    return disk
+
+
+@pytest.mark.skipif(shutil.which('mkfs.ext4') is None,
+                    reason='requires mkfs.ext4')
+def test_tsk(tmp_path, make_conf):
+    disk = make_disk(tmp_path)
+    conf = make_conf({'Image': {'mode': 'tsk'},
+                      'TextFile': {'grep': 'secret'}})
+    task = Image(str(disk), conf).start()
+    assert task.results == 'Partitions: 1 found'
+    partition = BaseTask.from_json(task.next_tasks[0], conf)
+    assert partition._offset == PARTITION_OFFSET
+
+    partition.start()
+    files = sorted((BaseTask.from_json(t, conf) for t in
+                    partition.next_tasks), key=lambda t: t.path)
+    prefix = '{d}@{o}'.format(d=disk, o=PARTITION_OFFSET)
+    assert [t.path for t in files] == [prefix + '/b.txt',
+                                       prefix + '/sub/a.txt']
+    assert files[1]._size == len('secret: 1\n')
+    with files[0].open() as fd:
+        assert fd.read() == b'hello\n'
+        # other threads read through file systems of their own
+        headers = []
+        thread = threading.Thread(
+            target=lambda: headers.append(files[1].read_header(6)))
+        thread.start()
+        thread.join()
+        assert headers == [b'secret']
+        fd.seek(0)
+        assert fd.read() == b'hello\n'
+    assert files[1].start().results['matches'] == [[0, 6, 'secret']]
+
+
+@pytest.mark.skipif(shutil.which('mkfs.ext4') is None,
+                    reason='requires mkfs.ext4')
+def test_tsk_carve(tmp_path, make_conf, make_jpeg):
+    disk = make_disk(tmp_path)
+    # hide a picture between the partition table and the partition
+    picture = make_jpeg()
+    with disk.open('r+b') as fd:
+        fd.seek(64 * 1024)
+        fd.write(picture)
+    conf = make_conf({'Image': {'mode': 'tsk', 'carve': True}})
+    task = Image(str(disk), conf).start()
+    carvers = [BaseTask.from_json(t, conf) for t in task.next_tasks]
+    carvers = [t.start() for t in carvers if t._name == 'Carver']
+    carved = [BaseTask.from_json(t, conf)
+              for carver in carvers for t in carver.next_tasks]
+    assert [t._name for t in carved] == ['JpegFile']
+    with carved[0].open() as fd:
+        assert fd.read() == picture
@@ -0,0 +1,39 @@
+import io
+import struct
+
+from forework.tasks import jpeg
+from forework.tasks.jpeg import JpegFile
+
+
+def iptc_segment(datasets):
+    iim = b''.join(
+        struct.pack('>BBBH', 0x1c, 2, dataset, len(value)) + value
+        for (dataset, value) in datasets
+    )
+    resource = b'8BIM' + struct.pack('>HBBI', jpeg.IPTC_RESOURCE_ID, 0, 0,
+                                     len(iim)) + iim
+    data = jpeg.PHOTOSHOP_HEADER + resource
+    return b'\xff\xed' + struct.pack('>H', len(data) + 2) + data
+
+
+def test_read_metadata(make_jpeg):
+    data = make_jpeg()
+    # insert IPTC after SOI, and make sure nothing after SOS is read
+    data = data[:2] + iptc_segment([(25, b'a'), (25, b'b'), (5, b'x')]) + \
+        data[2:]
+    scan = data.index(b'\xff\xda')
+    metadata = jpeg.read_metadata(io.BytesIO(data[:scan + 2]))
+    assert metadata['exif']['Make'] == 'Canon'
+    assert metadata['datetime_original'] == '2019-12-31T23:59:58'
+    assert metadata['latitude'] == 45.5
+    assert round(metadata['longitude'], 2) == -10.26
+    assert metadata['iptc'] == {'Keywords': ['a', 'b'], 'ObjectName': 'x'}
+    assert metadata['comments'] == ['hello']
+
+
+def test_run(tmp_path, make_conf, make_jpeg):
+    path = tmp_path / 'a.jpg'
+    make_jpeg(path)
+    task = JpegFile(str(path), make_conf()).start()
+    assert task.results['gps']['GPSLatitudeRef'] == 'N'
+    assert task.warnings == []
@@ -0,0 +1,52 @@
+import threading
+
+import PIL.Image
+
+from forework.basetask import BaseTask
+from forework.tasks import pdf
+from forework.tasks.pdf import PDFFile
+
+
+def test_metadata(tmp_path, make_conf, make_pdf):
+    path = tmp_path / 'doc.pdf'
+    make_pdf(path)
+    task = PDFFile(str(path), make_conf()).start()
+    assert task.results['pages'] == 2
+    assert task.results['images'] == []
+    assert task.next_tasks == []
+
+
+def test_extract_pictures(tmp_path, make_conf, make_pdf):
+    path = tmp_path / 'doc.pdf'
+    make_pdf(path)
+    conf = make_conf({'PDFFile': {'extract_pictures': True}})
+    task = PDFFile(str(path), conf).start()
+    assert len(task.results['images']) == 2
+    assert task.results['other_images'] == []
+    images = [BaseTask.from_json(t, conf) for t in task.next_tasks]
+    assert {t._name for t in images} == {'JpegFile'}
+    for image in images:
+        with image.open() as fd:
+            assert PIL.Image.open(fd).format == 'JPEG'
+    assert PIL.Image.open(images[1].open()).size == (8, 8)
+
+
+def test_documents_per_thread(tmp_path, make_conf, make_pdf, monkeypatch):
+    path = tmp_path / 'doc.pdf'
+    make_pdf(path)
+    conf = make_conf({'PDFFile': {'extract_pictures': True}})
+    task = PDFFile(str(path), conf).start()
+    images = [BaseTask.from_json(t, conf) for t in task.next_tasks]
+    pdf._documents.clear()
+    opened = []
+    open_document = pdf._open_document
+    monkeypatch.setattr(pdf, '_open_document',
+                        lambda *args: opened.append(args) or
+                        open_document(*args))
+    assert images[0].read_header(2) == b'\xff\xd8'
+    # another thread parses the document again, and leaves it open in this one
+    thread = threading.Thread(target=images[1].read_header, args=(2, ))
+    thread.start()
+    thread.join()
+    assert images[1].read_header(2) == b'\xff\xd8'
+    assert len(opened) == 2
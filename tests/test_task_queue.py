@@ -0,0 +1,74 @@
+import queue
+
+import pytest
+
+from forework.basetask import PRIO_HIGH, PRIO_LOW, PRIO_NORMAL
+from forework.task_queue import PriorityTaskQueue
+
+
+class FakeTask:
+    def __init__(self, priority=PRIO_NORMAL, depth=0):
+        self._priority = priority
+        self._depth = depth
+
+
+class TextFile(FakeTask):
+    pass
+
+
+class JpegFile(FakeTask):
+    pass
+
+
+def drain(task_queue):
+    tasks = []
+    while True:
+        try:
+            tasks.append(task_queue.get_nowait())
+        except queue.Empty:
+            return tasks
+
+
+def test_order():
+    task_queue = PriorityTaskQueue(priority=['JpegFile'], aging_rate=0)
+    tasks = [
+        TextFile(depth=1),
+        TextFile(priority=PRIO_LOW),
+        TextFile(),
+        JpegFile(depth=5),
+        TextFile(priority=PRIO_HIGH, depth=3),
+    ]
+    for task in tasks:
+        task_queue.put_nowait(task)
+    assert drain(task_queue) == [tasks[3], tasks[4], tasks[2], tasks[0],
+                                 tasks[1]]
+
+
+def test_reprioritize():
+    task_queue = PriorityTaskQueue(aging_rate=0)
+    text, jpeg = TextFile(), JpegFile()
+    task_queue.put_nowait(text)
+    task_queue.put_nowait(jpeg)
+    assert task_queue.reprioritize('JpegFile', PRIO_HIGH) == 1
+    assert task_queue.snapshot() == [jpeg, text]
+    task_queue.set_priority(['TextFile'])
+    task_queue.reprioritize('JpegFile', PRIO_NORMAL)
+    assert drain(task_queue) == [text, jpeg]
+
+
+def test_aging(monkeypatch):
+    clock = [0]
+    monkeypatch.setattr('time.monotonic', lambda: clock[0])
+    task_queue = PriorityTaskQueue(aging_rate=1)
+    low = TextFile(priority=PRIO_LOW)
+    task_queue.put_nowait(low)
+    clock[0] = 1000
+    high = TextFile(priority=PRIO_HIGH)
+    task_queue.put_nowait(high)
+    assert task_queue.get_nowait() is low
+
+
+def test_empty():
+    task_queue = PriorityTaskQueue()
+    with pytest.raises(queue.Empty):
+        task_queue.get(timeout=0)
@@ -0,0 +1,64 @@
+import io
+import re
+
+from forework.results import Results
+from forework.tasks import textfile
+from forework.tasks.textfile import TextFile
+
+
+def test_run(tmp_path, make_conf):
+    path = tmp_path / 'log.txt'
+    path.write_text('first line\nSecret: 1\nother\nsecret: 2\n')
+    conf = make_conf({'TextFile': {'grep': '^secret: \\d', 'max_matches': 1}})
+    task = TextFile(str(path), conf).start()
+    assert task.results == {
+        'pattern': '^secret: \\d',
+        'matches': [[11, 20, 'Secret: 1']],
+        'truncated': True,
+    }
+
+
+def test_run_no_pattern(tmp_path, make_conf):
+    path = tmp_path / 'log.txt'
+    path.write_text('text\n')
+    task = TextFile(str(path), make_conf()).start()
+    assert task.results.startswith('No pattern requested')
+
+
+def test_finditer_chunked():
+    data = b'xxabcxxxxabcxabc' * 3
+    pattern = re.compile(b'abcx+')
+    expected = [(m.start(), m.end(), m.group())
+                for m in pattern.finditer(data)]
+    found = list(textfile.finditer_chunked(
+        io.BytesIO(data), pattern, chunk_size=5, overlap=4))
+    assert found == expected
+
+
+def test_finditer_preview(tmp_path):
+    data = b'start ' + b'x' * 100000 + b' end\n'
+    path = tmp_path / 'big.txt'
+    path.write_bytes(data)
+    pattern = textfile.compile_pattern('start.*end')
+    preview = data[:textfile.MAX_MATCH_PREVIEW]
+    assert list(textfile.finditer_file(str(path), pattern)) == [
+        (0, len(data) - 1, preview)]
+    assert list(textfile.finditer_chunked(
+        io.BytesIO(data), pattern, chunk_size=4096, overlap=len(data))) == [
+        (0, len(data) - 1, preview)]
+
+
+def test_run_keywords(tmp_path, make_conf):
+    (tmp_path / 'a.txt').write_text('Alice paid bob\n')
+    (tmp_path / 'b.txt').write_text('nothing here\n')
+    conf = make_conf({'TextFile': {'keywords': ['alice', 'bob', 'carol']}})
+    tasks = [TextFile(str(tmp_path / name), conf).start()
+             for name in ('a.txt', 'b.txt')]
+    assert tasks[0].results == {
+        'keywords': {'alice': [0], 'bob': [11]},
+        'keywords_truncated': False,
+    }
+    res = Results(tasks)
+    assert res.keywords() == {'alice': 1, 'bob': 1}
+    assert [t.path for t in res.hits('bob')] == [tasks[0].path]
+    assert len(res.hits('carol')) == 0
@@ -0,0 +1,96 @@
+import io
+import zipfile
+import threading
+
+from forework import sources
+from forework.basetask import BaseTask
+from forework.tasks.zip import ZipFile
+
+
+def make_zip(path_or_fd, members):
+    with zipfile.ZipFile(path_or_fd, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for (name, data) in members.items():
+            zf.writestr(name, data)
+
+
+def test_stream(tmp_path, make_conf):
+    inner = io.BytesIO()
+    make_zip(inner, {'deep.txt': 'secret: 42\n'})
+    evidence = tmp_path / 'evidence'
+    evidence.mkdir()
+    path = evidence / 'outer.zip'
+    make_zip(str(path), {
+        'docs/notes.txt': 'nothing\n',
+        'inner.zip': inner.getvalue(),
+    })
+    conf = make_conf({'TextFile': {'grep': 'secret: \\d+'}})
+    task = ZipFile(str(path), conf).start()
+    assert task.results.endswith('found 2 tasks, and 0 unknown file types')
+    # nothing is extracted
+    assert list(evidence.iterdir()) == [path]
+    members = [BaseTask.from_json(t, conf) for t in task.next_tasks]
+    assert [(t._name, t.path) for t in members] == [
+        ('TextFile', str(path) + '/docs/notes.txt'),
+        ('ZipFile', str(path) + '/inner.zip'),
+    ]
+
+    # nested archives are read from their parent
+    inner_task = members[1].start()
+    deep = BaseTask.from_json(inner_task.next_tasks[0], conf).start()
+    assert deep.path == str(path) + '/inner.zip/deep.txt'
+    assert deep._size == len('secret: 42\n')
+    assert deep.results['matches'] == [[0, 10, 'secret: 42']]
+
+
+def test_nested_members(tmp_path, make_conf, monkeypatch):
+    inner = io.BytesIO()
+    make_zip(inner, {'{n}.txt'.format(n=n): 'text\n' for n in range(5)})
+    path = tmp_path / 'outer.zip'
+    make_zip(str(path), {'inner.zip': inner.getvalue()})
+    conf = make_conf()
+    task = ZipFile(str(path), conf).start()
+    inner_task = BaseTask.from_json(task.next_tasks[0], conf).start()
+    members = [BaseTask.from_json(t, conf) for t in inner_task.next_tasks]
+    assert len(members) == 5
+    sources._archives.clear()
+    spooled = []
+    spool = sources.spool
+    monkeypatch.setattr(sources, 'spool',
+                        lambda fd: spooled.append(fd) or spool(fd))
+    for member in members:
+        assert member.read_header(5) == b'text\n'
+    # the inner archive is spooled once, then each member
+    assert len(spooled) == 6
+    # other threads open the archive again, and leave it open in this one
+    thread = threading.Thread(target=members[0].read_header, args=(5, ))
+    thread.start()
+    thread.join()
+    assert len(spooled) == 8
+    assert members[1].read_header(5) == b'text\n'
+    assert len(spooled) == 9
+
+
+def test_limits(tmp_path, make_conf):
+    path = tmp_path / 'bomb.zip'
+    make_zip(str(path), {
+        'zeros': b'\0' * (2 * ZipFile.RATIO_MIN_SIZE),
+        'a.txt': 'text\n',
+    })
+    task = ZipFile(str(path), make_conf()).start()
+    assert len(task.warnings) == 1
+    assert len(task.next_tasks) == 1
+
+    conf = make_conf({'ZipFile': {'max_total_size': 1024}})
+    task = ZipFile(str(path), conf).start()
+    assert task.results is None
+    assert task.next_tasks == []
+
+
+def test_extract(tmp_path, make_conf):
+    path = tmp_path / 'a.zip'
+    make_zip(str(path), {'a.txt': 'text\n'})
+    outdir = tmp_path / 'out'
+    task = ZipFile(str(path), make_conf({'ZipFile': {'outdir': str(outdir)}}))
+    task.start()
+    assert (outdir / 'a.txt').read_text() == 'text\n'
+    assert len(task.next_tasks) == 1
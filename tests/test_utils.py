@@ -0,0 +1,34 @@
+from forework import utils
+
+
+def test_get_file_type_cached(tmp_path, monkeypatch):
+    path = tmp_path / 'a.txt'
+    path.write_text('hello\n')
+    calls = []
+    from_buffer = utils.mage.from_buffer
+    monkeypatch.setattr(utils.mage, 'from_buffer',
+                        lambda buf: calls.append(buf) or from_buffer(buf))
+    assert utils.get_file_type(str(path)) == 'ASCII text'
+    assert utils.get_file_type(str(path)) == 'ASCII text'
+    assert calls == [b'hello\n']
+    assert utils.read_header(str(path), 4) == b'hell'
+
+
+def test_get_file_type_special(tmp_path):
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'link').symlink_to(tmp_path / 'missing')
+    assert utils.get_file_type(str(tmp_path / 'dir')) == 'directory'
+    assert utils.get_file_type(str(tmp_path / 'link')) == 'symbolic link'
+
+
+def test_get_file_type_generic(tmp_path, monkeypatch):
+    small = tmp_path / 'small.bin'
+    small.write_bytes(b'\x00\xff' * 16)
+    large = tmp_path / 'large.bin'
+    large.write_bytes(b'\x00\xff' * utils.config.FILE_TYPE_HEADER_SIZE)
+    calls = []
+    monkeypatch.setattr(utils.mage, 'from_file',
+                        lambda path: calls.append(path) or 'whole file')
+    assert utils.get_file_type(str(small)) == 'data'
+    assert utils.get_file_type(str(large)) == 'whole file'
+    assert calls == [str(large)]